@@ -29,6 +29,9 @@ export function useMedicalRecordWebSocket({
     const url = new URL(wsUrl);
     url.searchParams.set('historyID', historyID);
     url.searchParams.set('userId', userId);
+    // websocket_connect only subscribes the doctor the token belongs to
+    const token = window.localStorage.getItem('accessToken');
+    if (token) url.searchParams.set('token', token);
 
     const animationFrame = requestAnimationFrame(() => setStatus('connecting'));
     let socket: WebSocket;
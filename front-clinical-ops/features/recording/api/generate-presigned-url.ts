@@ -1,5 +1,10 @@
 import { useMutation } from '@tanstack/react-query';
-import type { PresignedUrlRequest, PresignedUrlResponse } from '../types';
+import type {
+  PresignedUrlBatchRequest,
+  PresignedUrlBatchResponse,
+  PresignedUrlRequest,
+  PresignedUrlResponse,
+} from '../types';
 import { invokeLambdaApi } from '@/lib/lambda-api';
 
 export const generatePresignedUrl = (
@@ -11,6 +16,16 @@ export const generatePresignedUrl = (
   });
 };
 
+// One round trip for a whole sync burst; duplicate content shares an upload
+export const generatePresignedUrlBatch = (
+  data: PresignedUrlBatchRequest
+): Promise<PresignedUrlBatchResponse> => {
+  return invokeLambdaApi<PresignedUrlBatchResponse>({
+    functionName: 'generate_presigned_url',
+    payload: { action: 'batch', ...data },
+  });
+};
+
 export const useGeneratePresignedUrl = () => {
   return useMutation({
     mutationFn: generatePresignedUrl,
@@ -1,6 +1,7 @@
 import { queryOptions, useQuery } from '@tanstack/react-query';
 import type { CreateHistoryFromRecordingResponse } from '../types';
 import { invokeLambdaApi } from '@/lib/lambda-api';
+import { usePipelineUpdates } from '../hooks/use-pipeline-updates';
 
 export const getHistoryStatus = (
   historyID: string
@@ -18,17 +19,25 @@ export const getHistoryStatusQueryOptions = (historyID: string) => {
     queryKey: ['medical-history', historyID],
     queryFn: () => getHistoryStatus(historyID),
     enabled: !!historyID,
+  });
+};
+
+// Pushes are best effort: poll as before while the socket is down, and slowly
+// while it is up in case an event (a terminal one included) was lost
+const DISCONNECTED_POLL_MS = 3000;
+const CONNECTED_POLL_MS = 30000;
+
+// Progress arrives over the WebSocket API (see usePipelineUpdates), polling is the fallback
+export const useHistoryStatus = (historyID: string, userId?: string) => {
+  const { isConnected } = usePipelineUpdates({ historyID, userId });
+  return useQuery({
+    ...getHistoryStatusQueryOptions(historyID),
     refetchInterval: (query) => {
-      // Refetch every 3 seconds if status is pending or processing
       const data = query.state.data;
       if (data?.history?.status === 'pending' || data?.history?.status === 'processing') {
-        return 3000;
+        return isConnected ? CONNECTED_POLL_MS : DISCONNECTED_POLL_MS;
       }
       return false;
     },
   });
 };
-
-export const useHistoryStatus = (historyID: string) => {
-  return useQuery(getHistoryStatusQueryOptions(historyID));
-};
@@ -0,0 +1,48 @@
+import type {
+  CompleteMultipartUploadResponse,
+  CreateMultipartUploadResponse,
+  ListPartsResponse,
+  MultipartUploadRef,
+  PresignedUrlRequest,
+  PresignPartsResponse,
+} from '../types';
+import { invokeLambdaApi } from '@/lib/lambda-api';
+
+// Resumable uploads for long recordings: parts already in S3 survive a
+// dropped connection, so a retry only sends the missing ones.
+
+export const createMultipartUpload = (
+  data: PresignedUrlRequest
+): Promise<CreateMultipartUploadResponse> => {
+  return invokeLambdaApi<CreateMultipartUploadResponse>({
+    functionName: 'generate_presigned_url',
+    payload: { action: 'createMultipart', ...data },
+  });
+};
+
+export const presignUploadParts = (
+  data: MultipartUploadRef & { partNumbers: number[] }
+): Promise<PresignPartsResponse> => {
+  return invokeLambdaApi<PresignPartsResponse>({
+    functionName: 'generate_presigned_url',
+    payload: { action: 'presignParts', ...data },
+  });
+};
+
+export const listUploadedParts = (
+  data: MultipartUploadRef
+): Promise<ListPartsResponse> => {
+  return invokeLambdaApi<ListPartsResponse>({
+    functionName: 'generate_presigned_url',
+    payload: { action: 'listParts', ...data },
+  });
+};
+
+export const completeMultipartUpload = (
+  data: MultipartUploadRef & { partCount: number }
+): Promise<CompleteMultipartUploadResponse> => {
+  return invokeLambdaApi<CompleteMultipartUploadResponse>({
+    functionName: 'generate_presigned_url',
+    payload: { action: 'completeMultipart', ...data },
+  });
+};
@@ -47,7 +47,7 @@ export function RecordingInterfaceLegacy({
 
   const generatePresignedUrl = useGeneratePresignedUrl()
   const createHistory = useCreateHistoryFromRecording()
-  const historyStatus = useHistoryStatus(processingHistoryID || '')
+  const historyStatus = useHistoryStatus(processingHistoryID || '', doctorID)
 
   // Update timer
   useEffect(() => {
@@ -158,6 +158,7 @@ export function RecordingInterfaceLegacy({
       await axios.put(presignedData.uploadURL, recordingBlob, {
         headers: {
           'Content-Type': recordingBlob.type || 'audio/webm',
+          ...presignedData.uploadHeaders,
         },
         onUploadProgress: (progressEvent) => {
           const percentCompleted = Math.round(
@@ -172,14 +173,19 @@ export function RecordingInterfaceLegacy({
       // Construct the recording URL
       const recordingURL = `https://storage.clinicalops.co/${presignedData.fileKey}`
 
-      // Create medical history from recording
-      const result = await createHistory.mutateAsync({
-        doctorID,
-        recordingURL,
-      })
+      // The upload starts the pipeline when the URL carried a historyID;
+      // otherwise create the medical history (returns immediately with pending status)
+      const historyID =
+        presignedData.historyID ??
+        (
+          await createHistory.mutateAsync({
+            doctorID,
+            recordingURL,
+          })
+        ).history.historyID
 
       // Start polling for status updates
-      setProcessingHistoryID(result.history.historyID)
+      setProcessingHistoryID(historyID)
     } catch (error: unknown) {
       setIsUploading(false)
       const errorMessage =
@@ -217,6 +223,7 @@ export function RecordingInterfaceLegacy({
       await axios.put(presignedData.uploadURL, file, {
         headers: {
           'Content-Type': file.type,
+          ...presignedData.uploadHeaders,
         },
         onUploadProgress: (progressEvent) => {
           const percentCompleted = Math.round(
@@ -231,14 +238,19 @@ export function RecordingInterfaceLegacy({
       // Construct the recording URL
       const recordingURL = `https://storage.clinicalops.co/${presignedData.fileKey}`
 
-      // Create medical history from recording
-      const result = await createHistory.mutateAsync({
-        doctorID,
-        recordingURL,
-      })
+      // The upload starts the pipeline when the URL carried a historyID;
+      // otherwise create the medical history (returns immediately with pending status)
+      const historyID =
+        presignedData.historyID ??
+        (
+          await createHistory.mutateAsync({
+            doctorID,
+            recordingURL,
+          })
+        ).history.historyID
 
       // Start polling for status updates
-      setProcessingHistoryID(result.history.historyID)
+      setProcessingHistoryID(historyID)
     } catch (error: unknown) {
       setIsUploading(false)
       const errorMessage =
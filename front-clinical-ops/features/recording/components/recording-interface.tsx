@@ -49,7 +49,7 @@ export function RecordingInterface({
 
   const generatePresignedUrl = useGeneratePresignedUrl()
   const createHistory = useCreateHistoryFromRecording()
-  const historyStatus = useHistoryStatus(processingHistoryID || '')
+  const historyStatus = useHistoryStatus(processingHistoryID || '', doctorID)
   const { isOnline } = useNetworkStatus()
   const { saveRecording, storageStats, refreshStorageStats } =
     useRecordingStorage()
@@ -285,12 +285,14 @@ export function RecordingInterface({
         doctorID,
         fileName,
         contentType: recordingBlob.type || 'audio/webm',
+        durationSeconds,
       })
 
       // Upload to S3 using pre-signed URL
       await axios.put(presignedData.uploadURL, recordingBlob, {
         headers: {
           'Content-Type': recordingBlob.type || 'audio/webm',
+          ...presignedData.uploadHeaders,
         },
         onUploadProgress: (progressEvent) => {
           const percentCompleted = Math.round(
@@ -305,21 +307,24 @@ export function RecordingInterface({
       // Construct the recording URL
       const recordingURL = `https://storage.clinicalops.co/${presignedData.fileKey}`
 
-      // Create medical history from recording (returns immediately with pending status)
-      const result = await createHistory.mutateAsync({
-        doctorID,
-        recordingURL,
-      })
+      // The upload starts the pipeline when the URL carried a historyID;
+      // otherwise create the medical history (returns immediately with pending status)
+      const historyID =
+        presignedData.historyID ??
+        (
+          await createHistory.mutateAsync({
+            doctorID,
+            recordingURL,
+            durationSeconds,
+          })
+        ).history.historyID
 
       // Start polling for status updates
-      setProcessingHistoryID(result.history.historyID)
+      setProcessingHistoryID(historyID)
 
       // Note: We'll update the recording status to 'synced' in the sync manager later
       // For now, just log that upload was successful
-      console.log(
-        'Recording uploaded successfully, historyID:',
-        result.history.historyID,
-      )
+      console.log('Recording uploaded successfully, historyID:', historyID)
     } catch (error: unknown) {
       setIsUploading(false)
       const errorMessage =
@@ -357,6 +362,7 @@ export function RecordingInterface({
       await axios.put(presignedData.uploadURL, file, {
         headers: {
           'Content-Type': file.type,
+          ...presignedData.uploadHeaders,
         },
         onUploadProgress: (progressEvent) => {
           const percentCompleted = Math.round(
@@ -371,14 +377,19 @@ export function RecordingInterface({
       // Construct the recording URL
       const recordingURL = `https://storage.clinicalops.co/${presignedData.fileKey}`
 
-      // Create medical history from recording (returns immediately with pending status)
-      const result = await createHistory.mutateAsync({
-        doctorID,
-        recordingURL,
-      })
+      // The upload starts the pipeline when the URL carried a historyID;
+      // otherwise create the medical history (returns immediately with pending status)
+      const historyID =
+        presignedData.historyID ??
+        (
+          await createHistory.mutateAsync({
+            doctorID,
+            recordingURL,
+          })
+        ).history.historyID
 
       // Start polling for status updates
-      setProcessingHistoryID(result.history.historyID)
+      setProcessingHistoryID(historyID)
     } catch (error: unknown) {
       setIsUploading(false)
       const errorMessage =
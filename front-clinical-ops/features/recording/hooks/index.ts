@@ -15,6 +15,9 @@ export type {
   SyncProgress,
 } from './use-sync-manager';
 
+export { usePipelineUpdates } from './use-pipeline-updates';
+export type { UsePipelineUpdatesOptions } from './use-pipeline-updates';
+
 export { useRecordingStorage } from './use-recording-storage';
 export type { UseRecordingStorageReturn } from './use-recording-storage';
 
@@ -0,0 +1,133 @@
+'use client'
+
+import { useEffect, useState } from 'react'
+import { useQueryClient } from '@tanstack/react-query'
+import type {
+  CreateHistoryFromRecordingResponse,
+  PipelineProgressEvent,
+} from '../types'
+
+export interface UsePipelineUpdatesOptions {
+  historyID?: string | null
+  // Follow every history of this doctor (dashboards)
+  doctorID?: string | null
+  userId?: string | null
+  onEvent?: (event: PipelineProgressEvent) => void
+}
+
+type ConnectionStatus = 'idle' | 'connecting' | 'connected' | 'error'
+
+const TERMINAL_STATUSES = ['completed', 'failed']
+
+// Delay before reopening a dropped subscription; useHistoryStatus polls meanwhile
+const RECONNECT_DELAY_MS = 5000
+
+/**
+ * Subscribe to pipeline progress pushed over the WebSocket API for a history
+ * and/or every history of a doctor, and keep the React Query cache in sync.
+ * Replaces fast polling of get_medical_history while a recording is processed;
+ * a dropped socket is reopened and refetches on open to catch up.
+ */
+export function usePipelineUpdates({
+  historyID,
+  doctorID,
+  userId,
+  onEvent,
+}: UsePipelineUpdatesOptions) {
+  const [status, setStatus] = useState<ConnectionStatus>('idle')
+  const queryClient = useQueryClient()
+
+  useEffect(() => {
+    const wsUrl = process.env.NEXT_PUBLIC_WS_URL
+    if ((!historyID && !doctorID) || !wsUrl || typeof window === 'undefined') {
+      return
+    }
+
+    const url = new URL(wsUrl)
+    if (historyID) url.searchParams.set('historyID', historyID)
+    if (doctorID) url.searchParams.set('doctorID', doctorID)
+    const connectionUser = userId || doctorID
+    if (connectionUser) url.searchParams.set('userId', connectionUser)
+    // websocket_connect only subscribes the doctor the token belongs to
+    const token = window.localStorage.getItem('accessToken')
+    if (token) url.searchParams.set('token', token)
+
+    let socket: WebSocket | null = null
+    let reconnectTimer: ReturnType<typeof setTimeout> | undefined
+    let closed = false
+
+    const connect = () => {
+      try {
+        socket = new WebSocket(url.toString())
+      } catch (error) {
+        console.error('Failed to establish WebSocket connection', error)
+        setStatus('error')
+        return
+      }
+      setStatus('connecting')
+
+      socket.onopen = () => {
+        setStatus('connected')
+        // Catch up on anything that happened before the subscription existed
+        // or while it was down
+        if (historyID) {
+          queryClient.invalidateQueries({ queryKey: ['medical-history', historyID] })
+        }
+      }
+      socket.onclose = () => {
+        setStatus('idle')
+        if (!closed) {
+          reconnectTimer = setTimeout(connect, RECONNECT_DELAY_MS)
+        }
+      }
+      socket.onerror = () => setStatus('error')
+      socket.onmessage = handleMessage
+    }
+
+    const handleMessage = (message: MessageEvent) => {
+      try {
+        const payload = JSON.parse(message.data) as PipelineProgressEvent
+        if (payload?.action !== 'pipeline') return
+
+        const queryKey = ['medical-history', payload.historyID]
+        if (TERMINAL_STATUSES.includes(payload.status)) {
+          // The finished history carries the note, fetch it once
+          queryClient.invalidateQueries({ queryKey })
+          queryClient.invalidateQueries({ queryKey: ['medical-histories'] })
+        } else {
+          queryClient.setQueryData<CreateHistoryFromRecordingResponse>(
+            queryKey,
+            (previous) =>
+              previous?.history
+                ? {
+                    ...previous,
+                    history: {
+                      ...previous.history,
+                      status: payload.status,
+                      updatedAt: payload.updatedAt,
+                    },
+                  }
+                : previous,
+          )
+        }
+
+        onEvent?.(payload)
+      } catch (error) {
+        console.error('Invalid WebSocket message', error)
+      }
+    }
+
+    connect()
+
+    return () => {
+      closed = true
+      clearTimeout(reconnectTimer)
+      socket?.close()
+    }
+  }, [historyID, doctorID, userId, onEvent, queryClient])
+
+  return {
+    status,
+    isConnected: status === 'connected',
+  }
+}
@@ -2,10 +2,20 @@ import { useState, useEffect, useCallback, useRef } from 'react'
 import { useNetworkStatus } from './use-network-status'
 import { useRecordingStorage } from './use-recording-storage'
 import { RecordingRecord } from '../services/recording-storage.service'
-import { generatePresignedUrl } from '../api/generate-presigned-url'
+import {
+  generatePresignedUrl,
+  generatePresignedUrlBatch,
+} from '../api/generate-presigned-url'
+import {
+  completeMultipartUpload,
+  createMultipartUpload,
+  listUploadedParts,
+  presignUploadParts,
+} from '../api/multipart-upload'
 import { createHistoryFromRecording } from '../api/create-history-from-recording'
 import { errorLoggingService } from '../services/error-logging.service'
 import { performanceMonitoringService } from '../services/performance-monitoring.service'
+import type { PipelinePriority, PresignedUrlResponse } from '../types'
 
 export interface SyncProgress {
   current: number
@@ -47,6 +57,29 @@ export interface SyncManagerOptions {
   onSyncComplete?: () => void | Promise<void>
 }
 
+// Recordings above this size are uploaded in resumable parts
+const MULTIPART_THRESHOLD = 10 * 1024 * 1024 // 10MB
+const PART_SIZE = 5 * 1024 * 1024 // S3 minimum for all but the last part
+const PART_CONCURRENCY = 4
+const PRESIGN_BATCH_SIZE = 100
+const URL_BATCH_SIZE = 50
+
+interface UploadedRecording {
+  recordingURL: string
+  // Set when the upload itself starts the pipeline (ObjectCreated event)
+  historyID: string | null
+}
+
+/**
+ * Hex SHA-256 of the recording bytes, used to spot the same audio queued twice
+ */
+async function hashBlob(blob: Blob): Promise<string> {
+  const digest = await crypto.subtle.digest('SHA-256', await blob.arrayBuffer())
+  return Array.from(new Uint8Array(digest))
+    .map((byte) => byte.toString(16).padStart(2, '0'))
+    .join('')
+}
+
 interface UploadTask {
   recordingId: string
   abortController: AbortController
@@ -94,6 +127,12 @@ export function useSyncManager(
   const activeTasksRef = useRef<Map<string, UploadTask>>(new Map())
   const queueRef = useRef<string[]>([])
   const isSyncingRef = useRef(false)
+  // Upload URLs issued in bulk for the current sync, and keys already sent
+  const prefetchedUrlsRef = useRef<Map<string, PresignedUrlResponse>>(new Map())
+  const uploadedKeysRef = useRef<Set<string>>(new Set())
+  // A backlog synced in one go is batch work for the pipeline; a single
+  // recording is one the doctor is waiting on
+  const syncPriorityRef = useRef<PipelinePriority>('interactive')
 
   /**
    * Update counts from storage
@@ -118,6 +157,216 @@ export function useSyncManager(
     return opts.retryDelay * Math.pow(2, attempt)
   }
 
+  /**
+   * Issue upload URLs for all queued single-PUT recordings in one request per
+   * doctor. Best effort: recordings without a prefetched URL ask for their own.
+   */
+  const prefetchUploadUrls = async (recordings: RecordingRecord[]) => {
+    prefetchedUrlsRef.current.clear()
+    uploadedKeysRef.current.clear()
+
+    const byDoctor = new Map<string, RecordingRecord[]>()
+    recordings
+      .filter((recording) => recording.size < MULTIPART_THRESHOLD)
+      .forEach((recording) => {
+        const group = byDoctor.get(recording.doctorID) ?? []
+        group.push(recording)
+        byDoctor.set(recording.doctorID, group)
+      })
+
+    for (const [doctorID, group] of byDoctor) {
+      for (let i = 0; i < group.length; i += URL_BATCH_SIZE) {
+        const chunk = group.slice(i, i + URL_BATCH_SIZE)
+        try {
+          const files = await Promise.all(
+            chunk.map(async (recording) => ({
+              fileName: recording.fileName,
+              contentType: recording.mimeType,
+              contentHash: await hashBlob(recording.blob),
+              patientID: recording.metadata.patientID,
+              durationSeconds: recording.duration,
+              priority: syncPriorityRef.current,
+            })),
+          )
+          const batch = await generatePresignedUrlBatch({ doctorID, files })
+          batch.uploads.forEach((upload, index) => {
+            prefetchedUrlsRef.current.set(chunk[index].id, {
+              uploadURL: upload.uploadURL,
+              fileKey: upload.fileKey,
+              historyID: upload.historyID,
+              uploadHeaders: upload.uploadHeaders,
+              expiresIn: batch.expiresIn,
+              bucketName: batch.bucketName,
+            })
+          })
+        } catch (error) {
+          console.error('Error prefetching upload URLs:', error)
+        }
+      }
+    }
+  }
+
+  /**
+   * Upload a recording with a single presigned PUT
+   */
+  const uploadSingle = async (
+    recording: RecordingRecord,
+    abortSignal: AbortSignal,
+  ): Promise<UploadedRecording> => {
+    const prefetched = prefetchedUrlsRef.current.get(recording.id)
+    // A prefetched URL is used once; retries ask for a fresh one
+    prefetchedUrlsRef.current.delete(recording.id)
+
+    const presignedData =
+      prefetched ??
+      (await generatePresignedUrl({
+        doctorID: recording.doctorID,
+        fileName: recording.fileName,
+        contentType: recording.mimeType,
+        patientID: recording.metadata.patientID,
+        durationSeconds: recording.duration,
+        priority: syncPriorityRef.current,
+      }))
+
+    if (abortSignal.aborted) {
+      throw new Error('Upload cancelled')
+    }
+
+    const uploaded: UploadedRecording = {
+      recordingURL: presignedData.uploadURL.split('?')[0], // Remove query params
+      historyID: presignedData.historyID ?? null,
+    }
+
+    // Same audio queued twice shares one object, already in S3
+    if (uploadedKeysRef.current.has(presignedData.fileKey)) {
+      return uploaded
+    }
+
+    const uploadResponse = await fetch(presignedData.uploadURL, {
+      method: 'PUT',
+      body: recording.blob,
+      headers: {
+        'Content-Type': recording.mimeType,
+        ...presignedData.uploadHeaders,
+      },
+      signal: abortSignal,
+    })
+
+    if (!uploadResponse.ok) {
+      throw new Error(`S3 upload failed: ${uploadResponse.statusText}`)
+    }
+
+    uploadedKeysRef.current.add(presignedData.fileKey)
+    return uploaded
+  }
+
+  /**
+   * Upload a recording as multipart parts, resuming a previous session if
+   * one is stored with the recording. Parts are pushed in parallel.
+   */
+  const uploadMultipart = async (
+    recording: RecordingRecord,
+    abortSignal: AbortSignal,
+  ): Promise<UploadedRecording> => {
+    // Re-read so a retry in the same sync picks up the session it created
+    const stored = await getRecording(recording.id)
+    let session = stored?.multipartUpload ?? recording.multipartUpload ?? null
+    const uploaded = new Set<number>()
+
+    if (session) {
+      try {
+        const { parts } = await listUploadedParts({
+          doctorID: recording.doctorID,
+          fileKey: session.fileKey,
+          uploadId: session.uploadId,
+        })
+        parts.forEach((part) => uploaded.add(part.partNumber))
+      } catch {
+        // Upload expired or was completed elsewhere, start over
+        session = null
+      }
+    }
+
+    if (!session) {
+      const created = await createMultipartUpload({
+        doctorID: recording.doctorID,
+        fileName: recording.fileName,
+        contentType: recording.mimeType,
+        patientID: recording.metadata.patientID,
+        durationSeconds: recording.duration,
+        priority: syncPriorityRef.current,
+      })
+      session = {
+        uploadId: created.uploadId,
+        fileKey: created.fileKey,
+        partSize: PART_SIZE,
+        historyID: created.historyID ?? null,
+      }
+      await updateRecordingStatus(recording.id, 'uploading', {
+        multipartUpload: session,
+      })
+    }
+
+    const { uploadId, fileKey, partSize } = session
+    const partCount = Math.ceil(recording.size / partSize)
+    const missing: number[] = []
+    for (let partNumber = 1; partNumber <= partCount; partNumber++) {
+      if (!uploaded.has(partNumber)) {
+        missing.push(partNumber)
+      }
+    }
+
+    for (let i = 0; i < missing.length; i += PRESIGN_BATCH_SIZE) {
+      const batch = missing.slice(i, i + PRESIGN_BATCH_SIZE)
+      const { partURLs } = await presignUploadParts({
+        doctorID: recording.doctorID,
+        fileKey,
+        uploadId,
+        partNumbers: batch,
+      })
+
+      const pending = [...batch]
+      const worker = async () => {
+        while (pending.length > 0) {
+          if (abortSignal.aborted) {
+            throw new Error('Upload cancelled')
+          }
+          const partNumber = pending.shift() as number
+          const start = (partNumber - 1) * partSize
+          const response = await fetch(partURLs[String(partNumber)], {
+            method: 'PUT',
+            body: recording.blob.slice(start, start + partSize),
+            signal: abortSignal,
+          })
+          if (!response.ok) {
+            throw new Error(
+              `S3 part ${partNumber} upload failed: ${response.statusText}`,
+            )
+          }
+        }
+      }
+
+      await Promise.all(
+        Array.from(
+          { length: Math.min(PART_CONCURRENCY, batch.length) },
+          worker,
+        ),
+      )
+    }
+
+    const completed = await completeMultipartUpload({
+      doctorID: recording.doctorID,
+      fileKey,
+      uploadId,
+      partCount,
+    })
+
+    return {
+      recordingURL: completed.recordingURL,
+      historyID: session.historyID ?? null,
+    }
+  }
+
   /**
    * Upload a single recording with retry logic
    */
@@ -154,48 +403,36 @@ export function useSyncManager(
           performanceMonitoringService.trackUploadRetry(recordingId)
         }
 
-        // Step 1: Generate presigned URL
-        const presignedData = await generatePresignedUrl({
-          doctorID: recording.doctorID,
-          fileName: recording.fileName,
-          contentType: recording.mimeType,
-        })
-
-        if (abortSignal.aborted) {
-          throw new Error('Upload cancelled')
-        }
-
-        // Step 2: Upload blob to S3 using presigned URL
-        const uploadResponse = await fetch(presignedData.uploadURL, {
-          method: 'PUT',
-          body: recording.blob,
-          headers: {
-            'Content-Type': recording.mimeType,
-          },
-          signal: abortSignal,
-        })
-
-        if (!uploadResponse.ok) {
-          throw new Error(`S3 upload failed: ${uploadResponse.statusText}`)
-        }
+        // Steps 1-2: Upload blob to S3, in resumable parts when large
+        const uploaded =
+          recording.size >= MULTIPART_THRESHOLD
+            ? await uploadMultipart(recording, abortSignal)
+            : await uploadSingle(recording, abortSignal)
 
         if (abortSignal.aborted) {
           throw new Error('Upload cancelled')
         }
 
-        // Step 3: Create medical history from recording
-        const recordingURL = presignedData.uploadURL.split('?')[0] // Remove query params
-        const historyResponse = await createHistoryFromRecording({
-          doctorID: recording.doctorID,
-          recordingURL,
-          patientID: recording.metadata.patientID,
-        })
+        // Step 3: The upload already started the pipeline when the URL carried
+        // a historyID; otherwise create the medical history explicitly
+        const historyID =
+          uploaded.historyID ??
+          (
+            await createHistoryFromRecording({
+              doctorID: recording.doctorID,
+              recordingURL: uploaded.recordingURL,
+              patientID: recording.metadata.patientID,
+              durationSeconds: recording.duration,
+              priority: syncPriorityRef.current,
+            })
+          ).history.historyID
 
         // Step 4: Update recording status to synced
         await updateRecordingStatus(recordingId, 'synced', {
           syncedAt: new Date().toISOString(),
-          historyID: historyResponse.history.historyID,
+          historyID,
           errorMessage: null,
+          multipartUpload: null,
         })
 
         // Track successful upload
@@ -206,7 +443,7 @@ export function useSyncManager(
           opts.onSyncEvent({
             type: 'recording_synced',
             recordingId,
-            historyID: historyResponse.history.historyID,
+            historyID,
           })
         }
 
@@ -418,6 +655,14 @@ export function useSyncManager(
         a.createdAt.localeCompare(b.createdAt),
       )
 
+      syncPriorityRef.current =
+        sortedRecordings.length > 1 ? 'batch' : 'interactive'
+
+      // Issue every upload URL up front in one request
+      if (sortedRecordings.length > 1) {
+        await prefetchUploadUrls(sortedRecordings)
+      }
+
       // Add to queue
       queueRef.current = sortedRecordings.map((r) => r.id)
 
@@ -447,6 +692,7 @@ export function useSyncManager(
 
       // Add to queue
       queueRef.current = [id]
+      syncPriorityRef.current = 'interactive'
 
       // Update progress
       setSyncProgress({
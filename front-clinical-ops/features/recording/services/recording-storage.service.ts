@@ -25,6 +25,12 @@ export interface RecordingRecord {
   updatedAt: string; // ISO 8601
   syncedAt: string | null; // ISO 8601
   historyID: string | null;
+  multipartUpload?: {
+    uploadId: string;
+    fileKey: string;
+    partSize: number; // bytes
+    historyID?: string | null;
+  } | null;
   metadata: {
     patientID?: string;
     sessionNotes?: string;
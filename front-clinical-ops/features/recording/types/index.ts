@@ -1,7 +1,16 @@
+// Live consultations are "interactive"; offline backlogs and backfills are
+// "batch" and only use pipeline capacity that live recordings leave idle
+export type PipelinePriority = 'interactive' | 'batch';
+
 export type PresignedUrlRequest = {
   doctorID: string;
   fileName: string;
   contentType: string;
+  patientID?: string;
+  durationSeconds?: number;
+  // Segments of a live session don't start the pipeline on upload
+  purpose?: 'recording' | 'segment';
+  priority?: PipelinePriority;
 };
 
 export type PresignedUrlResponse = {
@@ -9,16 +18,83 @@ export type PresignedUrlResponse = {
   fileKey: string;
   expiresIn: number;
   bucketName: string;
+  // History started by the upload itself, and the metadata headers to send with the PUT
+  historyID?: string | null;
+  uploadHeaders?: Record<string, string>;
+};
+
+export type PresignedUrlBatchRequest = {
+  doctorID: string;
+  files: {
+    fileName: string;
+    contentType: string;
+    contentHash?: string;
+    patientID?: string;
+    durationSeconds?: number;
+    priority?: PipelinePriority;
+  }[];
+};
+
+export type PresignedUrlBatchResponse = {
+  uploads: (Omit<PresignedUrlResponse, 'expiresIn' | 'bucketName'> & {
+    fileName: string;
+    contentHash: string | null;
+    duplicateOf: number | null;
+  })[];
+  expiresIn: number;
+  bucketName: string;
+};
+
+export type CreateMultipartUploadResponse = {
+  uploadId: string;
+  fileKey: string;
+  historyID?: string | null;
+  bucketName: string;
+};
+
+export type MultipartUploadRef = {
+  doctorID: string;
+  fileKey: string;
+  uploadId: string;
+};
+
+export type PresignPartsResponse = {
+  partURLs: Record<string, string>;
+  expiresIn: number;
+};
+
+export type ListPartsResponse = {
+  parts: { partNumber: number; size: number }[];
+};
+
+export type CompleteMultipartUploadResponse = {
+  fileKey: string;
+  bucketName: string;
+  recordingURL: string;
 };
 
 export type CreateHistoryFromRecordingRequest = {
+  historyID?: string;
   doctorID: string;
   recordingURL: string;
   patientID?: string;
+  durationSeconds?: number;
+  priority?: PipelinePriority;
 };
 
 export type MedicalHistoryStatus = 'pending' | 'processing' | 'completed' | 'failed';
 
+export type PipelineProgressEvent = {
+  action: 'pipeline';
+  historyID: string;
+  doctorID: string;
+  status: MedicalHistoryStatus;
+  pipelineStage: string;
+  checkpoints: string[];
+  errorMessage?: string | null;
+  updatedAt: string;
+};
+
 export type CreateHistoryFromRecordingResponse = {
   history: {
     historyID: string;
@@ -1,9 +1,13 @@
 import os
 import json
+import math
 import boto3
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
 from boto3.dynamodb.types import TypeSerializer
 
+from style_profile import example_hash
+
 # AWS Configuration
 AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
 DYNAMODB_TABLE = os.getenv("DYNAMODB_DOCTORS_TABLE", "doctors")
@@ -14,22 +18,36 @@ dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION)
 lambda_client = boto3.client('lambda', region_name=AWS_REGION)
 table = dynamodb.Table(DYNAMODB_TABLE)
 
+class ExtractFormatUnavailable(Exception):
+    """OpenAI is down: extract_format answered "unavailable" (circuit open)"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"OpenAI is unavailable, retry in {retry_after:.0f}s")
+        # Whole seconds for the Retry-After header, never before the next probe
+        self.retry_after = math.ceil(retry_after)
+
 
-def invoke_extract_format_lambda(example_history_text):
+def invoke_extract_format_lambda(example_history_text, task=None):
     """
     Invoke the extract_format lambda to process the example clinical history
 
     Args:
         example_history_text: Raw text of the example clinical history
+        task: None for the structure, "style_profile" for the condensed style
 
     Returns:
         Structured JSON format of the clinical history
+
+    Raises:
+        ExtractFormatUnavailable while OpenAI is unavailable
     """
     try:
         # Prepare payload for extract_format lambda
         payload = {
             'medical_record_example': example_history_text
         }
+        if task:
+            payload['task'] = task
 
         # Invoke lambda
         response = lambda_client.invoke(
@@ -41,6 +59,9 @@ def invoke_extract_format_lambda(example_history_text):
         # Parse response
         response_payload = json.loads(response['Payload'].read())
 
+        if response_payload.get('error') == 'unavailable':
+            raise ExtractFormatUnavailable(response_payload['retryAfter'])
+
         # Check if there was an error in the lambda execution
         if 'errorMessage' in response_payload:
             raise Exception(f"Extract format lambda error: {response_payload['errorMessage']}")
@@ -52,14 +73,28 @@ def invoke_extract_format_lambda(example_history_text):
         raise
 
 
+def invoke_style_profile(example_history_text):
+    """
+    Condensed style profile of the example, used by create_medical_record
+    instead of the full example. Never blocks a registration: without it the
+    full example is used until backfill_style_profiles computes it.
+    """
+    try:
+        return invoke_extract_format_lambda(example_history_text, task='style_profile')
+    except Exception as e:
+        print(f"Style profile not computed, left for the backfill: {e}")
+        return None
+
+
 def lambda_handler(event, context):
     """
     Lambda function to complete doctor registration (Step 2)
 
     This function:
     1. Receives the example clinical history text
-    2. Invokes extract_format lambda to structure it
-    3. Saves doctor data to DynamoDB with structured example
+    2. Invokes extract_format lambda to structure it and, in parallel, to
+       distill its writing style into a compact profile
+    3. Saves doctor data to DynamoDB with structured example and style profile
 
     Expected event body:
     {
@@ -121,10 +156,14 @@ def lambda_handler(event, context):
 
         # Process example history with extract_format lambda
         print(f"Processing example history for doctor {doctor_id}")
-        structured_history = invoke_extract_format_lambda(example_history_text)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            structure_future = executor.submit(invoke_extract_format_lambda, example_history_text)
+            style_future = executor.submit(invoke_style_profile, example_history_text)
+        structured_history = structure_future.result()
+        style_profile = style_future.result()
         
         # Parse the response body if it's wrapped in API Gateway format
-        if 'body' in structured_history:
+        if structured_history and 'body' in structured_history:
             structured_history = json.loads(structured_history['body']) if isinstance(structured_history['body'], str) else structured_history['body']
 
         # Prepare doctor item for DynamoDB
@@ -142,6 +181,10 @@ def lambda_handler(event, context):
             'registrationComplete': True
         }
 
+        if style_profile:
+            doctor_item['medical_record_style_profile'] = json.dumps(style_profile, ensure_ascii=False)
+            doctor_item['style_profile_example_hash'] = example_hash(example_history_text)
+
         # Save to DynamoDB
         table.put_item(Item=doctor_item)
 
@@ -161,6 +204,22 @@ def lambda_handler(event, context):
             })
         }
 
+    except ExtractFormatUnavailable as e:
+        # Nothing saved: the doctor is never registered without a structure
+        print(f"Extract format unavailable: {e}")
+        return {
+            'statusCode': 503,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*',
+                'Retry-After': str(e.retry_after)
+            },
+            'body': json.dumps({
+                'error': 'Format extraction is temporarily unavailable, please try again in a moment',
+                'retryAfter': e.retry_after
+            })
+        }
+
     except ClientError as e:
         print(f"DynamoDB error: {e}")
         error_code = e.response['Error']['Code']
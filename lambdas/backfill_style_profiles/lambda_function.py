@@ -0,0 +1,164 @@
+import os
+import json
+import boto3
+from datetime import datetime
+
+from style_profile import example_hash
+
+DOCTORS_TABLE = os.getenv('DYNAMODB_DOCTORS_TABLE', 'doctors')
+EXTRACT_FORMAT_LAMBDA = os.getenv('EXTRACT_FORMAT_LAMBDA', 'extract_format')
+# Doctors read per scan page
+BACKFILL_BATCH_SIZE = int(os.getenv('BACKFILL_BATCH_SIZE', '25'))
+# Needed to profile one more doctor (an extract_format call) and hand off
+RESERVED_MS = int(os.getenv('BACKFILL_RESERVED_MS', '90000'))
+
+dynamodb = boto3.resource('dynamodb')
+table = dynamodb.Table(DOCTORS_TABLE)
+lambda_client = boto3.client('lambda')
+
+
+def needs_profile(doctor, force):
+    example = doctor.get('medical_record_example')
+    if not example:
+        return False
+    if force or not doctor.get('medical_record_style_profile'):
+        return True
+    # The example changed after the profile was computed
+    return doctor.get('style_profile_example_hash') != example_hash(example)
+
+
+def compute_style_profile(example):
+    response = lambda_client.invoke(
+        FunctionName=EXTRACT_FORMAT_LAMBDA,
+        InvocationType='RequestResponse',
+        Payload=json.dumps({'medical_record_example': example, 'task': 'style_profile'})
+    )
+    payload = json.loads(response['Payload'].read())
+    if payload.get('error') == 'unavailable':
+        raise Exception(f"OpenAI is unavailable, retry in {payload['retryAfter']:.0f}s")
+    if 'errorMessage' in payload:
+        raise Exception(f"Extract format lambda error: {payload['errorMessage']}")
+    return payload
+
+
+def save_style_profile(doctor, style_profile):
+    """Store the profile unless the doctor replaced the example meanwhile"""
+    example = doctor['medical_record_example']
+    try:
+        table.update_item(
+            Key={'doctorID': doctor['doctorID']},
+            UpdateExpression=(
+                'SET medical_record_style_profile = :profile, style_profile_example_hash = :hash, '
+                'updatedAt = :updated'
+            ),
+            ConditionExpression='medical_record_example = :example',
+            ExpressionAttributeValues={
+                ':profile': json.dumps(style_profile, ensure_ascii=False),
+                ':hash': example_hash(example),
+                ':updated': datetime.utcnow().isoformat() + 'Z',
+                ':example': example
+            }
+        )
+        return True
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+def has_time(context):
+    return context is None or context.get_remaining_time_in_millis() > RESERVED_MS
+
+
+def backfill(context, start_key=None, force=False, dry_run=False):
+    """
+    Scan the doctors from start_key and profile those that need it, while one
+    more doctor fits in the invocation. Returns the counts, the key to
+    continue from (the last doctor handled) and whether the table is done.
+    """
+    result = {'updated': 0, 'skipped': 0, 'failed': 0, 'pending': []}
+    scan_kwargs = {
+        'Limit': BACKFILL_BATCH_SIZE,
+        'ProjectionExpression': (
+            'doctorID, medical_record_example, medical_record_style_profile, style_profile_example_hash'
+        )
+    }
+
+    while True:
+        if start_key:
+            scan_kwargs['ExclusiveStartKey'] = start_key
+        response = table.scan(**scan_kwargs)
+
+        for doctor in response.get('Items', []):
+            if not has_time(context):
+                return result, start_key, False
+            # The doctors table is keyed by doctorID alone
+            start_key = {'doctorID': doctor['doctorID']}
+            if not needs_profile(doctor, force):
+                result['skipped'] += 1
+                continue
+            if dry_run:
+                result['pending'].append(doctor['doctorID'])
+                continue
+            try:
+                style_profile = compute_style_profile(doctor['medical_record_example'])
+                if save_style_profile(doctor, style_profile):
+                    result['updated'] += 1
+                else:
+                    result['skipped'] += 1
+            except Exception as e:
+                # Left without a profile: create_medical_record keeps using the full example
+                print(f"Style profile failed for doctor {doctor['doctorID']}: {e}")
+                result['failed'] += 1
+
+        start_key = response.get('LastEvaluatedKey')
+        if not start_key:
+            return result, None, True
+
+
+def lambda_handler(event, context):
+    """
+    Backfill of the condensed style profile (extract_format "style_profile"
+    task) for doctors registered before auth_register_step2 computed it, or
+    whose profile no longer matches their example.
+
+    Event (all optional):
+        force: recompute every profile, e.g. after changing the style prompt
+        dryRun: only list the doctors that would be profiled
+        startKey: scan position, set when an invocation continues the previous one
+
+    Before each doctor it checks the remaining time, and when one more doesn't
+    fit it hands the rest of the scan, from the last doctor handled, to a fresh
+    invocation of itself. Each profile is written only if the doctor's example
+    is still the one it was computed from.
+    """
+    try:
+        force = bool(event.get('force'))
+        dry_run = bool(event.get('dryRun'))
+        result, start_key, finished = backfill(context, event.get('startKey'), force=force, dry_run=dry_run)
+        handled = result['updated'] + result['skipped'] + result['failed'] + len(result['pending'])
+
+        if not finished and not handled:
+            raise Exception(f"Not a single doctor fits in the invocation, raise the timeout above {RESERVED_MS}ms")
+
+        if not finished and not dry_run:
+            lambda_client.invoke(
+                FunctionName=context.function_name,
+                InvocationType='Event',
+                Payload=json.dumps({'startKey': start_key, 'force': force})
+            )
+            print(f"Continuing the backfill from {start_key}")
+        result['nextStartKey'] = start_key
+
+        print(f"Backfill batch finished: {result}")
+        return {
+            'statusCode': 200,
+            'body': json.dumps(result)
+        }
+
+    except Exception as e:
+        print(f"Error: {e}")
+        import traceback
+        traceback.print_exc()
+        return {
+            'statusCode': 500,
+            'body': json.dumps({'error': 'Internal server error', 'details': str(e)})
+        }
@@ -0,0 +1,280 @@
+import os
+import json
+import boto3
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+BUCKET_NAME = os.getenv('BUCKET_NAME', 'recordings-clinicalops')
+RECORDINGS_DOMAIN = os.getenv('RECORDINGS_DOMAIN', 'storage.clinicalops.co')
+CREATE_HISTORY_LAMBDA = os.getenv('CREATE_HISTORY_LAMBDA', 'create_medical_history_from_recording')
+MAX_PARALLEL_PARTS = int(os.getenv('MAX_PARALLEL_PARTS', '8'))
+
+# S3 rejects multipart parts under 5 MiB, except for the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Containers whose files still play when joined byte by byte: MP3 and ADTS
+# frames are self-delimiting, and Ogg allows chained streams. WebM, MP4 and WAV
+# carry a header per file, so a joined file is corrupt or stops after the first
+# segment; those recordings have to be uploaded whole.
+CONCATENABLE_TYPES = {'audio/mpeg', 'audio/mp3', 'audio/aac', 'audio/aacp', 'audio/ogg'}
+
+# S3_ENDPOINT_URL points the client at a local S3 stand-in
+s3_client = boto3.client('s3', endpoint_url=os.getenv('S3_ENDPOINT_URL') or None)
+lambda_client = boto3.client('lambda')
+
+
+class UnsupportedContainer(ValueError):
+    """The segments can't be joined as-is"""
+
+
+def _base_type(content_type):
+    return (content_type or '').split(';')[0].strip().lower()
+
+
+def _response(status_code, body):
+    return {
+        'statusCode': status_code,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps(body)
+    }
+
+
+def plan_parts(segments):
+    """
+    Lay the ordered (key, size) segments out as multipart parts.
+
+    Returns a list of ('copy', (key, start, end)) parts, copied inside S3 with
+    UploadPartCopy, and ('upload', [(key, start, end), ...]) parts, which gather
+    byte ranges too small to be a part of their own. Only those small ranges
+    pass through the Lambda, never more than MIN_PART_SIZE at a time per part.
+    """
+    parts = []
+    pending = []
+    pending_size = 0
+
+    for key, size in segments:
+        offset = 0
+
+        # Top up a pending small part with the head of this segment
+        if pending:
+            take = min(MIN_PART_SIZE - pending_size, size)
+            pending.append((key, 0, take))
+            pending_size += take
+            offset = take
+            if pending_size >= MIN_PART_SIZE:
+                parts.append(('upload', pending))
+                pending, pending_size = [], 0
+
+        remaining = size - offset
+        if remaining <= 0:
+            continue
+
+        if remaining >= MIN_PART_SIZE:
+            parts.append(('copy', (key, offset, size)))
+        else:
+            pending.append((key, offset, size))
+            pending_size += remaining
+
+    if pending:
+        parts.append(('upload', pending))
+
+    return parts
+
+
+def _write_part(upload_id, final_key, part_number, part):
+    kind, ranges = part
+
+    if kind == 'copy':
+        key, start, end = ranges
+        response = s3_client.upload_part_copy(
+            Bucket=BUCKET_NAME,
+            Key=final_key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            CopySource={'Bucket': BUCKET_NAME, 'Key': key},
+            CopySourceRange=f"bytes={start}-{end - 1}"
+        )
+        return {'PartNumber': part_number, 'ETag': response['CopyPartResult']['ETag']}
+
+    data = b''.join(
+        s3_client.get_object(Bucket=BUCKET_NAME, Key=key, Range=f"bytes={start}-{end - 1}")['Body'].read()
+        for key, start, end in ranges
+    )
+    response = s3_client.upload_part(
+        Bucket=BUCKET_NAME,
+        Key=final_key,
+        UploadId=upload_id,
+        PartNumber=part_number,
+        Body=data
+    )
+    return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+
+def concatenate_segments(segment_keys, final_key, content_type):
+    """
+    Build final_key from the segments in order; returns bytes copied in S3 and
+    bytes streamed. Raises UnsupportedContainer unless every segment is of
+    content_type, one of CONCATENABLE_TYPES.
+    """
+    if _base_type(content_type) not in CONCATENABLE_TYPES:
+        raise UnsupportedContainer(f"{content_type} segments can't be concatenated")
+
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_PARTS) as executor:
+        heads = list(executor.map(
+            lambda key: s3_client.head_object(Bucket=BUCKET_NAME, Key=key),
+            segment_keys
+        ))
+
+    for key, head in zip(segment_keys, heads):
+        if _base_type(head.get('ContentType')) != _base_type(content_type):
+            raise UnsupportedContainer(f"Segment {key} is {head.get('ContentType')}, expected {content_type}")
+
+    segments = [(key, head['ContentLength']) for key, head in zip(segment_keys, heads) if head['ContentLength'] > 0]
+    if not segments:
+        raise ValueError('All segments are empty')
+
+    parts = plan_parts(segments)
+
+    # The pipeline is started explicitly below, not by the ObjectCreated event
+    upload_id = s3_client.create_multipart_upload(
+        Bucket=BUCKET_NAME,
+        Key=final_key,
+        ContentType=content_type,
+        Metadata={'pipeline': 'skip'}
+    )['UploadId']
+
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_PARALLEL_PARTS) as executor:
+            completed_parts = list(executor.map(
+                lambda numbered: _write_part(upload_id, final_key, numbered[0], numbered[1]),
+                enumerate(parts, start=1)
+            ))
+
+        s3_client.complete_multipart_upload(
+            Bucket=BUCKET_NAME,
+            Key=final_key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': completed_parts}
+        )
+    except Exception:
+        s3_client.abort_multipart_upload(Bucket=BUCKET_NAME, Key=final_key, UploadId=upload_id)
+        raise
+
+    bytes_copied = sum(ranges[2] - ranges[1] for kind, ranges in parts if kind == 'copy')
+    bytes_streamed = sum(end - start for kind, ranges in parts if kind == 'upload' for key, start, end in ranges)
+    return bytes_copied, bytes_streamed
+
+
+def start_pipeline(body, recording_url, segment_count):
+    """Create the history (or close the live session) for the concatenated recording"""
+    if body.get('historyID'):
+        payload = {
+            'action': 'finishSession',
+            'historyID': body['historyID'],
+            'segmentCount': segment_count,
+            'recordingURL': recording_url
+        }
+    else:
+        payload = {
+            'doctorID': body['doctorID'],
+            'recordingURL': recording_url
+        }
+        if body.get('patientID'):
+            payload['patientID'] = body['patientID']
+
+    if body.get('durationSeconds'):
+        payload['durationSeconds'] = body['durationSeconds']
+
+    # Only writes the history item and returns, no processing happens in this call
+    response = lambda_client.invoke(
+        FunctionName=CREATE_HISTORY_LAMBDA,
+        InvocationType='RequestResponse',
+        Payload=json.dumps({'body': json.dumps(payload)})
+    )
+    result = json.loads(response['Payload'].read())
+    if result.get('statusCode') != 200:
+        raise Exception(f"Pipeline start failed: {result}")
+    return json.loads(result['body'])
+
+
+def lambda_handler(event, context):
+    """
+    Concatenate uploaded recording segments into one recording inside S3 and start the pipeline
+
+    Expected input:
+    {
+        "doctorID": "string",
+        "segmentKeys": ["doctors/{doctorID}/recordings/...", ...],  # in recording order
+        "fileName": "string",
+        "contentType": "audio/mpeg" | "audio/aac" | "audio/ogg",
+        "patientID": "string" (optional),
+        "durationSeconds": number (optional),
+        "historyID": "string" (optional, live session to close instead of creating a history)
+    }
+
+    Returns:
+    {
+        "fileKey": "doctors/{doctorID}/recordings/{timestamp}_{fileName}",
+        "recordingURL": "https://storage.clinicalops.co/...",
+        "history": {...}
+    }
+
+    The bytes are concatenated as-is, so segments must share a container that
+    tolerates it (CONCATENABLE_TYPES); anything else is rejected with a 400.
+    """
+    try:
+        if isinstance(event.get('body'), str):
+            body = json.loads(event['body'])
+        else:
+            body = event.get('body', {})
+
+        doctor_id = body.get('doctorID')
+        segment_keys = body.get('segmentKeys') or []
+        file_name = body.get('fileName')
+        content_type = body.get('contentType')
+
+        if not doctor_id or not segment_keys or not file_name or not content_type:
+            return _response(400, {'error': 'doctorID, segmentKeys, fileName and contentType are required'})
+
+        prefix = f"doctors/{doctor_id}/"
+        if any(not key.startswith(prefix) for key in segment_keys):
+            return _response(403, {'error': 'Segments must belong to the doctor'})
+
+        timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+        final_key = f"doctors/{doctor_id}/recordings/{timestamp}_{file_name}"
+
+        bytes_copied, bytes_streamed = concatenate_segments(segment_keys, final_key, content_type)
+        print(f"Concatenated {len(segment_keys)} segments into {final_key}: "
+              f"{bytes_copied} bytes copied in S3, {bytes_streamed} bytes streamed")
+
+        recording_url = f"https://{RECORDINGS_DOMAIN}/{final_key}"
+        pipeline = start_pipeline(body, recording_url, len(segment_keys))
+
+        return _response(200, {
+            'fileKey': final_key,
+            'recordingURL': recording_url,
+            'history': pipeline.get('history'),
+            'bytesCopied': bytes_copied,
+            'bytesStreamed': bytes_streamed
+        })
+
+    except UnsupportedContainer as e:
+        print(f"Rejected: {e}")
+        return _response(400, {
+            'error': 'Segments must be MP3, AAC (ADTS) or Ogg to be concatenated',
+            'details': str(e)
+        })
+
+    except ClientError as e:
+        print(f"AWS Error: {e}")
+        return _response(500, {'error': 'Failed to concatenate recording segments'})
+
+    except Exception as e:
+        print(f"Error: {e}")
+        import traceback
+        traceback.print_exc()
+        return _response(500, {'error': 'Internal server error', 'details': str(e)})
@@ -0,0 +1,113 @@
+import os
+
+import boto3
+import pytest
+
+MiB = 1024 * 1024
+
+
+@pytest.fixture(scope='module')
+def concatenate(load_lambda):
+    return load_lambda('concatenate_recording')
+
+
+def assert_valid_layout(concatenate, segments, parts):
+    """Parts replay every byte of the segments in order; only the last one is under the S3 minimum"""
+    ranges = []
+    for index, (kind, part) in enumerate(parts):
+        part_ranges = [part] if kind == 'copy' else part
+        if index < len(parts) - 1:
+            assert sum(end - start for _, start, end in part_ranges) >= concatenate.MIN_PART_SIZE
+        ranges.extend(part_ranges)
+
+    replayed = []
+    for key, start, end in ranges:
+        if replayed and replayed[-1][0] == key and replayed[-1][2] == start:
+            replayed[-1] = (key, replayed[-1][1], end)
+        else:
+            replayed.append((key, start, end))
+    assert replayed == [(key, 0, size) for key, size in segments]
+
+
+def test_plan_parts_copies_large_segments_in_s3(concatenate):
+    segments = [('a', 12 * MiB), ('b', 8 * MiB)]
+
+    parts = concatenate.plan_parts(segments)
+
+    assert parts == [('copy', ('a', 0, 12 * MiB)), ('copy', ('b', 0, 8 * MiB))]
+
+
+def test_plan_parts_merges_segments_under_the_minimum_part_size(concatenate):
+    segments = [('a', 2 * MiB), ('b', 2 * MiB), ('c', 3 * MiB)]
+
+    parts = concatenate.plan_parts(segments)
+
+    assert parts == [
+        ('upload', [('a', 0, 2 * MiB), ('b', 0, 2 * MiB), ('c', 0, 1 * MiB)]),
+        ('upload', [('c', 1 * MiB, 3 * MiB)]),
+    ]
+    assert_valid_layout(concatenate, segments, parts)
+
+
+def test_plan_parts_tops_up_a_small_part_from_the_next_segment(concatenate):
+    segments = [('a', 1 * MiB), ('b', 12 * MiB)]
+
+    parts = concatenate.plan_parts(segments)
+
+    assert parts == [
+        ('upload', [('a', 0, 1 * MiB), ('b', 0, 4 * MiB)]),
+        ('copy', ('b', 4 * MiB, 12 * MiB)),
+    ]
+
+
+def test_plan_parts_leaves_a_small_last_segment_as_the_last_part(concatenate):
+    segments = [('a', 12 * MiB), ('b', 1 * MiB)]
+
+    parts = concatenate.plan_parts(segments)
+
+    assert parts == [('copy', ('a', 0, 12 * MiB)), ('upload', [('b', 0, 1 * MiB)])]
+    assert_valid_layout(concatenate, segments, parts)
+
+
+def test_plan_parts_layouts_are_valid_for_mixed_sizes(concatenate):
+    segments = [('a', 6 * MiB), ('b', 100), ('c', 5 * MiB - 50), ('d', 11 * MiB), ('e', 3)]
+
+    assert_valid_layout(concatenate, segments, concatenate.plan_parts(segments))
+
+
+def test_concatenate_segments_builds_the_recording_in_s3(concatenate):
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=concatenate.BUCKET_NAME)
+    segments = {
+        'doctors/d1/segments/0.mp3': os.urandom(6 * MiB),
+        'doctors/d1/segments/1.mp3': os.urandom(2 * MiB),
+        'doctors/d1/segments/2.mp3': os.urandom(7 * MiB),
+        'doctors/d1/segments/3.mp3': os.urandom(300 * 1024),
+    }
+    for key, data in segments.items():
+        s3.put_object(Bucket=concatenate.BUCKET_NAME, Key=key, Body=data, ContentType='audio/mpeg')
+
+    copied, streamed = concatenate.concatenate_segments(
+        list(segments), 'doctors/d1/recordings/consulta.mp3', 'audio/mpeg'
+    )
+
+    recording = s3.get_object(Bucket=concatenate.BUCKET_NAME, Key='doctors/d1/recordings/consulta.mp3')
+    assert recording['Body'].read() == b''.join(segments.values())
+    assert recording['ContentType'] == 'audio/mpeg'
+    assert recording['Metadata'] == {'pipeline': 'skip'}
+    assert copied + streamed == sum(len(data) for data in segments.values())
+    assert streamed < 2 * concatenate.MIN_PART_SIZE
+
+
+def test_concatenate_segments_rejects_mismatched_containers(concatenate):
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=concatenate.BUCKET_NAME)
+    s3.put_object(Bucket=concatenate.BUCKET_NAME, Key='doctors/d1/segments/0.mp3', Body=b'a', ContentType='audio/mpeg')
+    s3.put_object(Bucket=concatenate.BUCKET_NAME, Key='doctors/d1/segments/1.webm', Body=b'b', ContentType='audio/webm')
+
+    with pytest.raises(concatenate.UnsupportedContainer):
+        concatenate.concatenate_segments(
+            ['doctors/d1/segments/0.mp3', 'doctors/d1/segments/1.webm'], 'doctors/d1/recordings/x.mp3', 'audio/mpeg'
+        )
+    with pytest.raises(concatenate.UnsupportedContainer):
+        concatenate.concatenate_segments(['doctors/d1/segments/1.webm'], 'doctors/d1/recordings/x.webm', 'audio/webm')
@@ -0,0 +1,53 @@
+import os
+import sys
+import importlib.util
+
+import pytest
+from moto import mock_aws
+
+# In-process backends for the limiter and the breaker, and a region and dummy
+# credentials for the clients the modules create at import
+os.environ.setdefault('RATE_LIMIT_BACKEND', 'memory')
+os.environ.setdefault('CIRCUIT_BACKEND', 'memory')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+
+LAMBDAS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.join(LAMBDAS_DIR, 'shared'))
+
+
+@pytest.fixture(autouse=True)
+def aws():
+    """
+    Nothing in the tests talks to AWS: every call goes to moto, including those
+    of clients the Lambdas create at import, and each test starts from an
+    empty account.
+    """
+    with mock_aws():
+        yield
+
+
+@pytest.fixture(scope='session')
+def load_lambda():
+    """
+    Import lambdas/<name>/lambda_function.py as the module <name>. Every Lambda
+    names its handler file the same, so they can't be imported by plain name
+    side by side.
+    """
+    def load(name):
+        if name in sys.modules:
+            return sys.modules[name]
+        directory = os.path.join(LAMBDAS_DIR, name)
+        sys.path.insert(0, directory)
+        try:
+            spec = importlib.util.spec_from_file_location(name, os.path.join(directory, 'lambda_function.py'))
+            module = importlib.util.module_from_spec(spec)
+            sys.modules[name] = module
+            spec.loader.exec_module(module)
+        finally:
+            sys.path.remove(directory)
+        return module
+
+    return load
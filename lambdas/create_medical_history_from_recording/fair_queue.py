@@ -0,0 +1,57 @@
+import heapq
+import itertools
+
+# Weighted fair queueing of pipeline jobs across doctors (start-time fair queueing).
+#
+# Every job is tagged when it is queued:
+#   start  = max(virtual time, finish tag of the doctor's previous job)
+#   finish = start + cost / weight
+# and jobs are admitted in finish-tag order; admitting a job moves the virtual
+# time to its start tag. A doctor with a backlog of 200 recordings gets finish
+# tags stretching far ahead of the virtual time, while a doctor who just
+# recorded a consultation is tagged from the current virtual time and goes
+# ahead of that backlog. The cost of a job is its audio duration, so shares are
+# shares of processing time, not of job counts.
+#
+# These functions hold no state: scheduler.py keeps the tags in DynamoDB, and
+# FairQueue below keeps them in memory for the scheduling simulation.
+
+# Seconds of audio assumed when a recording arrives without its duration
+DEFAULT_JOB_COST = 300
+# Very short recordings still cost a transcription and a note
+MIN_JOB_COST = 60
+
+
+def job_cost(duration_seconds=None):
+    if not duration_seconds:
+        return DEFAULT_JOB_COST
+    return max(MIN_JOB_COST, float(duration_seconds))
+
+
+def tag_job(virtual_time, last_finish, cost, weight=1):
+    """(start, finish) tags of a job queued now by a doctor whose previous job finishes at last_finish"""
+    start = max(virtual_time, last_finish or 0)
+    return start, start + cost / max(weight, 0.01)
+
+
+class FairQueue:
+    """In-memory weighted fair queue with the same tagging as the pipeline scheduler"""
+
+    def __init__(self):
+        self.virtual_time = 0
+        self.last_finish = {}
+        self._heap = []
+        self._order = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, tenant, job, cost, weight=1):
+        start, finish = tag_job(self.virtual_time, self.last_finish.get(tenant), cost, weight)
+        self.last_finish[tenant] = finish
+        heapq.heappush(self._heap, (finish, next(self._order), start, job))
+
+    def pop(self):
+        finish, _, start, job = heapq.heappop(self._heap)
+        self.virtual_time = max(self.virtual_time, start)
+        return job
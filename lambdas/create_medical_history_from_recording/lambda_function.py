@@ -1,17 +1,80 @@
 import os
 import json
+import time
 import boto3
 import uuid
-from datetime import datetime
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from decimal import Decimal
+from urllib.parse import unquote_plus
 
+from boto3.dynamodb.conditions import Attr, Key
 from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+
+import scheduler
+import workers
+from retries import record_failure
+from style_profile import example_hash
 
 lambda_client = boto3.client('lambda')
+s3_client = boto3.client('s3')
 dynamodb = boto3.resource('dynamodb')
 histories_table = dynamodb.Table('medical-histories')
 doctors_table = dynamodb.Table('doctors')
 
+TRANSCRIBE_LAMBDA = os.getenv('TRANSCRIBE_LAMBDA', 'transcribe')
+CREATE_MEDICAL_RECORD_LAMBDA = os.getenv('CREATE_MEDICAL_RECORD_LAMBDA', 'create_medical_record')
+RECORDINGS_DOMAIN = os.getenv('RECORDINGS_DOMAIN', 'storage.clinicalops.co')
+
+# Histories that failed for good (a permanent error, or a transient one after
+# its automatic retries, see retries.py) are filed here by historyID until they
+# are redriven (action "redrive") or retried by hand.
+dead_letters_table = dynamodb.Table(os.getenv('DEAD_LETTERS_TABLE', 'pipeline-dead-letters'))
+REDRIVE_LIMIT = int(os.getenv('REDRIVE_LIMIT', '100'))
+
+# "distributed" hands transcription and note generation to the transcribe and
+# create_medical_record Lambdas; "monolith" runs the same worker handlers in
+# this process (see workers.py), with no invoke hop, payload encoding or worker
+# cold start. Steps, checkpoints and leases are the same in both modes. Every
+# completed history records where its time went (see pipeline_timings).
+PIPELINE_MODE = os.getenv('PIPELINE_MODE', 'distributed')
+WORKER_MODULES = {TRANSCRIBE_LAMBDA: 'transcribe', CREATE_MEDICAL_RECORD_LAMBDA: 'create_medical_record'}
+
+# Pipeline progress is pushed to WebSocket subscribers of the history or its doctor
+WS_API_ENDPOINT = os.getenv('WS_API_ENDPOINT', '')
+connections_table = dynamodb.Table(os.getenv('DYNAMODB_CONNECTIONS_TABLE', 'websocket_connections'))
+
+# Pipeline stages, a summary of how far a history got. Each worker writes its
+# result to the history item together with a checkpoint, and the DynamoDB stream
+# on medical-histories brings the change back to handle_stream_event, which
+# dispatches every step that just became ready. No invocation ever waits on
+# another Lambda.
+STAGE_RECORDING = 'recording'
+STAGE_QUEUED = 'queued'
+STAGE_TRANSCRIBED = 'transcribed'
+STAGE_GENERATED = 'generated'
+STAGE_COMPLETED = 'completed'
+STAGE_FAILED = 'failed'
+
+# Pipeline steps as a dependency graph: a step runs as soon as the checkpoints
+# it depends on are saved under the history's "checkpoints" map, so the doctor
+# profile and the patient are settled while the audio is still being
+# transcribed. The graph itself is declared under STEPS below.
+# Histories recorded as a live session (startSession/addSegment/finishSession)
+# sit in STAGE_RECORDING while their segments are transcribed one by one; their
+# transcription step is driven by the session, not dispatched from here.
+# Transcription, the first paid step, waits for the "admission" checkpoint,
+# written by scheduler.py when the history's turn in the fair queue comes.
+# Live sessions are admitted as they open: a doctor is waiting on them.
+
+# Client-facing statuses of histories still moving through the pipeline. They are
+# mirrored to "inFlightStatus", which is removed once a history completes or
+# fails: the sparse GSI inFlightStatus-updatedAt-index then holds only in-flight
+# histories, which is all stuck_history_sweeper has to query.
+IN_FLIGHT_STATUSES = ('pending', 'processing')
+
 _type_deserializer = TypeDeserializer()
 _dynamodb_type_keys = {'S', 'N', 'M', 'L', 'BOOL', 'NULL', 'SS', 'NS', 'BS'}
 
@@ -35,168 +98,929 @@ class DecimalEncoder(json.JSONEncoder):
         return super(DecimalEncoder, self).default(obj)
 
 
-def process_recording_sync(history_id, doctor_id, recording_url, patient_id=None):
+def _invoke_async(function_name, body):
+    """Fire-and-forget invocation of a pipeline worker"""
+    lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType='Event',
+        Payload=json.dumps({'body': json.dumps(body, cls=DecimalEncoder)})
+    )
+
+
+def _native(value):
+    """Decimals from DynamoDB as the int/float a worker would get from JSON"""
+    if isinstance(value, Decimal):
+        return int(value) if value % 1 == 0 else float(value)
+    if isinstance(value, dict):
+        return {k: _native(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_native(item) for item in value]
+    return value
+
+
+def _run_worker(function_name, body):
     """
-    Process the recording synchronously - this is the heavy lifting
-    Called asynchronously by lambda_handler
+    Hand a pipeline step to its worker. The worker saves its own checkpoint (or
+    failure) on the history either way; dispatchedAt lets it report how long the
+    hand-over took.
     """
+    body = {**body, 'dispatchedAt': int(time.time() * 1000)}
+    if PIPELINE_MODE != 'monolith':
+        _invoke_async(function_name, body)
+        return
+
+    worker = workers.load_worker(WORKER_MODULES[function_name])
+    # No Lambda context: the worker's deadline hand-offs would re-invoke this function
+    result = worker.lambda_handler({'body': _native(body)}, None)
+    print(f"In-process {function_name} for history {body.get('historyID')} returned {result.get('statusCode')}")
+
+
+def _set_stage(history_id, stage=None, status=None, checkpoint=None, extra_values=None):
+    """
+    Persist a checkpoint and/or stage transition; the stream brings it back to
+    handle_stream_event. A checkpoint is only written once, so a redelivered
+    stream record can't redo a step. Returns False when the checkpoint already existed.
+    """
+    timestamp = datetime.utcnow().isoformat() + 'Z'
+    update_expression = 'SET updatedAt = :updated'
+    expression_names = {}
+    expression_values = {':updated': timestamp}
+
+    if stage:
+        update_expression += ', pipelineStage = :stage'
+        expression_values[':stage'] = stage
+
+    if status:
+        update_expression += ', #status = :status'
+        expression_names['#status'] = 'status'
+        expression_values[':status'] = status
+        if status in IN_FLIGHT_STATUSES:
+            update_expression += ', inFlightStatus = :status'
+
+    if checkpoint:
+        update_expression += ', checkpoints.#checkpoint = :updated'
+        expression_names['#checkpoint'] = checkpoint
+
+    for attribute, value in (extra_values or {}).items():
+        update_expression += f', {attribute} = :{attribute}'
+        expression_values[f':{attribute}'] = value
+
+    if status and status not in IN_FLIGHT_STATUSES:
+        update_expression += ' REMOVE inFlightStatus'
+
+    update_kwargs = {
+        'Key': {'historyID': history_id},
+        'UpdateExpression': update_expression,
+        'ExpressionAttributeValues': expression_values
+    }
+    if checkpoint:
+        update_kwargs['ConditionExpression'] = 'attribute_not_exists(checkpoints.#checkpoint)'
+    if expression_names:
+        update_kwargs['ExpressionAttributeNames'] = expression_names
+
     try:
-        print(f"Processing history {history_id} for doctor {doctor_id}")
+        histories_table.update_item(**update_kwargs)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        print(f"Checkpoint '{checkpoint}' of history {history_id} already saved, dropping duplicate")
+        return False
+    return True
 
-        # Update status to processing
-        histories_table.update_item(
-            Key={'historyID': history_id},
-            UpdateExpression='SET #status = :status',
-            ExpressionAttributeNames={'#status': 'status'},
-            ExpressionAttributeValues={':status': 'processing'}
-        )
 
-        # Step 1: Transcribe audio
-        print("Step 1: Transcribing audio...")
-        transcribe_payload = {'body': json.dumps({'audio_url': recording_url})}
-        transcribe_response = lambda_client.invoke(
-            FunctionName='transcribe',
-            InvocationType='RequestResponse',
-            Payload=json.dumps(transcribe_payload)
-        )
+def _mark_failed(history_id, error):
+    """Fail the history, or schedule its retry when the error is transient"""
+    try:
+        record_failure(histories_table, history_id, error, str(error))
+    except Exception as update_error:
+        print(f"Failed to update error status: {update_error}")
 
-        transcribe_result = json.loads(transcribe_response['Payload'].read())
-        if transcribe_result.get('statusCode') != 200:
-            raise Exception(f"Transcription failed: {transcribe_result}")
 
-        transcribe_body = json.loads(transcribe_result['body'])
-        transcription = transcribe_body.get('transcription')
-        print(f"Transcription completed: {len(transcription)} characters")
+def queue_for_admission(history):
+    """Queue the history in its doctor's share and admit whatever fits now"""
+    start = scheduler.enqueue(history)
+    if start is None:
+        scheduler.dispatch()
+    else:
+        scheduler.dispatch((history['historyID'], scheduler.priority_of(history), start))
 
-        # Step 2: Get doctor's example history
-        print("Step 2: Getting doctor's example history...")
-        doctor_response = doctors_table.get_item(Key={'doctorID': doctor_id})
 
-        if 'Item' not in doctor_response:
-            raise Exception('Doctor not found')
+def start_transcription(history):
+    """Hand the audio to the transcribe worker"""
+    history_id = history['historyID']
+    print(f"Dispatching transcription for history {history_id}")
 
-        doctor_data = doctor_response['Item']
-        medical_record_example = doctor_data.get('medical_record_example', {})
-        medical_record_structure = doctor_data.get('medical_record_structure', {})
+    histories_table.update_item(
+        Key={'historyID': history_id},
+        UpdateExpression='SET #status = :status, inFlightStatus = :status',
+        ExpressionAttributeNames={'#status': 'status'},
+        ExpressionAttributeValues={':status': 'processing'}
+    )
 
-        # Step 3: Create medical record
-        print("Step 3: Generating medical record with AI...")
-        create_record_payload = {
-            'body': json.dumps({
-                'transcription': transcription,
-                'medical_record_example': medical_record_example,
-                'medical_record_format': medical_record_structure
-            })
+    if history.get('segmentCount'):
+        # Live session: re-assemble from the segments, transcribing any that are missing
+        transcribe_body = {'historyID': history_id, 'assemble': True}
+    elif history.get('transcriptionJobs'):
+        # Resumed after its AssemblyAI jobs were submitted: wait for them and
+        # collect them again instead of paying for new ones. Jobs the provider
+        # failed are discarded by transcribe, so those resumes submit anew.
+        transcribe_body = {'historyID': history_id, 'poll': True}
+    else:
+        transcribe_body = {
+            'historyID': history_id,
+            'audio_url': history['recordingURL']
         }
+        if history.get('durationSeconds'):
+            # Lets transcribe switch to chunked mode for long consultations
+            transcribe_body['audio_duration_ms'] = int(history['durationSeconds'] * 1000)
+
+    _run_worker(TRANSCRIBE_LAMBDA, transcribe_body)
+
+
+def load_doctor_profile(history):
+    """Snapshot the doctor's example and format onto the history"""
+    history_id = history['historyID']
+    print(f"Getting doctor's example history for {history['doctorID']}")
+
+    doctor_response = doctors_table.get_item(Key={'doctorID': history['doctorID']})
+    if 'Item' not in doctor_response:
+        raise Exception('Doctor not found')
+
+    doctor_data = doctor_response['Item']
+    doctor_profile = {
+        'medical_record_example': doctor_data.get('medical_record_example', {}),
+        'medical_record_format': doctor_data.get('medical_record_structure', {}),
+        'createdBy': doctor_data.get('name', '') + ' ' + doctor_data.get('lastName', '')
+    }
+    # The condensed style replaces the example only while it was computed from
+    # the current one (auth_register_step2 / backfill_style_profiles)
+    example = doctor_data.get('medical_record_example')
+    style_profile = doctor_data.get('medical_record_style_profile')
+    if style_profile and isinstance(example, str) and (
+            doctor_data.get('style_profile_example_hash') == example_hash(example)):
+        doctor_profile['medical_record_style_profile'] = style_profile
+
+    _set_stage(history_id, checkpoint='doctorProfile', extra_values={
+        'doctorProfile': doctor_profile
+    })
+
+
+def assign_patient(history):
+    """Keep the patient the recording was made for, or open a new one"""
+    patient_id = history.get('patientID')
+    if not patient_id:
+        print("Creating new patient ID...")
+        patient_id = str(uuid.uuid4())
+    else:
+        print(f"Using existing patient: {patient_id}")
+
+    _set_stage(history['historyID'], checkpoint='patient', extra_values={
+        'patientID': patient_id
+    })
+
+
+def start_medical_record(history):
+    """Hand the transcription and doctor profile to create_medical_record"""
+    history_id = history['historyID']
+    doctor_profile = history['doctorProfile']
+
+    print(f"Dispatching medical record generation for history {history_id}")
+    body = {
+        'historyID': history_id,
+        'medical_record_example': doctor_profile.get('medical_record_example', {}),
+        'medical_record_format': doctor_profile.get('medical_record_format', {})
+    }
+    if doctor_profile.get('medical_record_style_profile'):
+        body['medical_record_style_profile'] = doctor_profile['medical_record_style_profile']
+    # Only the S3 reference travels; histories from before it carry the text inline
+    if history.get('transcriptionRef'):
+        body['transcriptionRef'] = history['transcriptionRef']
+    else:
+        body['transcription'] = history['transcription']
+    _run_worker(CREATE_MEDICAL_RECORD_LAMBDA, body)
+
+
+def _epoch_ms(timestamp):
+    return int(datetime.fromisoformat(timestamp.rstrip('Z')).replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def pipeline_timings(history, finished_ms):
+    """
+    Where the end-to-end time of a history went. Workers report, per stage, the
+    time from dispatch to their start (invoke hop plus cold start) and the
+    time spent on the provider; what remains is queueing, stream hops and
+    bookkeeping. The note generation also reports its prompt cache use.
+    """
+    timings = {
+        'mode': PIPELINE_MODE,
+        'totalMs': finished_ms - _epoch_ms(history['createdAt'])
+    }
+    if history.get('queuedAt') and (history.get('checkpoints') or {}).get('admission'):
+        timings['queueMs'] = _epoch_ms(history['checkpoints']['admission']) - _epoch_ms(history['queuedAt'])
+
+    accounted = timings.get('queueMs', 0)
+    for stage in ('transcription', 'medicalRecord'):
+        timing = history.get(f"{stage}Timing") or {}
+        for key in ('dispatchMs', 'providerMs', 'coldStart', 'inputTokens', 'cachedTokens'):
+            if key in timing:
+                timings[f"{stage}{key[0].upper()}{key[1:]}"] = timing[key]
+        accounted += int(timing.get('dispatchMs', 0)) + int(timing.get('providerMs', 0))
+    timings['otherMs'] = timings['totalMs'] - accounted
+    return timings
+
+
+def finalize_history(history):
+    """Add the metadata and mark the history completed"""
+    history_id = history['historyID']
+    timings = pipeline_timings(history, int(time.time() * 1000))
+
+    # Initialize metadata - diagnosis and summary will be generated by frontend with Bedrock
+    metadata = {
+        'diagnosis': '',
+        'summary': '',
+        'createdBy': history.get('doctorProfile', {}).get('createdBy', '')
+    }
+
+    print("Updating medical history...")
+    _set_stage(history_id, STAGE_COMPLETED, status='completed', checkpoint='metadata', extra_values={
+        'metaData': metadata,
+        'pipelineTimings': timings
+    })
+    print(f"Medical history {history_id} completed successfully")
+    print(f"Pipeline timings for history {history_id}: {json.dumps(timings, cls=DecimalEncoder)}")
+
+
+# checkpoint -> (checkpoints it depends on, step that produces it). Workers
+# (transcription, medicalRecord) save their own checkpoint; the other steps are
+# short bookkeeping run here and save theirs through _set_stage.
+STEPS = {
+    'admission': ((), queue_for_admission),
+    'transcription': (('admission',), start_transcription),
+    'doctorProfile': ((), load_doctor_profile),
+    'patient': ((), assign_patient),
+    'medicalRecord': (('transcription', 'doctorProfile'), start_medical_record),
+    'metadata': (('medicalRecord', 'patient'), finalize_history),
+}
+
+
+def ready_steps(history):
+    """Steps whose dependencies are all checkpointed and that are not done yet"""
+    stage = history.get('pipelineStage')
+    if not stage or stage in (STAGE_COMPLETED, STAGE_FAILED):
+        return set()
+
+    checkpoints = history.get('checkpoints') or {}
+    ready = set()
+    for checkpoint, (depends_on, _) in STEPS.items():
+        if checkpoint in checkpoints or not all(dep in checkpoints for dep in depends_on):
+            continue
+        if checkpoint == 'transcription' and stage == STAGE_RECORDING:
+            continue
+        ready.add(checkpoint)
+    return ready
+
+
+def _run_step(checkpoint, history):
+    started = time.time()
+    STEPS[checkpoint][1](history)
+    print(f"Step '{checkpoint}' of history {history['historyID']} done in {(time.time() - started) * 1000:.0f} ms")
+
+
+def advance_pipeline(history, steps):
+    """Run the given ready steps concurrently; their I/O doesn't depend on each other"""
+    history_id = history['historyID']
+
+    with ThreadPoolExecutor(max_workers=len(steps)) as executor:
+        futures = {executor.submit(_run_step, checkpoint, history): checkpoint for checkpoint in steps}
+
+    for future, checkpoint in futures.items():
+        error = future.exception()
+        if error:
+            print(f"Error in step '{checkpoint}' of history {history_id}: {error}")
+            traceback.print_exception(type(error), error, error.__traceback__)
+            _mark_failed(history_id, error)
+            return
+
+
+def resume_stage_for(checkpoints):
+    """Stage a history restarts in: the furthest milestone its checkpoints reached"""
+    if 'transcription' not in checkpoints:
+        return STAGE_QUEUED
+    if 'medicalRecord' not in checkpoints:
+        return STAGE_TRANSCRIBED
+    if 'metadata' not in checkpoints:
+        return STAGE_GENERATED
+    return STAGE_COMPLETED
+
+
+def resume_history(history_id, expected_updated_at=None, reset_retries=False, priority=None):
+    """
+    Restart a failed or stuck history: every missing step whose dependencies are
+    checkpointed runs again. Bumping pipelineAttempt makes the stream re-dispatch
+    even if the stage is unchanged.
+    With expected_updated_at the restart only happens if the history made no
+    progress since then. reset_retries gives it a fresh set of automatic
+    retries, and priority moves it to another scheduler class. The history
+    leaves the dead-letter store. A transcription whose jobs were already
+    submitted is collected again rather than resubmitted (start_transcription).
+    Returns the stage the pipeline resumes from,
+    or None if the history does not exist (or moved on).
+    """
+    response = histories_table.get_item(Key={'historyID': history_id})
+    if 'Item' not in response:
+        return None
+
+    history = response['Item']
+    resume_stage = resume_stage_for(history.get('checkpoints') or {})
+
+    if resume_stage == STAGE_COMPLETED:
+        dead_letters_table.delete_item(Key={'historyID': history_id})
+        return resume_stage
+
+    condition = {}
+    if expected_updated_at:
+        condition = {'ConditionExpression': 'updatedAt = :seen'}
+
+    set_expression = (
+        'SET pipelineStage = :stage, #status = :status, inFlightStatus = :status, updatedAt = :updated, '
+        'pipelineAttempt = if_not_exists(pipelineAttempt, :zero) + :one'
+    )
+    remove_expression = ' REMOVE errorMessage, errorClass, transcriptionCollectRequestedAt, retryState, retryAt'
+    expression_values = {
+        ':stage': resume_stage,
+        ':status': 'processing',
+        ':updated': datetime.utcnow().isoformat() + 'Z',
+        ':zero': 0,
+        ':one': 1,
+        **({':seen': expected_updated_at} if expected_updated_at else {})
+    }
+    if 'checkpoints' not in history:
+        set_expression += ', checkpoints = :empty'
+        expression_values[':empty'] = {}
+    elif resume_stage == STAGE_QUEUED and not history.get('scheduleLane'):
+        # Released when it failed: it queues again for its transcription
+        remove_expression += ', checkpoints.admission'
+    if reset_retries:
+        remove_expression += ', retryCount'
+    if priority:
+        set_expression += ', priority = :priority'
+        expression_values[':priority'] = priority
+
+    histories_table.update_item(
+        Key={'historyID': history_id},
+        UpdateExpression=set_expression + remove_expression,
+        ExpressionAttributeNames={'#status': 'status'},
+        ExpressionAttributeValues=expression_values,
+        **condition
+    )
+    dead_letters_table.delete_item(Key={'historyID': history_id})
+    print(f"History {history_id} resumed from stage '{resume_stage}'")
+    return resume_stage
+
+
+def file_dead_letter(history):
+    """Keep a history that failed for good, with what is needed to triage and redrive it"""
+    checkpoints = history.get('checkpoints') or {}
+    dead_letters_table.put_item(Item={
+        'historyID': history['historyID'],
+        'doctorID': history.get('doctorID'),
+        'errorMessage': history.get('errorMessage', ''),
+        'errorClass': history.get('errorClass', 'unknown'),
+        'resumeStage': resume_stage_for(checkpoints),
+        'retryCount': history.get('retryCount', 0),
+        'pipelineAttempt': history.get('pipelineAttempt', 0),
+        'failedAt': history.get('updatedAt') or datetime.utcnow().isoformat() + 'Z'
+    })
+    print(f"History {history['historyID']} dead-lettered ({history.get('errorClass', 'unknown')}): "
+          f"{history.get('errorMessage')}")
+
+
+def _subscribers(history_id, doctor_id):
+    """Connection IDs following this history or doctor, from the connections table GSIs"""
+    connection_ids = set()
+    for index_name, attribute, value in (
+        ('historyID-index', 'historyID', history_id),
+        ('doctorID-index', 'doctorID', doctor_id),
+    ):
+        if not value:
+            continue
+        query_kwargs = {
+            'IndexName': index_name,
+            'KeyConditionExpression': Key(attribute).eq(value),
+            'ProjectionExpression': 'connectionId'
+        }
+        while True:
+            response = connections_table.query(**query_kwargs)
+            connection_ids.update(item['connectionId'] for item in response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                break
+            query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return connection_ids
+
+
+def _progress_changed(new_image, old_image):
+    if not old_image:
+        return True
+    return (
+        new_image.get('status') != old_image.get('status')
+        or new_image.get('pipelineStage') != old_image.get('pipelineStage')
+        or set(new_image.get('checkpoints') or {}) != set(old_image.get('checkpoints') or {})
+    )
+
+
+def notify_subscribers(history):
+    """
+    Push a pipeline progress event to the WebSocket connections subscribed to the
+    history or its doctor. Best effort: a lost event never affects the pipeline,
+    and clients refetch when they (re)connect.
+    """
+    if not WS_API_ENDPOINT:
+        return
+
+    try:
+        connection_ids = _subscribers(history.get('historyID'), history.get('doctorID'))
+        if not connection_ids:
+            return
+
+        message = json.dumps({
+            'action': 'pipeline',
+            'historyID': history.get('historyID'),
+            'doctorID': history.get('doctorID'),
+            'status': history.get('status'),
+            'pipelineStage': history.get('pipelineStage'),
+            'checkpoints': sorted(history.get('checkpoints') or {}),
+            'errorMessage': history.get('errorMessage'),
+            'updatedAt': history.get('updatedAt')
+        }).encode('utf-8')
+
+        apigateway = boto3.client('apigatewaymanagementapi', endpoint_url=WS_API_ENDPOINT)
+
+        def post(connection_id):
+            try:
+                apigateway.post_to_connection(ConnectionId=connection_id, Data=message)
+            except apigateway.exceptions.GoneException:
+                connections_table.delete_item(Key={'connectionId': connection_id})
+                print(f"Cleaned up stale connection: {connection_id}")
+
+        with ThreadPoolExecutor(max_workers=min(len(connection_ids), 10)) as executor:
+            list(executor.map(post, connection_ids))
+        print(f"Pushed '{history.get('pipelineStage')}' of history {history.get('historyID')} "
+              f"to {len(connection_ids)} connections")
+
+    except Exception as e:
+        print(f"Error pushing pipeline progress: {e}")
+        traceback.print_exc()
+
+
+def handle_stream_event(event):
+    """
+    Dispatch the pipeline steps that each change on medical-histories made ready:
+    all steps without dependencies on INSERT or a retry (pipelineAttempt bump),
+    afterwards the steps whose last dependency was just checkpointed. Other
+    modifications (edits, metadata updates) make nothing ready and are ignored.
+    Every change in status, stage or checkpoints is also pushed to WebSocket
+    subscribers (notify_subscribers). Histories that complete or fail leave the
+    scheduler, and their place goes to the next one in the queue.
+    """
+    for record in event.get('Records', []):
+        if record.get('eventName') not in ('INSERT', 'MODIFY'):
+            continue
+
+        images = record.get('dynamodb', {})
+        new_image = _normalize_dynamodb_json(images.get('NewImage', {}))
+        old_image = _normalize_dynamodb_json(images.get('OldImage', {}))
+
+        if _progress_changed(new_image, old_image):
+            notify_subscribers(new_image)
+
+        if new_image.get('scheduleLane') and new_image.get('status') in ('completed', 'failed'):
+            if scheduler.release(new_image['historyID']):
+                scheduler.dispatch()
+
+        if new_image.get('status') == 'failed' and old_image.get('status') != 'failed':
+            file_dead_letter(new_image)
+
+        steps = ready_steps(new_image)
+        if old_image and new_image.get('pipelineAttempt') == old_image.get('pipelineAttempt'):
+            steps -= ready_steps(old_image)
+        if not steps:
+            continue
+
+        print(f"History {new_image.get('historyID')} ready for {sorted(steps)}")
+        advance_pipeline(new_image, steps)
+
+    return {'statusCode': 200}
+
+
+def create_history(doctor_id, recording_url, patient_id=None, duration_seconds=None, history_id=None,
+                   priority=None):
+    """
+    Write the pending history whose INSERT on the stream starts the pipeline.
+    Idempotent on historyID: the upload event and a direct API call for the
+    same recording end up with a single history. Returns (history, created).
+    priority is the scheduler class, "interactive" unless the caller says "batch".
+    """
+    timestamp = datetime.utcnow().isoformat() + 'Z'
+
+    medical_history = {
+        'historyID': history_id or str(uuid.uuid4()),
+        'doctorID': doctor_id,
+        'recordingURL': recording_url,
+        'status': 'pending',
+        'inFlightStatus': 'pending',
+        'pipelineStage': STAGE_QUEUED,
+        'priority': priority if priority in scheduler.PRIORITIES else scheduler.PRIORITY_INTERACTIVE,
+        'checkpoints': {},
+        'createdAt': timestamp,
+        'updatedAt': timestamp
+    }
 
-        create_record_response = lambda_client.invoke(
-            FunctionName='create_medical_record',
-            InvocationType='RequestResponse',
-            Payload=json.dumps(create_record_payload)
+    if patient_id:
+        medical_history['patientID'] = patient_id
+    if duration_seconds:
+        medical_history['durationSeconds'] = Decimal(str(duration_seconds))
+
+    try:
+        histories_table.put_item(
+            Item=medical_history,
+            ConditionExpression='attribute_not_exists(historyID)'
         )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        existing = histories_table.get_item(Key={'historyID': medical_history['historyID']}).get('Item')
+        return existing, False
+
+    return medical_history, True
+
+
+def handle_s3_event(event):
+    """
+    Start the pipeline for recordings uploaded to doctors/{doctorID}/recordings/.
+    The history metadata travels as object metadata set by generate_presigned_url;
+    uploads without it still get a history, keyed on the object so redeliveries
+    of the event don't duplicate it.
+    """
+    for record in event.get('Records', []):
+        bucket = record['s3']['bucket']['name']
+        key = unquote_plus(record['s3']['object']['key'])
 
-        create_record_result = json.loads(create_record_response['Payload'].read())
-        if create_record_result.get('statusCode') != 200:
-            raise Exception(f"Medical record creation failed: {create_record_result}")
+        parts = key.split('/')
+        if len(parts) < 4 or parts[0] != 'doctors' or parts[2] != 'recordings':
+            continue
+        doctor_id = parts[1]
 
-        create_record_body = json.loads(create_record_result['body'])
-        medical_record_json = create_record_body.get('medical_record')
-        print("Medical record generated successfully")
+        metadata = s3_client.head_object(Bucket=bucket, Key=key).get('Metadata', {})
+        if metadata.get('pipeline') == 'skip':
+            print(f"Skipping {key}, its history is started elsewhere")
+            continue
 
-        # Step 4: Set patient ID if not provided
-        if not patient_id:
-            print("Step 4: Creating new patient ID...")
-            patient_id = str(uuid.uuid4())
+        history_id = metadata.get('history-id') or str(uuid.uuid5(uuid.NAMESPACE_URL, f"s3://{bucket}/{key}"))
+
+        try:
+            history, created = create_history(
+                doctor_id,
+                f"https://{RECORDINGS_DOMAIN}/{key}",
+                patient_id=metadata.get('patient-id'),
+                duration_seconds=metadata.get('duration-seconds'),
+                history_id=history_id,
+                priority=metadata.get('priority')
+            )
+            print(f"Upload {key} -> history {history_id} ({'created' if created else 'already exists'})")
+        except Exception as e:
+            # One bad object must not block the rest of the batch
+            print(f"Error starting pipeline for {key}: {e}")
+            traceback.print_exc()
+
+    return {'statusCode': 200}
+
+
+def _response(status_code, body):
+    return {
+        'statusCode': status_code,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps(body, cls=DecimalEncoder)
+    }
+
+
+def handle_retry(history_id):
+    if not history_id:
+        return _response(400, {'error': 'historyID is required'})
+
+    resume_stage = resume_history(history_id, reset_retries=True)
+    if resume_stage is None:
+        return _response(404, {'error': 'Medical history not found'})
+
+    if resume_stage == STAGE_COMPLETED:
+        return _response(409, {'error': 'Medical history already completed'})
+
+    return _response(200, {
+        'historyID': history_id,
+        'resumeStage': resume_stage,
+        'message': 'Processing resumed from last checkpoint.'
+    })
+
+
+def handle_requeue(body):
+    """
+    Bulk restart of stuck histories, sent by stuck_history_sweeper with the
+    updatedAt it saw for each one so histories that moved on are left alone.
+    """
+    histories = body.get('histories') or []
+    requeued = []
+    skipped = []
+
+    for entry in histories:
+        history_id = entry.get('historyID')
+        try:
+            resume_stage = resume_history(history_id, entry.get('updatedAt'))
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            resume_stage = None
+        if resume_stage in (None, STAGE_COMPLETED):
+            skipped.append(history_id)
         else:
-            print(f"Using existing patient: {patient_id}")
+            requeued.append(history_id)
 
-        # Step 5: Update medical history with results
-        print("Step 5: Updating medical history...")
-        timestamp = datetime.utcnow().isoformat() + 'Z'
+    print(f"Requeued {len(requeued)} stuck histories, skipped {len(skipped)}")
+    return _response(200, {'requeued': requeued, 'skipped': skipped})
 
-        # Initialize metadata - diagnosis and summary will be generated by frontend with Bedrock
-        metadata = {
-            'diagnosis': '',
-            'summary': '',
-            'createdBy': doctor_data.get('name', '') + ' ' + doctor_data.get('lastName', '')
-        }
 
+def _dead_letters(body, limit):
+    """Dead letters selected by a redrive: the given historyIDs, or all matching the filters"""
+    if body.get('historyIDs'):
+        letters = []
+        for history_id in body['historyIDs'][:limit]:
+            item = dead_letters_table.get_item(Key={'historyID': history_id}).get('Item')
+            if item:
+                letters.append(item)
+        return letters
+
+    filters = []
+    if body.get('errorClass'):
+        filters.append(Attr('errorClass').eq(body['errorClass']))
+    if body.get('failedSince'):
+        filters.append(Attr('failedAt').gte(body['failedSince']))
+
+    scan_kwargs = {}
+    if filters:
+        expression = filters[0]
+        for condition in filters[1:]:
+            expression = expression & condition
+        scan_kwargs['FilterExpression'] = expression
+
+    # The store only holds histories that failed for good, small enough to scan
+    letters = []
+    while len(letters) < limit:
+        response = dead_letters_table.scan(**scan_kwargs)
+        letters.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return sorted(letters, key=lambda item: item.get('failedAt', ''))[:limit]
+
+
+def handle_redrive(body):
+    """
+    Bulk restart of dead-lettered histories from their last checkpoint, at most
+    REDRIVE_LIMIT per call. They get a fresh set of automatic retries and go
+    through the batch lane of the scheduler, so a redrive after a provider
+    incident doesn't delay live consultations. With dryRun only lists what
+    would be redriven.
+    """
+    limit = min(int(body.get('limit') or REDRIVE_LIMIT), REDRIVE_LIMIT)
+    letters = _dead_letters(body, limit)
+
+    if body.get('dryRun'):
+        return _response(200, {'deadLetters': letters})
+
+    redriven = []
+    skipped = []
+    for letter in letters:
+        history_id = letter['historyID']
+        resume_stage = resume_history(history_id, reset_retries=True, priority=scheduler.PRIORITY_BATCH)
+        if resume_stage in (None, STAGE_COMPLETED):
+            dead_letters_table.delete_item(Key={'historyID': history_id})
+            skipped.append(history_id)
+        else:
+            redriven.append(history_id)
+
+    print(f"Redrove {len(redriven)} dead-lettered histories, skipped {len(skipped)}")
+    return _response(200, {'redriven': redriven, 'skipped': skipped})
+
+
+def handle_start_session(body):
+    """Open a live recording session; segments are transcribed as they arrive"""
+    doctor_id = body.get('doctorID')
+    patient_id = body.get('patientID')
+
+    if not doctor_id:
+        return _response(400, {'error': 'doctorID is required'})
+
+    history_id = str(uuid.uuid4())
+    timestamp = datetime.utcnow().isoformat() + 'Z'
+
+    medical_history = {
+        'historyID': history_id,
+        'doctorID': doctor_id,
+        'status': 'pending',
+        'inFlightStatus': 'pending',
+        'pipelineStage': STAGE_RECORDING,
+        'checkpoints': {'admission': timestamp},
+        'segments': {},
+        'segmentTranscripts': {},
+        'createdAt': timestamp,
+        'updatedAt': timestamp
+    }
+
+    if patient_id:
+        medical_history['patientID'] = patient_id
+
+    histories_table.put_item(Item=medical_history)
+    print(f"Recording session opened: {history_id}")
+
+    return _response(200, {
+        'history': medical_history,
+        'message': 'Recording session started.'
+    })
+
+
+def handle_add_segment(body):
+    """Register an uploaded segment and start transcribing it right away"""
+    history_id = body.get('historyID')
+    segment_index = body.get('segmentIndex')
+    recording_url = body.get('recordingURL')
+
+    if not history_id or segment_index is None or not recording_url:
+        return _response(400, {'error': 'historyID, segmentIndex and recordingURL are required'})
+
+    segment = {'recordingURL': recording_url}
+    if body.get('durationSeconds'):
+        segment['durationSeconds'] = Decimal(str(body['durationSeconds']))
+
+    try:
         histories_table.update_item(
             Key={'historyID': history_id},
-            UpdateExpression='SET patientID = :pid, jsonData = :jdata, metaData = :meta, #status = :status, updatedAt = :updated, transcription = :trans',
-            ExpressionAttributeNames={'#status': 'status'},
+            UpdateExpression='SET segments.#index = :segment, updatedAt = :updated',
+            # Late segments are accepted until the transcript has been assembled
+            ConditionExpression='attribute_exists(segments) AND attribute_not_exists(checkpoints.transcription)',
+            ExpressionAttributeNames={'#index': str(segment_index)},
             ExpressionAttributeValues={
-                ':pid': patient_id,
-                ':jdata': medical_record_json,
-                ':meta': metadata,
-                ':status': 'completed',
-                ':updated': timestamp,
-                ':trans': transcription
+                ':segment': segment,
+                ':updated': datetime.utcnow().isoformat() + 'Z'
             }
         )
-        print(f"Medical history {history_id} completed successfully")
+    except histories_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return _response(409, {'error': 'Recording session not found or already transcribed'})
 
-    except Exception as e:
-        print(f"Error processing history {history_id}: {e}")
-        import traceback
-        traceback.print_exc()
+    _run_worker(TRANSCRIBE_LAMBDA, {
+        'historyID': history_id,
+        'segmentIndex': int(segment_index),
+        'audio_url': recording_url
+    })
+    print(f"Segment {segment_index} of history {history_id} sent to transcription")
+
+    return _response(202, {
+        'historyID': history_id,
+        'segmentIndex': segment_index,
+        'message': 'Segment accepted.'
+    })
+
+
+def handle_finish_session(body):
+    """
+    Close a live recording session. If every segment is already transcribed the
+    transcript is assembled now; otherwise the last segment to finish does it.
+    """
+    history_id = body.get('historyID')
+    segment_count = body.get('segmentCount')
+
+    if not history_id or not segment_count:
+        return _response(400, {'error': 'historyID and segmentCount are required'})
+
+    update_expression = 'SET segmentCount = :count, #status = :status, inFlightStatus = :status, updatedAt = :updated'
+    expression_values = {
+        ':count': int(segment_count),
+        ':status': 'processing',
+        ':updated': datetime.utcnow().isoformat() + 'Z'
+    }
+    if body.get('recordingURL'):
+        update_expression += ', recordingURL = :url'
+        expression_values[':url'] = body['recordingURL']
+    if body.get('durationSeconds'):
+        update_expression += ', durationSeconds = :duration'
+        expression_values[':duration'] = Decimal(str(body['durationSeconds']))
+
+    try:
+        response = histories_table.update_item(
+            Key={'historyID': history_id},
+            UpdateExpression=update_expression,
+            ConditionExpression='pipelineStage = :recording',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={**expression_values, ':recording': STAGE_RECORDING},
+            ReturnValues='ALL_NEW'
+        )
+    except histories_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return _response(409, {'error': 'Recording session not found or already finished'})
+
+    history = response['Attributes']
+    transcribed = history.get('segmentTranscripts') or {}
+    if all(str(index) in transcribed for index in range(int(segment_count))):
+        _run_worker(TRANSCRIBE_LAMBDA, {'historyID': history_id, 'assemble': True})
+
+    return _response(200, {
+        'history': history,
+        'message': 'Recording session finished. Processing in background.'
+    })
 
-        # Update status to failed
-        try:
-            histories_table.update_item(
-                Key={'historyID': history_id},
-                UpdateExpression='SET #status = :status, errorMessage = :error, updatedAt = :updated',
-                ExpressionAttributeNames={'#status': 'status'},
-                ExpressionAttributeValues={
-                    ':status': 'failed',
-                    ':error': str(e),
-                    ':updated': datetime.utcnow().isoformat() + 'Z'
-                }
-            )
-        except Exception as update_error:
-            print(f"Failed to update error status: {update_error}")
+
+SESSION_ACTIONS = {
+    'startSession': handle_start_session,
+    'addSegment': handle_add_segment,
+    'finishSession': handle_finish_session,
+}
 
 
 def lambda_handler(event, context):
     """
     Create a medical history record immediately and process asynchronously
 
+    Also receives the DynamoDB stream of medical-histories, which dispatches
+    the recording pipeline's steps as they become ready (see handle_stream_event),
+    and the ObjectCreated events of doctors/{doctorID}/recordings/, which start
+    it without this call (see handle_s3_event).
+
     Expected input:
     {
         "doctorID": "string",
         "recordingURL": "https://storage.clinicalops.co/doctors/{doctorID}/recordings/{file}",
-        "patientID": "string" (optional)
+        "patientID": "string" (optional),
+        "durationSeconds": number (optional, enables chunked transcription of long audio),
+        "historyID": "string" (optional, the one issued with the upload URL),
+        "priority": "interactive" | "batch" (optional, backlogs and backfills are "batch")
     }
 
     Returns immediately with historyID and status "pending"
     The actual processing happens asynchronously
+
+    Retry a failed history from its last checkpoint:
+    {
+        "action": "retry",
+        "historyID": "string"
+    }
+
+    Bulk restart of stuck histories and histories due for an automatic retry (stuck_history_sweeper):
+    { "action": "requeue", "histories": [{ "historyID": "string", "updatedAt": "string" }, ...] }
+
+    Bulk redrive of the dead-letter store (notebooks/redrive_dead_letters.py):
+    { "action": "redrive", "historyIDs": ["string"] (optional), "errorClass": "transient" | "permanent" (optional),
+      "failedSince": "ISO timestamp" (optional), "limit": 100 (optional), "dryRun": true (optional) }
+
+    Admit queued histories into free pipeline places (stuck_history_sweeper):
+    { "action": "dispatch" }
+
+    Live recording sessions, transcribed segment by segment while recording:
+    { "action": "startSession", "doctorID": "string", "patientID": "string" (optional) }
+    { "action": "addSegment", "historyID": "string", "segmentIndex": 0, "recordingURL": "string" }
+    { "action": "finishSession", "historyID": "string", "segmentCount": 3,
+      "recordingURL": "string" (optional, merged file), "durationSeconds": number (optional) }
     """
     try:
+        # Uploads landing in S3, or stage transitions from the medical-histories stream
+        if event.get('Records'):
+            if event['Records'][0].get('eventSource') == 'aws:s3':
+                return handle_s3_event(event)
+            return handle_stream_event(event)
+
         # Parse input
         if isinstance(event.get('body'), str):
             body = json.loads(event['body'])
         else:
             body = event.get('body', {})
 
-        # Check if this is an async processing call (internal)
-        if body.get('_async_process'):
-            # This is the async worker invocation
-            history_id = body.get('historyID')
-            doctor_id = body.get('doctorID')
-            recording_url = body.get('recordingURL')
-            patient_id = body.get('patientID')
+        if body.get('action') == 'retry':
+            return handle_retry(body.get('historyID'))
 
-            process_recording_sync(history_id, doctor_id, recording_url, patient_id)
+        if body.get('action') == 'requeue':
+            return handle_requeue(body)
 
-            return {
-                'statusCode': 200,
-                'body': json.dumps({'message': 'Processing completed'})
-            }
+        if body.get('action') == 'redrive':
+            return handle_redrive(body)
+
+        if body.get('action') == 'dispatch':
+            return _response(200, {'admitted': scheduler.dispatch()})
+
+        if body.get('action') in SESSION_ACTIONS:
+            return SESSION_ACTIONS[body['action']](body)
 
-        # Normal API call - create record and process async
         doctor_id = body.get('doctorID')
         recording_url = body.get('recordingURL')
         patient_id = body.get('patientID')
+        duration_seconds = body.get('durationSeconds')
 
         # Validate required fields
         if not doctor_id or not recording_url:
@@ -211,42 +1035,19 @@ def lambda_handler(event, context):
 
         print(f"Creating medical history record for doctor {doctor_id}")
 
-        # Create history record immediately with status "pending"
-        history_id = str(uuid.uuid4())
-        timestamp = datetime.utcnow().isoformat() + 'Z'
-
-        medical_history = {
-            'historyID': history_id,
-            'doctorID': doctor_id,
-            'recordingURL': recording_url,
-            'status': 'pending',
-            'createdAt': timestamp,
-            'updatedAt': timestamp
-        }
-
-        if patient_id:
-            medical_history['patientID'] = patient_id
-
-        histories_table.put_item(Item=medical_history)
-        print(f"Medical history created: {history_id} with status 'pending'")
-
-        # Invoke self asynchronously to process the recording
-        async_payload = {
-            'body': json.dumps({
-                '_async_process': True,
-                'historyID': history_id,
-                'doctorID': doctor_id,
-                'recordingURL': recording_url,
-                'patientID': patient_id
-            })
-        }
-
-        lambda_client.invoke(
-            FunctionName=context.function_name,
-            InvocationType='Event',  # Asynchronous invocation
-            Payload=json.dumps(async_payload)
+        # The INSERT on the stream starts the pipeline
+        medical_history, created = create_history(
+            doctor_id,
+            recording_url,
+            patient_id=patient_id,
+            duration_seconds=duration_seconds,
+            history_id=body.get('historyID'),
+            priority=body.get('priority')
         )
-        print(f"Async processing initiated for history {history_id}")
+        if not created and (not medical_history or medical_history.get('doctorID') != doctor_id):
+            return _response(409, {'error': 'historyID already belongs to another recording'})
+        print(f"Medical history {medical_history['historyID']} "
+              f"{'created' if created else 'already started by the upload'}")
 
         # Return immediately
         return {
@@ -263,7 +1064,6 @@ def lambda_handler(event, context):
 
     except Exception as e:
         print(f"Error: {e}")
-        import traceback
         traceback.print_exc()
         return {
             'statusCode': 500,
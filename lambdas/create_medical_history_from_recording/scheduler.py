@@ -0,0 +1,237 @@
+import os
+from datetime import datetime
+from decimal import Decimal
+
+import boto3
+from boto3.dynamodb.conditions import Key
+
+from fair_queue import job_cost, tag_job
+
+# Admission control in front of the recording pipeline. A history waits in its
+# doctor's share of the queue until one of MAX_ACTIVE_PIPELINES places is free,
+# and places are handed out in weighted fair order (see fair_queue.py), so one
+# doctor bulk-uploading a backlog cannot starve everybody else.
+#
+# Queue state lives on the history items: "scheduleLane" is "waiting#{priority}"
+# or "running" and "virtualFinish" is the job's finish tag. The sparse GSI
+# scheduleLane-virtualFinish-index therefore holds exactly the queue (in
+# admission order) and the running set. The pipeline-scheduler table keeps the
+# virtual time and each doctor's last finish tag.
+#
+# The running count is read from the index, so two dispatches racing can
+# briefly admit a job or two above the limit; the order is what matters here.
+#
+# Histories carry a priority class. "interactive" (a doctor is waiting for the
+# note) may take any free place; "batch" (offline backlogs, backfills) only
+# takes places while more than RESERVED_INTERACTIVE_PIPELINES stay free, so
+# batch work soaks up idle capacity without ever delaying a live consultation.
+# Each class has its own waiting lane, virtual time and per-doctor tags: a
+# doctor's own backlog doesn't push back their live recordings either.
+
+MAX_ACTIVE_PIPELINES = int(os.getenv('MAX_ACTIVE_PIPELINES', '40'))
+RESERVED_INTERACTIVE_PIPELINES = int(os.getenv('RESERVED_INTERACTIVE_PIPELINES', '10'))
+SCHEDULE_INDEX = os.getenv('SCHEDULE_INDEX', 'scheduleLane-virtualFinish-index')
+
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_BATCH = 'batch'
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BATCH)
+
+LANE_RUNNING = 'running'
+
+dynamodb = boto3.resource('dynamodb')
+histories_table = dynamodb.Table(os.getenv('HISTORIES_TABLE', 'medical-histories'))
+doctors_table = dynamodb.Table(os.getenv('DOCTORS_TABLE', 'doctors'))
+scheduler_table = dynamodb.Table(os.getenv('SCHEDULER_TABLE', 'pipeline-scheduler'))
+ConditionalCheckFailed = histories_table.meta.client.exceptions.ConditionalCheckFailedException
+
+
+def _decimal(value):
+    return Decimal(str(round(value, 6)))
+
+
+def priority_of(history):
+    priority = history.get('priority')
+    return priority if priority in PRIORITIES else PRIORITY_INTERACTIVE
+
+
+def waiting_lane(priority):
+    return f"waiting#{priority}"
+
+
+def _virtual_time(priority):
+    item = scheduler_table.get_item(Key={'schedulerKey': f"clock#{priority}"}, ConsistentRead=True).get('Item')
+    return float(item['virtualTime']) if item else 0.0
+
+
+def _doctor_weight(doctor_id):
+    item = doctors_table.get_item(
+        Key={'doctorID': doctor_id},
+        ProjectionExpression='schedulingWeight'
+    ).get('Item') or {}
+    return float(item.get('schedulingWeight', 1))
+
+
+def _reserve_tags(doctor_id, priority, cost, weight):
+    """Tag a job of the doctor, moving their last finish tag with an optimistic check"""
+    doctor_key = {'schedulerKey': f"doctor#{doctor_id}#{priority}"}
+    for _ in range(10):
+        virtual_time = _virtual_time(priority)
+        item = scheduler_table.get_item(Key=doctor_key, ConsistentRead=True).get('Item')
+        last_finish = float(item['lastFinish']) if item else None
+        start, finish = tag_job(virtual_time, last_finish, cost, weight)
+
+        try:
+            if item:
+                scheduler_table.put_item(
+                    Item={**doctor_key, 'lastFinish': _decimal(finish)},
+                    ConditionExpression='lastFinish = :seen',
+                    ExpressionAttributeValues={':seen': item['lastFinish']}
+                )
+            else:
+                scheduler_table.put_item(
+                    Item={**doctor_key, 'lastFinish': _decimal(finish)},
+                    ConditionExpression='attribute_not_exists(schedulerKey)'
+                )
+            return start, finish
+        except ConditionalCheckFailed:
+            continue
+    raise Exception(f"Could not queue a job for doctor {doctor_id}: too much contention")
+
+
+def enqueue(history):
+    """
+    Put the history in its priority's lane and return its start tag. A history
+    already queued or admitted (a redelivered or requeued step) keeps its place.
+    """
+    history_id = history['historyID']
+    if history.get('scheduleLane'):
+        return None
+
+    priority = priority_of(history)
+    cost = job_cost(history.get('durationSeconds'))
+    start, finish = _reserve_tags(history['doctorID'], priority, cost, _doctor_weight(history['doctorID']))
+
+    try:
+        histories_table.update_item(
+            Key={'historyID': history_id},
+            UpdateExpression='SET scheduleLane = :lane, virtualStart = :start, virtualFinish = :finish, queuedAt = :now',
+            ConditionExpression='attribute_not_exists(scheduleLane)',
+            ExpressionAttributeValues={
+                ':lane': waiting_lane(priority),
+                ':start': _decimal(start),
+                ':finish': _decimal(finish),
+                ':now': datetime.utcnow().isoformat() + 'Z'
+            }
+        )
+    except ConditionalCheckFailed:
+        return None
+    print(f"History {history_id} queued as {priority} (cost {cost:.0f}s, finish tag {finish:.1f})")
+    return _decimal(start)
+
+
+def _count_running():
+    count = 0
+    query_kwargs = {
+        'IndexName': SCHEDULE_INDEX,
+        'KeyConditionExpression': Key('scheduleLane').eq(LANE_RUNNING),
+        'Select': 'COUNT'
+    }
+    while True:
+        response = histories_table.query(**query_kwargs)
+        count += response['Count']
+        if 'LastEvaluatedKey' not in response:
+            return count
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def _next_waiting(priority, limit):
+    if limit <= 0:
+        return []
+    response = histories_table.query(
+        IndexName=SCHEDULE_INDEX,
+        KeyConditionExpression=Key('scheduleLane').eq(waiting_lane(priority)),
+        Limit=limit
+    )
+    return response.get('Items', [])
+
+
+def _advance_virtual_time(priority, start):
+    try:
+        scheduler_table.update_item(
+            Key={'schedulerKey': f"clock#{priority}"},
+            UpdateExpression='SET virtualTime = :start',
+            ConditionExpression='attribute_not_exists(virtualTime) OR virtualTime < :start',
+            ExpressionAttributeValues={':start': start}
+        )
+    except ConditionalCheckFailed:
+        pass
+
+
+def admit(history_id, priority, virtual_start):
+    """
+    Move a waiting history to the running set. The admission checkpoint makes
+    its transcription step ready on the stream.
+    """
+    now = datetime.utcnow().isoformat() + 'Z'
+    try:
+        histories_table.update_item(
+            Key={'historyID': history_id},
+            UpdateExpression='SET scheduleLane = :running, checkpoints.admission = :now, updatedAt = :now',
+            # Histories that failed while waiting are left for release()
+            ConditionExpression='scheduleLane = :waiting AND attribute_exists(inFlightStatus)',
+            ExpressionAttributeValues={
+                ':running': LANE_RUNNING,
+                ':waiting': waiting_lane(priority),
+                ':now': now
+            }
+        )
+    except ConditionalCheckFailed:
+        return False
+    _advance_virtual_time(priority, virtual_start)
+    return True
+
+
+def _admit_lane(priority, places, queued):
+    candidates = [
+        (item['historyID'], item.get('virtualStart', Decimal(0)))
+        for item in _next_waiting(priority, places)
+    ]
+    if queued and queued[1] == priority and queued[0] not in {history_id for history_id, _ in candidates}:
+        candidates.append((queued[0], queued[2]))
+
+    admitted = 0
+    for history_id, virtual_start in candidates[:max(places, 0)]:
+        admitted += admit(history_id, priority, virtual_start)
+    return admitted
+
+
+def dispatch(queued=None):
+    """
+    Admit waiting histories in fair order while there are free places, the
+    interactive lane first. Returns how many. queued=(historyID, priority,
+    start tag) is a history just queued, which the index may not show yet: a
+    place still free after its lane is drained goes to it instead of staying
+    idle until the next dispatch.
+    """
+    free = MAX_ACTIVE_PIPELINES - _count_running()
+    if free <= 0:
+        return 0
+
+    interactive = _admit_lane(PRIORITY_INTERACTIVE, free, queued)
+    batch = _admit_lane(PRIORITY_BATCH, free - interactive - RESERVED_INTERACTIVE_PIPELINES, queued)
+    if interactive or batch:
+        print(f"Admitted {interactive} interactive and {batch} batch histories ({free} places were free)")
+    return interactive + batch
+
+
+def release(history_id):
+    """Take a completed or failed history out of the queue or the running set"""
+    try:
+        histories_table.update_item(
+            Key={'historyID': history_id},
+            UpdateExpression='REMOVE scheduleLane, virtualStart, virtualFinish',
+            ConditionExpression='attribute_exists(scheduleLane)'
+        )
+        return True
+    except ConditionalCheckFailed:
+        return False
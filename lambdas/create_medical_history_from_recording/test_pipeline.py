@@ -0,0 +1,118 @@
+import pytest
+from boto3.dynamodb.types import TypeSerializer
+
+INDEPENDENT_STEPS = {'admission', 'doctorProfile', 'patient'}
+
+
+@pytest.fixture(scope='module')
+def orchestrator(load_lambda):
+    return load_lambda('create_medical_history_from_recording')
+
+
+@pytest.fixture
+def dispatched(orchestrator, monkeypatch):
+    """Steps handle_stream_event hands to advance_pipeline, per history"""
+    calls = []
+    monkeypatch.setattr(orchestrator, 'advance_pipeline', lambda history, steps: calls.append(steps))
+    monkeypatch.setattr(orchestrator, 'notify_subscribers', lambda history: None)
+    monkeypatch.setattr(orchestrator, 'file_dead_letter', lambda history: None)
+    return calls
+
+
+def history(stage='queued', checkpoints=(), **attributes):
+    return {
+        'historyID': 'history-1',
+        'doctorID': 'doctor-1',
+        'status': 'processing',
+        'pipelineStage': stage,
+        'checkpoints': {checkpoint: '2026-01-01T00:00:00Z' for checkpoint in checkpoints},
+        **attributes
+    }
+
+
+def stream_record(new_image, old_image=None):
+    serializer = TypeSerializer()
+    encode = lambda image: {k: serializer.serialize(v) for k, v in image.items()}
+    images = {'NewImage': encode(new_image)}
+    if old_image is not None:
+        images['OldImage'] = encode(old_image)
+    return {'eventName': 'MODIFY' if old_image is not None else 'INSERT', 'dynamodb': images}
+
+
+def test_ready_steps_follow_the_dependency_graph(orchestrator):
+    assert orchestrator.ready_steps(history()) == INDEPENDENT_STEPS
+    assert orchestrator.ready_steps(history(checkpoints=INDEPENDENT_STEPS)) == {'transcription'}
+    assert orchestrator.ready_steps(
+        history(checkpoints={'admission', 'transcription', 'patient'})
+    ) == {'doctorProfile'}
+    assert orchestrator.ready_steps(
+        history(checkpoints={'admission', 'transcription', 'doctorProfile', 'patient'})
+    ) == {'medicalRecord'}
+    assert orchestrator.ready_steps(
+        history(checkpoints={'admission', 'transcription', 'doctorProfile', 'patient', 'medicalRecord'})
+    ) == {'metadata'}
+
+
+def test_ready_steps_leave_live_sessions_and_finished_histories_alone(orchestrator):
+    assert orchestrator.ready_steps(history(stage='recording', checkpoints=INDEPENDENT_STEPS)) == set()
+    assert orchestrator.ready_steps(history(stage='completed')) == set()
+    assert orchestrator.ready_steps(history(stage='failed')) == set()
+    assert orchestrator.ready_steps(history(stage=None)) == set()
+
+
+def test_insert_dispatches_the_steps_without_dependencies(orchestrator, dispatched):
+    orchestrator.handle_stream_event({'Records': [stream_record(history())]})
+
+    assert dispatched == [INDEPENDENT_STEPS]
+
+
+def test_checkpoint_dispatches_only_the_steps_it_made_ready(orchestrator, dispatched):
+    old = history(checkpoints={'admission', 'doctorProfile', 'patient'})
+    new = history(stage='transcribed', checkpoints={'admission', 'doctorProfile', 'patient', 'transcription'})
+
+    orchestrator.handle_stream_event({'Records': [stream_record(new, old)]})
+
+    assert dispatched == [{'medicalRecord'}]
+
+
+def test_checkpoint_with_a_step_still_running_dispatches_nothing(orchestrator, dispatched):
+    # doctorProfile is still missing, so the transcript alone doesn't make the note ready
+    old = history(checkpoints={'admission', 'patient'})
+    new = history(stage='transcribed', checkpoints={'admission', 'patient', 'transcription'})
+
+    orchestrator.handle_stream_event({'Records': [stream_record(new, old)]})
+
+    assert dispatched == []
+
+
+def test_retry_bump_dispatches_every_ready_step_again(orchestrator, dispatched):
+    old = history(stage='failed', checkpoints={'admission', 'doctorProfile', 'patient'}, pipelineAttempt=1)
+    new = history(stage='queued', checkpoints={'admission', 'doctorProfile', 'patient'}, pipelineAttempt=2)
+    stuck = history(checkpoints={'admission', 'doctorProfile', 'patient'}, pipelineAttempt=3)
+
+    orchestrator.handle_stream_event({'Records': [stream_record(new, old), stream_record(stuck, new)]})
+
+    assert dispatched == [{'transcription'}, {'transcription'}]
+
+
+def test_redelivered_or_unrelated_changes_dispatch_nothing(orchestrator, dispatched):
+    image = history(checkpoints={'admission', 'doctorProfile', 'patient'}, pipelineAttempt=1)
+    edited = {**image, 'patientName': 'Ana'}
+
+    orchestrator.handle_stream_event({'Records': [
+        stream_record(image, image),
+        stream_record(edited, image),
+        {'eventName': 'REMOVE', 'dynamodb': {}},
+    ]})
+
+    assert dispatched == []
+
+
+def test_resume_stage_is_the_furthest_milestone_reached(orchestrator):
+    assert orchestrator.resume_stage_for({}) == 'queued'
+    assert orchestrator.resume_stage_for({'admission': 't', 'doctorProfile': 't'}) == 'queued'
+    assert orchestrator.resume_stage_for({'admission': 't', 'transcription': 't'}) == 'transcribed'
+    assert orchestrator.resume_stage_for({'transcription': 't', 'medicalRecord': 't'}) == 'generated'
+    assert orchestrator.resume_stage_for(
+        {'transcription': 't', 'medicalRecord': 't', 'metadata': 't'}
+    ) == 'completed'
@@ -0,0 +1,125 @@
+from decimal import Decimal
+
+import boto3
+import pytest
+
+
+@pytest.fixture
+def scheduler(load_lambda, monkeypatch):
+    """scheduler.py against moto, with room for 3 pipelines, 1 of them kept for interactive work"""
+    scheduler = load_lambda('create_medical_history_from_recording').scheduler
+    dynamodb = boto3.resource('dynamodb')
+    dynamodb.create_table(
+        TableName='medical-histories',
+        KeySchema=[{'AttributeName': 'historyID', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[
+            {'AttributeName': 'historyID', 'AttributeType': 'S'},
+            {'AttributeName': 'scheduleLane', 'AttributeType': 'S'},
+            {'AttributeName': 'virtualFinish', 'AttributeType': 'N'},
+        ],
+        GlobalSecondaryIndexes=[{
+            'IndexName': scheduler.SCHEDULE_INDEX,
+            'KeySchema': [
+                {'AttributeName': 'scheduleLane', 'KeyType': 'HASH'},
+                {'AttributeName': 'virtualFinish', 'KeyType': 'RANGE'},
+            ],
+            'Projection': {'ProjectionType': 'ALL'},
+        }],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    for name, key in (('doctors', 'doctorID'), ('pipeline-scheduler', 'schedulerKey')):
+        dynamodb.create_table(
+            TableName=name,
+            KeySchema=[{'AttributeName': key, 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': key, 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+    monkeypatch.setattr(scheduler, 'MAX_ACTIVE_PIPELINES', 3)
+    monkeypatch.setattr(scheduler, 'RESERVED_INTERACTIVE_PIPELINES', 1)
+    return scheduler
+
+
+def add_history(scheduler, history_id, doctor_id, duration_seconds=600, priority=None):
+    history = {
+        'historyID': history_id,
+        'doctorID': doctor_id,
+        'durationSeconds': duration_seconds,
+        'status': 'pending',
+        'inFlightStatus': 'pending',
+        'checkpoints': {}
+    }
+    if priority:
+        history['priority'] = priority
+    scheduler.histories_table.put_item(Item=history)
+    return history
+
+
+def admitted(scheduler):
+    items = scheduler.histories_table.scan()['Items']
+    return {item['historyID'] for item in items if item.get('scheduleLane') == scheduler.LANE_RUNNING}
+
+
+def test_enqueue_keeps_the_place_of_a_redelivered_history(scheduler):
+    history = add_history(scheduler, 'h1', 'doctor-1')
+
+    start = scheduler.enqueue(history)
+    queued = scheduler.histories_table.get_item(Key={'historyID': 'h1'})['Item']
+
+    assert start == Decimal(0)
+    assert queued['scheduleLane'] == 'waiting#interactive'
+    assert queued['virtualFinish'] == Decimal(600)
+    # The stream hands the same step over again, with or without the new attributes
+    assert scheduler.enqueue(queued) is None
+    assert scheduler.enqueue(history) is None
+    assert scheduler.histories_table.get_item(Key={'historyID': 'h1'})['Item']['virtualFinish'] == Decimal(600)
+
+
+def test_dispatch_admits_a_new_doctor_ahead_of_a_backlog(scheduler):
+    for index in range(4):
+        scheduler.enqueue(add_history(scheduler, f"backlog-{index}", 'doctor-1'))
+    scheduler.enqueue(add_history(scheduler, 'live', 'doctor-2'))
+
+    assert scheduler.dispatch() == 3
+    assert admitted(scheduler) == {'backlog-0', 'live', 'backlog-1'}
+    # Admission checkpoints the history, which makes its transcription ready
+    live = scheduler.histories_table.get_item(Key={'historyID': 'live'})['Item']
+    assert 'admission' in live['checkpoints']
+
+    # Full: nothing more until a place is released
+    assert scheduler.dispatch() == 0
+    assert scheduler.release('live')
+    assert scheduler.dispatch() == 1
+    assert admitted(scheduler) == {'backlog-0', 'backlog-1', 'backlog-2'}
+
+
+def test_batch_work_leaves_the_reserved_places_free(scheduler):
+    for index in range(3):
+        scheduler.enqueue(add_history(scheduler, f"batch-{index}", 'doctor-1', priority='batch'))
+
+    assert scheduler.dispatch() == 2
+    assert admitted(scheduler) == {'batch-0', 'batch-1'}
+
+    scheduler.enqueue(add_history(scheduler, 'live', 'doctor-2'))
+    assert scheduler.dispatch() == 1
+    assert 'live' in admitted(scheduler)
+
+
+def test_dispatch_admits_the_history_just_queued(scheduler, monkeypatch):
+    start = scheduler.enqueue(add_history(scheduler, 'h1', 'doctor-1'))
+    # The index hasn't caught up with the write yet
+    monkeypatch.setattr(scheduler, '_next_waiting', lambda priority, limit: [])
+
+    assert scheduler.dispatch(queued=('h1', 'interactive', start)) == 1
+    assert admitted(scheduler) == {'h1'}
+
+
+def test_histories_that_failed_while_waiting_are_not_admitted(scheduler):
+    scheduler.enqueue(add_history(scheduler, 'h1', 'doctor-1'))
+    scheduler.histories_table.update_item(
+        Key={'historyID': 'h1'},
+        UpdateExpression='SET #status = :failed REMOVE inFlightStatus',
+        ExpressionAttributeNames={'#status': 'status'},
+        ExpressionAttributeValues={':failed': 'failed'}
+    )
+
+    assert scheduler.dispatch() == 0
@@ -0,0 +1,38 @@
+import os
+import sys
+import importlib.util
+
+# Monolith mode (PIPELINE_MODE=monolith) runs the pipeline workers in this
+# process. Their code is bundled next to this file by the deploy workflow
+# (lambda_config.yml "bundle": lambdas/transcribe/*.py -> transcribe/*.py); in
+# a checkout the sibling Lambda directories are used. Every worker is a
+# lambda_function.py, so each one is imported under its own module name.
+# Their shared modules (lambdas/shared) are packaged at the root next to this
+# file; in a checkout they are taken from lambdas/shared.
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_SHARED = os.path.join(_HERE, '..', 'shared')
+_workers = {}
+
+
+def _worker_path(name):
+    for base in (_HERE, os.path.join(_HERE, '..')):
+        path = os.path.join(base, name, 'lambda_function.py')
+        if os.path.exists(path):
+            return path
+    raise ImportError(f"Worker '{name}' is not bundled with this function")
+
+
+def load_worker(name):
+    """lambda_function module of the bundled Lambda `name`, imported once per container"""
+    if name not in _workers:
+        path = _worker_path(name)
+        # Its helper modules (prompts, artifacts, rate_limiter, ...) import by plain name
+        sys.path.append(os.path.dirname(path))
+        if os.path.isdir(_SHARED) and _SHARED not in sys.path:
+            sys.path.append(_SHARED)
+        spec = importlib.util.spec_from_file_location(f"{name}_worker", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _workers[name] = module
+    return _workers[name]
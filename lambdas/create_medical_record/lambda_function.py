@@ -1,11 +1,56 @@
 import os
+import time
+import uuid
+import hashlib
+import boto3
 import openai
+from collections import OrderedDict
 from datetime import datetime
 import json
 
-from prompts import SYSTEM_PROMPT, CLINICAL_NOTE_EXAMPLE, DEFAULT_MEDICAL_RECORD_FORMAT
+from prompts import (
+    SYSTEM_PROMPT, DOCTOR_PROMPT, DOCTOR_STYLE_PROFILE_PROMPT, TEMPORAL_CONTEXT_PROMPT, CLINICAL_NOTE_EXAMPLE,
+    DEFAULT_MEDICAL_RECORD_FORMAT
+)
+from artifacts import LazyArtifact
+from rate_limiter import limited_call
+from circuit_breaker import CircuitOpen, circuit
+from retries import record_failure
+from deadline import (
+    SAFETY_MARGIN_MS, DeadlineExceeded, StageEstimate, StageTooLong, call_budget_seconds, fits_fresh_invocation,
+    has_time_for, hand_off, remaining_ms
+)
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+HISTORIES_TABLE = os.getenv("HISTORIES_TABLE", "medical-histories")
+# Duplicate pipeline invocations (async retries, stream redeliveries) are dropped
+# through a lease on the history item; see acquire_lease
+STAGE_LEASE_SECONDS = int(os.getenv("STAGE_LEASE_SECONDS", "900"))
+# Expected GPT-5 latency for a transcript (see deadline.py); a pipeline
+# generation that doesn't fit in the remaining time moves to a fresh invocation
+# when it would fit there, otherwise it gets the whole remaining time
+GENERATION_ESTIMATE = StageEstimate(
+    base_ms=int(os.getenv("GENERATION_BASE_MS", "15000")),
+    per_unit_ms=float(os.getenv("GENERATION_MS_PER_CHAR", "2"))
+)
+
+dynamodb = boto3.resource('dynamodb')
+histories_table = dynamodb.Table(HISTORIES_TABLE)
+
+# First invocation of this container, reported with the stage timing
+_cold_start = True
+
+# Prompt cache use of this container's generations (see report_prompt_cache)
+_prompt_cache_totals = {'calls': 0, 'inputTokens': 0, 'cachedTokens': 0}
+
+# Compiled doctor profiles kept by a warm container, least recently used evicted
+# first (see compiled_profile)
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "128"))
+_compiled_profiles = OrderedDict()
+
+# Use the doctor's condensed style profile, when the pipeline sends one, instead
+# of the full example
+USE_STYLE_PROFILE = os.getenv("USE_STYLE_PROFILE", "true").lower() == "true"
 
 def extract_field_order(format_template):
     """
@@ -90,6 +135,86 @@ def reorder_medical_record(data, field_order):
 
     return ordered
 
+def render_prompt_value(value):
+    """Doctor example/format as prompt text: JSON pretty-printed, anything else as is"""
+    if isinstance(value, str):
+        try:
+            parsed = json.loads(value)
+        except ValueError:
+            return value
+        if not isinstance(parsed, (dict, list)):
+            return value
+        value = parsed
+    return json.dumps(value, indent=2, ensure_ascii=False)
+
+
+def profile_key(*values):
+    digest = hashlib.sha256()
+    for value in values:
+        text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+        digest.update(text.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def parse_style_profile(style_profile):
+    """Style profile as stored on the doctor (JSON text) or already parsed; None if unusable"""
+    if isinstance(style_profile, str):
+        try:
+            style_profile = json.loads(style_profile)
+        except ValueError:
+            return None
+    if not isinstance(style_profile, dict):
+        return None
+    if not style_profile.get('perfil_estilo') or not style_profile.get('ejemplo_corto'):
+        return None
+    return style_profile
+
+
+def compiled_profile(medical_record_example, medical_record_format, style_profile=None):
+    """
+    Everything of a prompt that only depends on the doctor: the static message
+    prefix, its prompt cache key and the field order of the doctor's format.
+    Compiled once per example (or style profile, which replaces it) and format
+    and kept in an LRU across warm invocations, so per-request assembly is a
+    lookup.
+    """
+    style_profile = parse_style_profile(style_profile)
+    if style_profile:
+        key = profile_key(style_profile, medical_record_format)
+    else:
+        key = profile_key(medical_record_example, medical_record_format)
+    profile = _compiled_profiles.get(key)
+    if profile is not None:
+        _compiled_profiles.move_to_end(key)
+        return profile
+
+    if style_profile:
+        doctor_prompt = DOCTOR_STYLE_PROFILE_PROMPT.format(
+            style_profile=render_prompt_value(style_profile['perfil_estilo']),
+            style_exemplar=style_profile['ejemplo_corto'],
+            medical_record_format=render_prompt_value(medical_record_format)
+        )
+    else:
+        doctor_prompt = DOCTOR_PROMPT.format(
+            medical_record_example=render_prompt_value(medical_record_example),
+            medical_record_format=render_prompt_value(medical_record_format)
+        )
+    profile = {
+        'messages': (
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "system", "content": doctor_prompt},
+        ),
+        'promptCacheKey': 'medical-record-' + key[:16],
+        'fieldOrder': extract_field_order(medical_record_format)
+    }
+    _compiled_profiles[key] = profile
+    if len(_compiled_profiles) > PROFILE_CACHE_SIZE:
+        _compiled_profiles.popitem(last=False)
+    print(f"Compiled doctor profile {key[:16]} ({len(_compiled_profiles)} cached)")
+    return profile
+
+
 def generate_temporal_context():
     meses = [
         "enero", "febrero", "marzo", "abril", "mayo", "junio",
@@ -105,51 +230,95 @@ def generate_temporal_context():
     fecha = f"{hoy.day} de {mes} de {hoy.year} {hoy.strftime('%H:%M')}"
     return f"hoy es {dia_semana}, {fecha}."
 
-def generate_medical_record(transcription, medical_record_example, medical_record_format):
+def report_prompt_cache(completion):
+    """Log how much of the prompt the provider served from its cache; returns this call's usage"""
+    usage = getattr(completion, 'usage', None)
+    input_tokens = getattr(usage, 'input_tokens', 0) or 0
+    cached_tokens = getattr(getattr(usage, 'input_tokens_details', None), 'cached_tokens', 0) or 0
+
+    _prompt_cache_totals['calls'] += 1
+    _prompt_cache_totals['inputTokens'] += input_tokens
+    _prompt_cache_totals['cachedTokens'] += cached_tokens
+    call_rate = cached_tokens / input_tokens if input_tokens else 0
+    container_rate = _prompt_cache_totals['cachedTokens'] / max(_prompt_cache_totals['inputTokens'], 1)
+    print(f"Prompt cache: {cached_tokens}/{input_tokens} input tokens cached ({call_rate:.0%}); "
+          f"container hit rate {container_rate:.0%} over {_prompt_cache_totals['calls']} calls")
+    return {'inputTokens': input_tokens, 'cachedTokens': cached_tokens}
+
+
+def generate_medical_record(transcription, medical_record_example, medical_record_format, context=None, usage=None,
+                            style_profile=None):
+    """
+    With the Lambda context the call is deadline-aware: it raises DeadlineExceeded
+    instead of starting a generation that a fresh invocation would have time
+    for but this one doesn't, and the request itself is cut off before the
+    invocation would be killed. A generation that needs more than a whole
+    invocation is still attempted with the time left, and raises StageTooLong
+    when it is cut off.
+
+    The messages go from static to volatile (see prompts.py) so a doctor's
+    consecutive notes reuse the cached prompt prefix; prompt_cache_key keeps
+    them on the same cache. The token usage is added to `usage` when given.
+    A style_profile replaces the full example in the prompt.
+    """
     client = openai.OpenAI(api_key=OPENAI_API_KEY)
 
     temporal_context = generate_temporal_context()
+    profile = compiled_profile(medical_record_example, medical_record_format, style_profile)
+
+    estimate_ms = GENERATION_ESTIMATE.estimate(len(transcription))
+
+    def create_completion(**request):
+        # Checked once the limiter lets the call through, queueing may have used up the budget
+        if not has_time_for(context, estimate_ms) and fits_fresh_invocation(context, estimate_ms):
+            raise DeadlineExceeded(f"{remaining_ms(context)}ms left, generation needs ~{estimate_ms:.0f}ms")
+        budget = call_budget_seconds(context)
+        if budget is None:
+            return client.responses.create(**request)
+        try:
+            return client.with_options(timeout=budget, max_retries=0).responses.create(**request)
+        except openai.APITimeoutError as e:
+            # Worth another try only if a fresh invocation gives the call more time than it had
+            if fits_fresh_invocation(context, budget * 1000 + SAFETY_MARGIN_MS):
+                raise DeadlineExceeded(f"Generation cut off after {budget:.0f}s") from e
+            raise StageTooLong(
+                f"Generation of a {len(transcription)}-character transcript did not finish "
+                f"within the {budget:.0f}s an invocation allows"
+            ) from e
+
+    started = time.time()
+    with circuit('openai'):
+        completion = limited_call(
+            'openai',
+            create_completion,
+            model="gpt-5",
+            reasoning={"effort": "minimal"},
+            input=[
+                *profile['messages'],
+                {
+                    "role": "system",
+                    "content": TEMPORAL_CONTEXT_PROMPT.format(temporal_context=temporal_context),
+                },
+                {
+                    "role": "user",
+                    "content": (
+                        transcription
+                    ),
+                },
+            ],
+            prompt_cache_key=profile['promptCacheKey'],
+            text={"format": {"type": "json_object"}},
+        )
+    GENERATION_ESTIMATE.observe(len(transcription), (time.time() - started) * 1000)
+    call_usage = report_prompt_cache(completion)
+    if usage is not None:
+        usage.update(call_usage)
 
-    try:
-        medical_record_example = json.dumps(medical_record_example, indent=2, ensure_ascii=False)
-    except Exception as e:
-        print(f"Nota clínica no es un JSON válido, contiunando como texto plano: {e}")
-    medical_record_example = medical_record_example.replace("{", "{{")
-    medical_record_example = medical_record_example.replace("}", "}}")
-    
-    try:
-        medical_record_format = json.dumps(medical_record_format, indent=2, ensure_ascii=False)
-    except Exception as e:
-        print(f"Formato de historia clínica no es un JSON válido, contiunando como texto plano: {e}")
-
-    medical_record_format = medical_record_format.replace("{", "{{")
-    medical_record_format = medical_record_format.replace("}", "}}")
-    
-    formatted_prompt = SYSTEM_PROMPT.format(temporal_context=temporal_context, medical_record_example=medical_record_example, medical_record_format=medical_record_format)
-
-    completion = client.responses.create(
-        model="gpt-5",
-        reasoning={"effort": "minimal"},
-        input=[
-            {
-                "role": "system",
-                "content": formatted_prompt,
-            },
-            {
-                "role": "user",
-                "content": (
-                    transcription
-                ),
-            },
-        ],
-        text={"format": {"type": "json_object"}},
-    )
-    
     data = json.loads(completion.output[1].content[0].text,
                       object_pairs_hook=dict)
 
-    # Extraer el orden de campos del formato del médico y reordenar
-    field_order = extract_field_order(medical_record_format)
+    # Reordenar según el orden de campos del formato del médico
+    field_order = profile['fieldOrder']
     if field_order:
         print(f"Reordering fields according to doctor's format: {field_order}")
         data = reorder_medical_record(data, field_order)
@@ -159,7 +328,95 @@ def generate_medical_record(transcription, medical_record_example, medical_recor
     return data
 
 
+def acquire_lease(history_id, owner):
+    """
+    Claim the note generation of a history for this invocation. Fails when the
+    note is already checkpointed or another invocation holds an unexpired
+    lease; a retry of this same invocation (same request ID) gets it back.
+    """
+    now = int(time.time())
+    try:
+        histories_table.update_item(
+            Key={'historyID': history_id},
+            UpdateExpression='SET medicalRecordLease = :lease',
+            ConditionExpression=(
+                'attribute_not_exists(checkpoints.medicalRecord) AND '
+                '(attribute_not_exists(medicalRecordLease) OR medicalRecordLease.expiresAt < :now '
+                'OR medicalRecordLease.#owner = :owner)'
+            ),
+            ExpressionAttributeNames={'#owner': 'owner'},
+            ExpressionAttributeValues={
+                ':lease': {'owner': owner, 'expiresAt': now + STAGE_LEASE_SECONDS},
+                ':now': now,
+                ':owner': owner
+            }
+        )
+        return True
+    except histories_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+def release_lease(history_id, owner):
+    """Give the lease up so the invocation taking over the generation can claim it"""
+    try:
+        histories_table.update_item(
+            Key={'historyID': history_id},
+            UpdateExpression='REMOVE medicalRecordLease',
+            ConditionExpression='medicalRecordLease.#owner = :owner',
+            ExpressionAttributeNames={'#owner': 'owner'},
+            ExpressionAttributeValues={':owner': owner}
+        )
+    except histories_table.meta.client.exceptions.ConditionalCheckFailedException:
+        pass
+
+
+def save_pipeline_result(history_id, medical_record, timing=None):
+    """Checkpoint the generated note and move the history to the next pipeline stage, once"""
+    try:
+        histories_table.update_item(
+            Key={'historyID': history_id},
+            UpdateExpression=(
+                'SET jsonData = :jdata, checkpoints.medicalRecord = :updated, pipelineStage = :stage, '
+                'updatedAt = :updated, medicalRecordTiming = :timing '
+                'REMOVE medicalRecordLease'
+            ),
+            ConditionExpression='attribute_not_exists(checkpoints.medicalRecord)',
+            ExpressionAttributeValues={
+                ':jdata': medical_record,
+                ':stage': 'generated',
+                ':updated': datetime.utcnow().isoformat() + 'Z',
+                ':timing': timing or {}
+            }
+        )
+        return True
+    except histories_table.meta.client.exceptions.ConditionalCheckFailedException:
+        print(f"Medical record of history {history_id} was already stored, dropping duplicate result")
+        return False
+
+
+def save_pipeline_failure(history_id, error):
+    """Fail the stage, or schedule its retry when the error is transient (see retries.py)"""
+    try:
+        record_failure(
+            histories_table, history_id, error, f"Medical record creation failed: {error}", lease_attribute='medicalRecordLease'
+        )
+    except Exception as update_error:
+        print(f"Failed to update error status: {update_error}")
+
+
 def lambda_handler(event, context):
+    """
+    Generate a clinical note from a transcription.
+
+    When called by the recording pipeline the body also carries "historyID": the
+    note is written to medical-histories instead of being awaited by the caller.
+    The pipeline sends "transcriptionRef" (an S3 reference, see artifacts.py)
+    instead of the transcript itself. Pipeline generations that would outlive
+    the invocation continue in a fresh one (see deadline.py).
+    """
+    global _cold_start
+    cold_start, _cold_start = _cold_start, False
+    history_id = None
     try:
         # Parse input - handle both direct invocation and API Gateway format
         if isinstance(event.get('body'), str):
@@ -167,9 +424,12 @@ def lambda_handler(event, context):
         else:
             body = event.get('body', event)  # Fallback to event itself for direct invocation
 
-        transcription = body.get('transcription')
+        history_id = body.get('historyID')
 
-        if not transcription:
+        # Validated before the lease, so a rejected request never holds it
+        transcription = LazyArtifact(body.get('transcriptionRef') or body.get('transcription'))
+
+        if not transcription.ref and not transcription.value:
             return {
                 'statusCode': 400,
                 'headers': {
@@ -179,14 +439,56 @@ def lambda_handler(event, context):
                 'body': json.dumps({'error': 'transcription is required'})
             }
 
+        # Drop duplicate deliveries before paying for a second generation
+        if history_id:
+            owner = getattr(context, 'aws_request_id', None) or str(uuid.uuid4())
+            if not acquire_lease(history_id, owner):
+                print(f"Duplicate medical record invocation for history {history_id} dropped")
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps({'historyID': history_id, 'message': 'Duplicate invocation dropped'})
+                }
+
         # Get example format - can be 'example_format' or 'medical_record_example'
         medical_record_example = (
             body.get('medical_record_example') or
             CLINICAL_NOTE_EXAMPLE
         )
         medical_record_format = body.get('medical_record_format', DEFAULT_MEDICAL_RECORD_FORMAT)
+        style_profile = body.get('medical_record_style_profile') if USE_STYLE_PROFILE else None
 
-        medical_record = generate_medical_record(transcription, medical_record_example, medical_record_format)
+        if not history_id:
+            medical_record = generate_medical_record(
+                transcription.value, medical_record_example, medical_record_format, style_profile=style_profile
+            )
+        else:
+            timing = {'coldStart': cold_start}
+            if body.get('dispatchedAt'):
+                timing['dispatchMs'] = max(0, int(time.time() * 1000) - int(body['dispatchedAt']))
+            started = time.time()
+            try:
+                medical_record = generate_medical_record(
+                    transcription.value, medical_record_example, medical_record_format, context, usage=timing,
+                    style_profile=style_profile
+                )
+            except DeadlineExceeded as e:
+                print(f"Medical record of history {history_id} handed off: {e}")
+                release_lease(history_id, owner)
+                hand_off(context, body)
+                return {
+                    'statusCode': 202,
+                    'body': json.dumps({'historyID': history_id, 'message': 'Generation handed off'})
+                }
+            timing['providerMs'] = int((time.time() - started) * 1000)
+
+        if history_id:
+            save_pipeline_result(history_id, medical_record, timing)
+            print(f"Medical record stored for history {history_id}")
+            # Nobody waits on the pipeline invocation, don't echo the note back
+            return {
+                'statusCode': 200,
+                'body': json.dumps({'historyID': history_id, 'message': 'Medical record stored'})
+            }
 
         return {
             'statusCode': 200,
@@ -197,10 +499,27 @@ def lambda_handler(event, context):
             'body': json.dumps({'medical_record': medical_record})
         }
 
+    except CircuitOpen as e:
+        # OpenAI is down: fail fast, pipeline histories wait for their retry
+        print(f"Error: {e}")
+        if history_id:
+            save_pipeline_failure(history_id, e)
+        return {
+            'statusCode': 503,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*',
+                'Retry-After': str(int(e.retry_after) + 1)
+            },
+            'body': json.dumps({'error': 'Medical record service unavailable', 'details': str(e)})
+        }
+
     except Exception as e:
         print(f"Error: {e}")
         import traceback
         traceback.print_exc()
+        if history_id:
+            save_pipeline_failure(history_id, e)
         return {
             'statusCode': 500,
             'headers': {
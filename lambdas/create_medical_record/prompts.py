@@ -1,15 +1,21 @@
+# The prompt is sent as separate messages ordered from static to volatile, so
+# consecutive notes share the longest possible prefix and hit the provider's
+# prompt cache: the rules (identical for every note), then the doctor's example
+# and format (identical for all of a doctor's notes), and only then the date
+# and the transcript. Nothing volatile may go into the first two.
+#
+# Doctors registered with a style profile (extract_format "style_profile" task)
+# send DOCTOR_STYLE_PROFILE_PROMPT instead of DOCTOR_PROMPT: the traits of their
+# writing and a short anonymized exemplar, far fewer tokens than the full example.
+
 SYSTEM_PROMPT = """
 [ROL/SISTEMA]
 Eres médico general. Estructura la nota clínica exclusivamente con la información presente en la transcripción. No inventes ni completes por inferencia. Si un campo no tiene evidencia, omítelo. Usa español médico neutro, Sistema Internacional de unidades, frases cortas y voz activa.
 
-[EJEMPLO ESTILO ESCRITURA DEL MEDICO]
-El siguiente ejemplo contiene el estilo de escritura del medico, intenta escribir como el lo hace.
-{medical_record_example}
-
 [REGLAS]
 - *Motivo de consulta*: el motivo de consulta medica de manera concisa en palabras del paciente.
 - *Enfermedad actual*: redacta en prosa cronopatológica, con estructura lógica (inicio → evolución → factores → síntomas asociados → severidad → tratamientos previos y respuesta). 
-  - Expresa tiempos en h/d/sem según corresponda al contexto temporal ({temporal_context}).
+  - Expresa tiempos en h/d/sem según corresponda al contexto temporal (sección [CONTEXTO TEMPORAL]).
   - No repitas texto del motivo de consulta.
   - No incluyas conductas terapéuticas ni hallazgos del examen físico
 - *Examen físico*: consigna hallazgos positivos y negativos relevantes. Si el área fue examinada y está normal, indica “sin hallazgos patológicos” o un descriptor clínico breve.
@@ -18,9 +24,7 @@ El siguiente ejemplo contiene el estilo de escritura del medico, intenta escribi
 - *Plan de manejo* en orden estándar. Solo incluir acciones explícitas.
 - Si una sección no tiene contenido no la incluyas en el JSON final.
 - Devuelve **únicamente un JSON válido**, sin texto adicional ni explicaciones.
-
-[FORMATO — SALIDA JSON ESPERADA]
-{medical_record_format}
+- Escribe con el estilo del médico (sección [EJEMPLO ESTILO ESCRITURA DEL MEDICO] o [PERFIL DE ESTILO DEL MEDICO]) y con su formato (sección [FORMATO — SALIDA JSON ESPERADA]).
 
 El formato tiene que tener un orden lógico y coherente acorde a la estructura de una nota clínica médica.
 Este es un ejemplo:
@@ -37,18 +41,45 @@ Análisis
 Plan de manejo
 """
 
+DOCTOR_PROMPT = """
+[EJEMPLO ESTILO ESCRITURA DEL MEDICO]
+El siguiente ejemplo contiene el estilo de escritura del medico, intenta escribir como el lo hace.
+{medical_record_example}
+
+[FORMATO — SALIDA JSON ESPERADA]
+{medical_record_format}
+"""
+
+DOCTOR_STYLE_PROFILE_PROMPT = """
+[PERFIL DE ESTILO DEL MEDICO]
+Rasgos del estilo de escritura del medico, escribe siguiéndolos.
+{style_profile}
+
+[EJEMPLO CORTO DEL ESTILO]
+Fragmento ilustrativo del estilo, no contiene datos de ningún paciente real.
+{style_exemplar}
+
+[FORMATO — SALIDA JSON ESPERADA]
+{medical_record_format}
+"""
+
+TEMPORAL_CONTEXT_PROMPT = """
+[CONTEXTO TEMPORAL]
+{temporal_context}
+"""
+
 DEFAULT_MEDICAL_RECORD_FORMAT = """
-{{
-  "datos_personales": {{
+{
+  "datos_personales": {
     "edad": "",
     "sexo": "",
     "servicio_lugar": "",
     "acompanante": "",
     "aseguradora": ""
-  }},
+  },
   "motivo_consulta": "",
   "enfermedad_actual": "<relato cronopatológico en prosa clínica teniendo en cuenta unidad de tiempo respecto a hoy para la descripción sintomática>",
-  "antecedentes_relevantes": {{
+  "antecedentes_relevantes": {
     "habitos": "",
     "quirurgicos": "",
     "patologicos": "",
@@ -57,8 +88,8 @@ DEFAULT_MEDICAL_RECORD_FORMAT = """
     "ginecoobstetricos": "",
     "familiares": "",
     "sociales": ""
-  }},
-  "examen_fisico": {{
+  },
+  "examen_fisico": {
     "estado_general": "",
     "cabeza_orl": "",
     "cuello": "",
@@ -69,26 +100,26 @@ DEFAULT_MEDICAL_RECORD_FORMAT = """
     "musculo_esqueletico": "",
     "neurologico": "",
     "piel_teg": ""
-  }},
+  },
   "paraclinicos_imagenes": [
-    {{
+    {
       "fecha": "",
       "estudio": "",
       "hallazgos": ""
-    }}
+    }
   ],
   "impresion_diagnostica": [
-    {{
+    {
       "diagnostico": "",
       "cie10": ""
-    }},
-    {{
+    },
+    {
       "diagnostico": "",
       "cie10": ""
-    }}
+    }
   ],
   "analisis_clinico": "",
-  "plan_manejo": {{
+  "plan_manejo": {
     "disposicion": "",
     "dieta_nutricion": "",
     "oxigeno_ventilacion": "",
@@ -101,9 +132,9 @@ DEFAULT_MEDICAL_RECORD_FORMAT = """
     "rehabilitacion_enfermeria": "<órdenes>",
     "educacion_advertencias": "<puntos clave y alarmas, según diagnóstico>",
     "seguimiento_citas": "<cuándo, con quién, metas>"
-  }},
+  },
   "notas_calidad_datos": "<inconsistencias, datos críticos ausentes>"
-}}
+}
 """
 
 CLINICAL_NOTE_EXAMPLE = """
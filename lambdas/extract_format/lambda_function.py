@@ -5,7 +5,9 @@ import boto3
 import requests
 from urllib.parse import urlparse
 
-from prompts import EXTRACT_STRUCTURE_SYSTEM_PROMPT
+from prompts import EXTRACT_STRUCTURE_SYSTEM_PROMPT, EXTRACT_STYLE_PROFILE_SYSTEM_PROMPT
+from rate_limiter import limited_call
+from circuit_breaker import CircuitOpen, circuit
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
@@ -46,30 +48,49 @@ def read_txt_file(file_path=None, s3_bucket=None, s3_key=None):
     else:
         raise ValueError("Either file_path or both s3_bucket and s3_key must be provided")
 
-def generate_structure_from_medical_record(medical_record_example):
-
+def generate_structure_from_medical_record(medical_record_example, system_prompt=EXTRACT_STRUCTURE_SYSTEM_PROMPT):
+    """Raises circuit_breaker.CircuitOpen at once while OpenAI is down"""
     client = openai.OpenAI(api_key=OPENAI_API_KEY)
-    completion = client.responses.create(
-        model="gpt-5",
-        reasoning={"effort": "minimal"},
-        input=[
-            {
-                "role": "system",
-                "content": EXTRACT_STRUCTURE_SYSTEM_PROMPT,
-            },
-            {
-                "role": "user",
-                "content": (
-                    medical_record_example
-                ),
-            },
-        ],
-        text={"format": {"type": "json_object"}},
-    )
+    with circuit('openai'):
+        completion = limited_call(
+            'openai',
+            client.responses.create,
+            model="gpt-5",
+            reasoning={"effort": "minimal"},
+            input=[
+                {
+                    "role": "system",
+                    "content": system_prompt,
+                },
+                {
+                    "role": "user",
+                    "content": (
+                        medical_record_example
+                    ),
+                },
+            ],
+            text={"format": {"type": "json_object"}},
+        )
     data = json.loads(completion.output[1].content[0].text)
     return data
 
+def generate_style_profile(medical_record_example):
+    """
+    Condensed writing style of the doctor's example: a profile of its traits and
+    a short anonymized exemplar, sent to create_medical_record instead of the
+    full example.
+    """
+    data = generate_structure_from_medical_record(medical_record_example, EXTRACT_STYLE_PROFILE_SYSTEM_PROMPT)
+    if not isinstance(data.get('perfil_estilo'), dict) or not data.get('ejemplo_corto'):
+        raise ValueError("Style profile response is missing perfil_estilo or ejemplo_corto")
+    return {'perfil_estilo': data['perfil_estilo'], 'ejemplo_corto': data['ejemplo_corto']}
+
 def lambda_handler(event, context):
+    """
+    Structure of an example clinical history, or with "task": "style_profile"
+    its condensed writing style (see generate_style_profile). While OpenAI is
+    down it returns {"error": "unavailable", "retryAfter": seconds} instead.
+    """
     # Handle different input formats
     if 'medical_record_example' in event:
         # Direct text input (backward compatibility)
@@ -94,4 +115,12 @@ def lambda_handler(event, context):
     else:
         raise ValueError("Event must contain 'medical_record_example', 'file_path', or 's3_bucket' and 's3_key'")
 
-    return generate_structure_from_medical_record(medical_record_example)
+    try:
+        if event.get('task') == 'style_profile':
+            return generate_style_profile(medical_record_example)
+
+        return generate_structure_from_medical_record(medical_record_example)
+    except CircuitOpen as e:
+        # Answered, not raised, so callers get the delay without parsing the message
+        print(f"Error: {e}")
+        return {'error': 'unavailable', 'retryAfter': e.retry_after}
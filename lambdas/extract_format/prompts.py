@@ -82,4 +82,22 @@ Eres un médico encargado de analizar una historia clínica y devolver un format
     "notas_calidad_datos": ""
   }
 }
-"""
\ No newline at end of file
+"""
+EXTRACT_STYLE_PROFILE_SYSTEM_PROMPT = """
+[ROL/SISTEMA]
+Eres un médico encargado de analizar una historia clínica de ejemplo escrita por otro médico y resumir su estilo de escritura, para que un asistente pueda redactar nuevas notas como él sin volver a leer el ejemplo completo.
+
+[REGLAS]
+- El JSON debe contener **exactamente dos llaves principales**:
+  1. `"perfil_estilo"` — objeto con los rasgos de escritura del médico, cada uno en una frase corta:
+     - `"redaccion"`: persona gramatical, tiempo verbal y tipo de frases (prosa, telegráfico, listas).
+     - `"extension"`: nivel de detalle y longitud típica de cada sección.
+     - `"abreviaturas"`: lista de las abreviaturas y siglas que usa, tal como las escribe (por ejemplo `"MC"`, `"EVA"`, `"Dx"`).
+     - `"terminologia"`: expresiones o giros característicos que repite.
+     - `"convenciones"`: cómo escribe unidades, escalas, fechas, dosis y diagnósticos.
+     - `"titulos_secciones"`: cómo nombra y separa las secciones.
+  2. `"ejemplo_corto"` — un fragmento de máximo 120 palabras que muestre el estilo (por ejemplo enfermedad actual y análisis), reescrito a partir del ejemplo.
+- En `"ejemplo_corto"` reemplaza todo dato que identifique al paciente (nombres, documentos, teléfonos, direcciones) por marcadores como `<nombre>` o `<documento>`.
+- Describe solo rasgos presentes en el ejemplo; no inventes preferencias.
+- Devuelve **únicamente un JSON válido**, sin texto adicional, explicaciones ni formato fuera del JSON.
+"""
@@ -1,5 +1,6 @@
 import os
 import json
+import uuid
 import boto3
 from botocore.exceptions import ClientError
 from datetime import datetime
@@ -8,6 +9,309 @@ s3_client = boto3.client('s3')
 
 BUCKET_NAME = 'recordings-clinicalops'
 EXPIRATION = 3600  # 1 hour
+MAX_PARTS_PER_REQUEST = 100
+MAX_BATCH_FILES = 50
+
+
+def _response(status_code, body):
+    return {
+        'statusCode': status_code,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps(body)
+    }
+
+
+def _recording_key(doctor_id, file_name):
+    # Generate unique file key with timestamp
+    timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+    return f"doctors/{doctor_id}/recordings/{timestamp}_{file_name}"
+
+
+def _upload_metadata(doctor_id, entry):
+    """
+    Object metadata that lets the ObjectCreated event start the pipeline on its
+    own. The historyID is minted here so the client knows it before uploading.
+    Segments of a live session are marked to be skipped, their history
+    already exists.
+    """
+    if entry.get('purpose') == 'segment':
+        return None, {'pipeline': 'skip'}
+
+    history_id = str(uuid.uuid4())
+    metadata = {'history-id': history_id, 'doctor-id': doctor_id}
+    if entry.get('patientID'):
+        metadata['patient-id'] = str(entry['patientID'])
+    if entry.get('durationSeconds'):
+        metadata['duration-seconds'] = str(entry['durationSeconds'])
+    if entry.get('priority') == 'batch':
+        # Offline backlogs wait behind live consultations in the pipeline
+        metadata['priority'] = 'batch'
+    return history_id, metadata
+
+
+def _upload_headers(metadata):
+    # Signed into the URL, so the PUT has to send them unchanged
+    return {f"x-amz-meta-{name}": value for name, value in metadata.items()}
+
+
+def _owns_key(doctor_id, file_key):
+    return bool(doctor_id) and bool(file_key) and file_key.startswith(f"doctors/{doctor_id}/")
+
+
+def handle_single_upload(body):
+    doctor_id = body.get('doctorID')
+    file_name = body.get('fileName')
+    content_type = body.get('contentType', 'audio/webm')
+
+    # Validate required fields
+    if not doctor_id or not file_name:
+        return _response(400, {'error': 'doctorID and fileName are required'})
+
+    file_key = _recording_key(doctor_id, file_name)
+    history_id, metadata = _upload_metadata(doctor_id, body)
+
+    # Generate pre-signed URL for PUT operation
+    presigned_url = s3_client.generate_presigned_url(
+        'put_object',
+        Params={
+            'Bucket': BUCKET_NAME,
+            'Key': file_key,
+            'ContentType': content_type,
+            'Metadata': metadata
+        },
+        ExpiresIn=EXPIRATION
+    )
+
+    return _response(200, {
+        'uploadURL': presigned_url,
+        'fileKey': file_key,
+        'historyID': history_id,
+        'uploadHeaders': _upload_headers(metadata),
+        'expiresIn': EXPIRATION,
+        'bucketName': BUCKET_NAME
+    })
+
+
+def handle_batch_upload(body):
+    """Presign one PUT per distinct file; entries sharing a contentHash share an upload"""
+    doctor_id = body.get('doctorID')
+    files = body.get('files') or []
+
+    if not doctor_id or not files:
+        return _response(400, {'error': 'doctorID and files are required'})
+    if len(files) > MAX_BATCH_FILES:
+        return _response(400, {'error': f'At most {MAX_BATCH_FILES} files per request'})
+    if any(not entry.get('fileName') for entry in files):
+        return _response(400, {'error': 'Every file needs a fileName'})
+
+    uploads = []
+    first_by_hash = {}
+    used_keys = set()
+
+    for index, entry in enumerate(files):
+        content_hash = entry.get('contentHash')
+
+        if content_hash and content_hash in first_by_hash:
+            original = uploads[first_by_hash[content_hash]]
+            uploads.append({**original, 'fileName': entry['fileName'], 'duplicateOf': first_by_hash[content_hash]})
+            continue
+
+        file_key = _recording_key(doctor_id, entry['fileName'])
+        # Same fileName twice in the same second would overwrite each other
+        if file_key in used_keys:
+            file_key = _recording_key(doctor_id, f"{index}_{entry['fileName']}")
+        used_keys.add(file_key)
+        history_id, metadata = _upload_metadata(doctor_id, entry)
+
+        presigned_url = s3_client.generate_presigned_url(
+            'put_object',
+            Params={
+                'Bucket': BUCKET_NAME,
+                'Key': file_key,
+                'ContentType': entry.get('contentType', 'audio/webm'),
+                'Metadata': metadata
+            },
+            ExpiresIn=EXPIRATION
+        )
+
+        if content_hash:
+            first_by_hash[content_hash] = index
+        uploads.append({
+            'fileName': entry['fileName'],
+            'uploadURL': presigned_url,
+            'fileKey': file_key,
+            'historyID': history_id,
+            'uploadHeaders': _upload_headers(metadata),
+            'contentHash': content_hash,
+            'duplicateOf': None
+        })
+
+    return _response(200, {
+        'uploads': uploads,
+        'expiresIn': EXPIRATION,
+        'bucketName': BUCKET_NAME
+    })
+
+
+def handle_create_multipart(body):
+    doctor_id = body.get('doctorID')
+    file_name = body.get('fileName')
+    content_type = body.get('contentType', 'audio/webm')
+
+    if not doctor_id or not file_name:
+        return _response(400, {'error': 'doctorID and fileName are required'})
+
+    file_key = _recording_key(doctor_id, file_name)
+    history_id, metadata = _upload_metadata(doctor_id, body)
+
+    # The metadata is set once here and carried to the completed object
+    upload = s3_client.create_multipart_upload(
+        Bucket=BUCKET_NAME,
+        Key=file_key,
+        ContentType=content_type,
+        Metadata=metadata
+    )
+
+    return _response(200, {
+        'uploadId': upload['UploadId'],
+        'fileKey': file_key,
+        'historyID': history_id,
+        'bucketName': BUCKET_NAME
+    })
+
+
+def handle_presign_parts(body):
+    doctor_id = body.get('doctorID')
+    file_key = body.get('fileKey')
+    upload_id = body.get('uploadId')
+    part_numbers = body.get('partNumbers') or []
+
+    if not upload_id or not part_numbers:
+        return _response(400, {'error': 'uploadId, fileKey and partNumbers are required'})
+    if not _owns_key(doctor_id, file_key):
+        return _response(403, {'error': 'fileKey does not belong to doctorID'})
+    if len(part_numbers) > MAX_PARTS_PER_REQUEST:
+        return _response(400, {'error': f'At most {MAX_PARTS_PER_REQUEST} parts per request'})
+
+    # Presigning is local signing, no S3 round trip per part
+    urls = {}
+    for part_number in part_numbers:
+        urls[str(part_number)] = s3_client.generate_presigned_url(
+            'upload_part',
+            Params={
+                'Bucket': BUCKET_NAME,
+                'Key': file_key,
+                'UploadId': upload_id,
+                'PartNumber': int(part_number)
+            },
+            ExpiresIn=EXPIRATION
+        )
+
+    return _response(200, {'partURLs': urls, 'expiresIn': EXPIRATION})
+
+
+def _list_uploaded_parts(file_key, upload_id):
+    parts = []
+    paginator = s3_client.get_paginator('list_parts')
+    for page in paginator.paginate(Bucket=BUCKET_NAME, Key=file_key, UploadId=upload_id):
+        for part in page.get('Parts', []):
+            parts.append({
+                'PartNumber': part['PartNumber'],
+                'ETag': part['ETag'],
+                'Size': part['Size']
+            })
+    return parts
+
+
+def handle_list_parts(body):
+    doctor_id = body.get('doctorID')
+    file_key = body.get('fileKey')
+    upload_id = body.get('uploadId')
+
+    if not upload_id:
+        return _response(400, {'error': 'uploadId and fileKey are required'})
+    if not _owns_key(doctor_id, file_key):
+        return _response(403, {'error': 'fileKey does not belong to doctorID'})
+
+    try:
+        parts = _list_uploaded_parts(file_key, upload_id)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchUpload':
+            return _response(404, {'error': 'Upload not found or already completed'})
+        raise
+
+    return _response(200, {
+        'parts': [{'partNumber': p['PartNumber'], 'size': p['Size']} for p in parts]
+    })
+
+
+def handle_complete_multipart(body):
+    doctor_id = body.get('doctorID')
+    file_key = body.get('fileKey')
+    upload_id = body.get('uploadId')
+
+    if not upload_id:
+        return _response(400, {'error': 'uploadId and fileKey are required'})
+    if not _owns_key(doctor_id, file_key):
+        return _response(403, {'error': 'fileKey does not belong to doctorID'})
+
+    # ETags come from S3 itself, so the browser does not need to read them
+    # from the part responses (they are not exposed through CORS)
+    try:
+        parts = _list_uploaded_parts(file_key, upload_id)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchUpload':
+            return _response(404, {'error': 'Upload not found or already completed'})
+        raise
+
+    expected_parts = body.get('partCount')
+    if not parts or (expected_parts and len(parts) != int(expected_parts)):
+        return _response(409, {
+            'error': 'Upload is missing parts',
+            'uploadedParts': [p['PartNumber'] for p in parts]
+        })
+
+    s3_client.complete_multipart_upload(
+        Bucket=BUCKET_NAME,
+        Key=file_key,
+        UploadId=upload_id,
+        MultipartUpload={
+            'Parts': [{'PartNumber': p['PartNumber'], 'ETag': p['ETag']} for p in parts]
+        }
+    )
+
+    return _response(200, {
+        'fileKey': file_key,
+        'bucketName': BUCKET_NAME,
+        'recordingURL': f"https://{BUCKET_NAME}.s3.amazonaws.com/{file_key}"
+    })
+
+
+def handle_abort_multipart(body):
+    doctor_id = body.get('doctorID')
+    file_key = body.get('fileKey')
+    upload_id = body.get('uploadId')
+
+    if not upload_id:
+        return _response(400, {'error': 'uploadId and fileKey are required'})
+    if not _owns_key(doctor_id, file_key):
+        return _response(403, {'error': 'fileKey does not belong to doctorID'})
+
+    s3_client.abort_multipart_upload(Bucket=BUCKET_NAME, Key=file_key, UploadId=upload_id)
+    return _response(200, {'aborted': True})
+
+
+ACTIONS = {
+    'batch': handle_batch_upload,
+    'createMultipart': handle_create_multipart,
+    'presignParts': handle_presign_parts,
+    'listParts': handle_list_parts,
+    'completeMultipart': handle_complete_multipart,
+    'abortMultipart': handle_abort_multipart,
+}
 
 
 def lambda_handler(event, context):
@@ -18,15 +322,34 @@ def lambda_handler(event, context):
     {
         "doctorID": "string",
         "fileName": "string",
-        "contentType": "audio/webm" | "audio/wav" | "audio/mp3" etc.
+        "contentType": "audio/webm" | "audio/wav" | "audio/mp3" etc.,
+        "patientID": "string" (optional),
+        "durationSeconds": number (optional),
+        "purpose": "recording" | "segment" (optional, segments don't start the pipeline),
+        "priority": "interactive" | "batch" (optional, pipeline priority of the history)
     }
 
     Returns:
     {
         "uploadURL": "https://...",
         "fileKey": "doctors/{doctorID}/recordings/{timestamp}_{fileName}",
+        "historyID": "string",  # history the upload creates once it lands in S3
+        "uploadHeaders": {"x-amz-meta-history-id": "...", ...},  # send with the PUT
         "expiresIn": 3600
     }
+
+    Batch issuance for queued recordings, one entry per input file in order.
+    Entries with the same contentHash get the first entry's upload and a
+    "duplicateOf" index, so the bytes are only sent once:
+    { "action": "batch", "doctorID", "files": [{ "fileName", "contentType", "contentHash", "patientID", "durationSeconds" }] }
+        -> { uploads: [{ fileName, uploadURL, fileKey, historyID, uploadHeaders, contentHash, duplicateOf }], expiresIn }
+
+    Resumable multipart uploads use an "action" field:
+    { "action": "createMultipart", "doctorID", "fileName", "contentType" } -> { uploadId, fileKey, historyID }
+    { "action": "presignParts", "doctorID", "fileKey", "uploadId", "partNumbers": [1, 2, ...] } -> { partURLs }
+    { "action": "listParts", "doctorID", "fileKey", "uploadId" } -> { parts: [{ partNumber, size }] }
+    { "action": "completeMultipart", "doctorID", "fileKey", "uploadId", "partCount" } -> { fileKey, recordingURL }
+    { "action": "abortMultipart", "doctorID", "fileKey", "uploadId" }
     """
     try:
         # Parse input
@@ -35,69 +358,19 @@ def lambda_handler(event, context):
         else:
             body = event.get('body', {})
 
-        doctor_id = body.get('doctorID')
-        file_name = body.get('fileName')
-        content_type = body.get('contentType', 'audio/webm')
-
-        # Validate required fields
-        if not doctor_id or not file_name:
-            return {
-                'statusCode': 400,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({'error': 'doctorID and fileName are required'})
-            }
-
-        # Generate unique file key with timestamp
-        timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
-        file_key = f"doctors/{doctor_id}/recordings/{timestamp}_{file_name}"
-
-        # Generate pre-signed URL for PUT operation
-        presigned_url = s3_client.generate_presigned_url(
-            'put_object',
-            Params={
-                'Bucket': BUCKET_NAME,
-                'Key': file_key,
-                'ContentType': content_type
-            },
-            ExpiresIn=EXPIRATION
-        )
+        action = body.get('action')
+        if action:
+            handler = ACTIONS.get(action)
+            if not handler:
+                return _response(400, {'error': f'Unknown action: {action}'})
+            return handler(body)
 
-        # Return success response
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({
-                'uploadURL': presigned_url,
-                'fileKey': file_key,
-                'expiresIn': EXPIRATION,
-                'bucketName': BUCKET_NAME
-            })
-        }
+        return handle_single_upload(body)
 
     except ClientError as e:
         print(f"AWS Error: {e}")
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Failed to generate pre-signed URL'})
-        }
+        return _response(500, {'error': 'Failed to generate pre-signed URL'})
 
     except Exception as e:
         print(f"Error: {e}")
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Internal server error'})
-        }
+        return _response(500, {'error': 'Internal server error'})
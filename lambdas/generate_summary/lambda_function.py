@@ -2,8 +2,15 @@ import os
 import json
 import boto3
 
+from rate_limiter import limited_call
+from circuit_breaker import CircuitOpen, circuit
+
 bedrock = boto3.client('bedrock-runtime', region_name='us-east-1')
 
+# Used while the primary model's circuit is open; another Anthropic model on
+# Bedrock, since the request format is the same. Empty fails fast instead.
+BEDROCK_FALLBACK_MODEL_ID = os.environ.get('BEDROCK_FALLBACK_MODEL_ID', '')
+
 SYSTEM_PROMPT = """Eres un asistente médico experto que analiza historias clínicas en español.
 Tu tarea es extraer información clave de una historia clínica en formato JSON.
 
@@ -32,6 +39,30 @@ IMPORTANTE:
 - Enfócate en el diagnóstico y plan de acción"""
 
 
+def invoke_model(model_id, request_body):
+    """Invoke a Bedrock model through its circuit breaker and the shared rate limiter"""
+    with circuit(f"bedrock#{model_id}"):
+        return limited_call(
+            'bedrock',
+            bedrock.invoke_model,
+            modelId=model_id,
+            contentType='application/json',
+            accept='application/json',
+            body=json.dumps(request_body)
+        )
+
+
+def invoke_with_fallback(model_id, request_body):
+    """The primary model, or the fallback model while the primary is unavailable"""
+    try:
+        return invoke_model(model_id, request_body)
+    except CircuitOpen as e:
+        if not BEDROCK_FALLBACK_MODEL_ID or BEDROCK_FALLBACK_MODEL_ID == model_id:
+            raise
+        print(f"[generate_summary] {e}; usando modelo de respaldo {BEDROCK_FALLBACK_MODEL_ID}")
+        return invoke_model(BEDROCK_FALLBACK_MODEL_ID, request_body)
+
+
 def lambda_handler(event, context):
     """
     Generate diagnosis and summary from medical record using AWS Bedrock
@@ -91,12 +122,7 @@ def lambda_handler(event, context):
         print(f"[generate_summary] Invocando Bedrock con modelo: {model_id}")
 
         # Invoke Bedrock
-        response = bedrock.invoke_model(
-            modelId=model_id,
-            contentType='application/json',
-            accept='application/json',
-            body=json.dumps(request_body)
-        )
+        response = invoke_with_fallback(model_id, request_body)
 
         # Parse response
         response_body = json.loads(response['body'].read())
@@ -177,6 +203,22 @@ def lambda_handler(event, context):
             'body': json.dumps(result)
         }
 
+    except CircuitOpen as e:
+        # Bedrock no disponible: fallar de inmediato en lugar de esperar el timeout
+        print(f"[generate_summary] Error: {e}")
+        return {
+            'statusCode': 503,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*',
+                'Retry-After': str(int(e.retry_after) + 1)
+            },
+            'body': json.dumps({
+                'error': 'Servicio de resúmenes no disponible temporalmente',
+                'details': str(e)
+            })
+        }
+
     except Exception as e:
         print(f"[generate_summary] Error: {e}")
         import traceback
@@ -0,0 +1,69 @@
+import os
+import json
+import boto3
+
+# Claim-check storage for pipeline artifacts (transcripts, generated notes).
+# An artifact is written once to S3 and only its reference, "s3://bucket/key",
+# travels between Lambdas or sits on DynamoDB items, so payload and item sizes
+# stay constant however long the consultation is.
+
+ARTIFACTS_BUCKET = os.getenv('ARTIFACTS_BUCKET', 'recordings-clinicalops')
+ARTIFACTS_PREFIX = 'artifacts'
+REF_SCHEME = 's3://'
+
+s3_client = boto3.client('s3')
+
+
+def is_ref(value):
+    return isinstance(value, str) and value.startswith(REF_SCHEME)
+
+
+def _split_ref(ref):
+    bucket, _, key = ref[len(REF_SCHEME):].partition('/')
+    return bucket, key
+
+
+def put_text(key, text, content_type='text/plain; charset=utf-8'):
+    """Store text under artifacts/{key} and return its reference"""
+    full_key = f"{ARTIFACTS_PREFIX}/{key}"
+    s3_client.put_object(
+        Bucket=ARTIFACTS_BUCKET,
+        Key=full_key,
+        Body=text.encode('utf-8'),
+        ContentType=content_type
+    )
+    return f"{REF_SCHEME}{ARTIFACTS_BUCKET}/{full_key}"
+
+
+def put_json(key, data):
+    return put_text(key, json.dumps(data, ensure_ascii=False), 'application/json')
+
+
+def resolve(value):
+    """Text behind a reference; values stored inline by older code pass through"""
+    if not is_ref(value):
+        return value
+    bucket, key = _split_ref(value)
+    return s3_client.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+
+
+def resolve_json(value):
+    if not is_ref(value):
+        return value
+    return json.loads(resolve(value))
+
+
+class LazyArtifact:
+    """Reference that is only fetched the first time its value is needed"""
+
+    def __init__(self, value):
+        self.ref = value if is_ref(value) else None
+        self._value = None if self.ref else value
+        self._loaded = self.ref is None
+
+    @property
+    def value(self):
+        if not self._loaded:
+            self._value = resolve(self.ref)
+            self._loaded = True
+        return self._value
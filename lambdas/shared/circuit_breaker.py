@@ -0,0 +1,332 @@
+import os
+import time
+import threading
+from decimal import Decimal
+from contextlib import contextmanager
+
+import boto3
+
+# Circuit breaker for calls to external AI providers (OpenAI, AssemblyAI, Bedrock).
+# When a provider is degraded every call would otherwise sit on its own timeout,
+# pinning Lambda concurrency on requests that are bound to fail. The breaker of
+# a provider is shared by every container of every Lambda calling it:
+#
+#   closed     calls go through; provider failures (5xx, timeouts, dropped
+#              connections) are counted, and CIRCUIT_FAILURE_THRESHOLD of them
+#              within CIRCUIT_WINDOW_SECONDS open the circuit
+#   open       calls fail at once with CircuitOpen until the cooldown ends
+#   half-open  after the cooldown a single call, claimed with a conditional
+#              write, goes through as the probe; success closes the circuit,
+#              failure opens it again with a doubled cooldown
+#
+# Client errors (4xx) and throttles say nothing about the provider's health and
+# are not counted; throttling is rate_limiter.py's job. Callers either fail fast
+# or take their fallback on CircuitOpen; in the recording pipeline it is a
+# transient error, so the history waits for its automatic retry (retries.py).
+#
+# The state shares the rate limiter's table (item "circuit#{provider}").
+# CIRCUIT_BACKEND=memory keeps it in the process, as a local stand-in.
+
+CIRCUIT_TABLE = os.getenv('CIRCUIT_TABLE', os.getenv('RATE_LIMIT_TABLE', 'provider-rate-limits'))
+CIRCUIT_BACKEND = os.getenv('CIRCUIT_BACKEND', os.getenv('RATE_LIMIT_BACKEND', 'dynamodb'))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_WINDOW_SECONDS = int(os.getenv('CIRCUIT_WINDOW_SECONDS', '60'))
+CIRCUIT_OPEN_SECONDS = int(os.getenv('CIRCUIT_OPEN_SECONDS', '30'))
+CIRCUIT_MAX_OPEN_SECONDS = int(os.getenv('CIRCUIT_MAX_OPEN_SECONDS', '600'))
+# A probe that never reports back (crashed container) is replaced after this long
+CIRCUIT_PROBE_SECONDS = int(os.getenv('CIRCUIT_PROBE_SECONDS', '120'))
+# How long a container trusts the state it last read
+CIRCUIT_CACHE_SECONDS = float(os.getenv('CIRCUIT_CACHE_SECONDS', '2'))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+FAILURE_ERROR_TYPES = {
+    'APITimeoutError', 'APIConnectionError', 'InternalServerError',
+    'TimeoutException', 'ConnectError', 'ConnectTimeout', 'ReadTimeout', 'RemoteProtocolError',
+    'EndpointConnectionError', 'ConnectTimeoutError', 'ReadTimeoutError'
+}
+FAILURE_ERROR_CODES = {
+    'ServiceUnavailable', 'ServiceUnavailableException', 'InternalServerError', 'InternalServerException',
+    'InternalFailure', 'ModelTimeoutException', 'ModelNotReadyException'
+}
+FAILURE_MESSAGES = ('internal server error', 'service unavailable', 'bad gateway', 'gateway timeout', 'timed out')
+# Raised by our own budgets before or instead of an answer: no outcome to record.
+# A probe that ends this way leaves its claim to expire (CIRCUIT_PROBE_SECONDS).
+UNRECORDED_ERROR_TYPES = {'DeadlineExceeded', 'StageTooLong', 'RateLimitTimeout'}
+
+
+class CircuitOpen(Exception):
+    """The provider is considered down; retry_after is the seconds until it is probed again"""
+
+    def __init__(self, provider, retry_after):
+        super().__init__(f"{provider} is unavailable (circuit open), retry in {retry_after:.0f}s")
+        self.provider = provider
+        self.retry_after = retry_after
+
+
+def is_provider_failure(error):
+    """True when the error points at the provider being down rather than at the request"""
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    if type(error).__name__ in FAILURE_ERROR_TYPES:
+        return True
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        if response.get('Error', {}).get('Code') in FAILURE_ERROR_CODES:
+            return True
+        status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    else:
+        status = getattr(error, 'status_code', None) or getattr(response, 'status_code', None)
+    if status and status >= 500:
+        return True
+    message = str(error).lower()
+    return any(marker in message for marker in FAILURE_MESSAGES)
+
+
+class DynamoDBCircuitStore:
+    """
+    Item: {limiterKey: circuit#provider, state, failures, windowStart, openUntil,
+    cooldown, probeUntil}. Transitions out of a state are conditional on it, so
+    concurrent containers agree on a single opening and a single probe.
+    """
+
+    def __init__(self, table_name):
+        kwargs = {}
+        if os.getenv('DYNAMODB_ENDPOINT_URL'):
+            kwargs['endpoint_url'] = os.getenv('DYNAMODB_ENDPOINT_URL')
+        self.table = boto3.resource('dynamodb', **kwargs).Table(table_name)
+        self.conflict = self.table.meta.client.exceptions.ConditionalCheckFailedException
+
+    @staticmethod
+    def _key(provider):
+        return {'limiterKey': f"circuit#{provider}"}
+
+    def load(self, provider):
+        item = self.table.get_item(Key=self._key(provider), ConsistentRead=True).get('Item') or {}
+        return {
+            'state': item.get('state', CLOSED),
+            'failures': int(item.get('failures', 0)),
+            'openUntil': float(item.get('openUntil', 0)),
+            'cooldown': float(item.get('cooldown', 0))
+        }
+
+    def count_failure(self, provider, now):
+        """Count a failure in the current window; returns the failures in it"""
+        item = self.table.update_item(
+            Key=self._key(provider),
+            UpdateExpression='ADD failures :one SET windowStart = if_not_exists(windowStart, :now)',
+            ExpressionAttributeValues={':one': 1, ':now': Decimal(str(round(now, 3)))},
+            ReturnValues='ALL_NEW'
+        )['Attributes']
+        if float(item['windowStart']) >= now - CIRCUIT_WINDOW_SECONDS:
+            return int(item['failures'])
+        # The window expired: this failure starts a new one
+        try:
+            self.table.update_item(
+                Key=self._key(provider),
+                UpdateExpression='SET failures = :one, windowStart = :now',
+                ConditionExpression='windowStart = :seen',
+                ExpressionAttributeValues={
+                    ':one': 1,
+                    ':now': Decimal(str(round(now, 3))),
+                    ':seen': item['windowStart']
+                }
+            )
+        except self.conflict:
+            pass
+        return 1
+
+    def open(self, provider, now, cooldown, from_states):
+        try:
+            self.table.update_item(
+                Key=self._key(provider),
+                UpdateExpression=(
+                    'SET #state = :open, openUntil = :until, cooldown = :cooldown, failures = :zero '
+                    'REMOVE windowStart, probeUntil'
+                ),
+                ConditionExpression='attribute_not_exists(#state) OR #state IN (' + ', '.join(
+                    f":from{index}" for index in range(len(from_states))
+                ) + ')',
+                ExpressionAttributeNames={'#state': 'state'},
+                ExpressionAttributeValues={
+                    ':open': OPEN,
+                    ':until': Decimal(str(round(now + cooldown, 3))),
+                    ':cooldown': Decimal(str(round(cooldown, 3))),
+                    ':zero': 0,
+                    **{f":from{index}": state for index, state in enumerate(from_states)}
+                }
+            )
+            return True
+        except self.conflict:
+            return False
+
+    def claim_probe(self, provider, now):
+        try:
+            self.table.update_item(
+                Key=self._key(provider),
+                UpdateExpression='SET #state = :half_open, probeUntil = :probe_until',
+                ConditionExpression=(
+                    '#state IN (:open, :half_open) AND openUntil <= :now '
+                    'AND (attribute_not_exists(probeUntil) OR probeUntil < :now)'
+                ),
+                ExpressionAttributeNames={'#state': 'state'},
+                ExpressionAttributeValues={
+                    ':open': OPEN,
+                    ':half_open': HALF_OPEN,
+                    ':now': Decimal(str(round(now, 3))),
+                    ':probe_until': Decimal(str(round(now + CIRCUIT_PROBE_SECONDS, 3)))
+                }
+            )
+            return True
+        except self.conflict:
+            return False
+
+    def close(self, provider):
+        self.table.put_item(Item={**self._key(provider), 'state': CLOSED, 'failures': 0})
+
+    def reset_failures(self, provider):
+        try:
+            self.table.update_item(
+                Key=self._key(provider),
+                UpdateExpression='SET failures = :zero REMOVE windowStart',
+                ConditionExpression='attribute_not_exists(#state) OR #state = :closed',
+                ExpressionAttributeNames={'#state': 'state'},
+                ExpressionAttributeValues={':zero': 0, ':closed': CLOSED}
+            )
+        except self.conflict:
+            pass
+
+
+class MemoryCircuitStore:
+    """Same contract as DynamoDBCircuitStore, limited to this process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.circuits = {}
+
+    def _circuit(self, provider):
+        return self.circuits.setdefault(provider, {'state': CLOSED, 'failures': 0, 'openUntil': 0, 'cooldown': 0})
+
+    def load(self, provider):
+        with self.lock:
+            return dict(self._circuit(provider))
+
+    def count_failure(self, provider, now):
+        with self.lock:
+            circuit = self._circuit(provider)
+            if circuit.get('windowStart', now) < now - CIRCUIT_WINDOW_SECONDS:
+                circuit['failures'] = 0
+                circuit['windowStart'] = now
+            circuit.setdefault('windowStart', now)
+            circuit['failures'] += 1
+            return circuit['failures']
+
+    def open(self, provider, now, cooldown, from_states):
+        with self.lock:
+            circuit = self._circuit(provider)
+            if circuit['state'] not in from_states:
+                return False
+            circuit.update(state=OPEN, openUntil=now + cooldown, cooldown=cooldown, failures=0)
+            circuit.pop('windowStart', None)
+            circuit.pop('probeUntil', None)
+            return True
+
+    def claim_probe(self, provider, now):
+        with self.lock:
+            circuit = self._circuit(provider)
+            if circuit['state'] == CLOSED or circuit['openUntil'] > now or circuit.get('probeUntil', 0) >= now:
+                return False
+            circuit.update(state=HALF_OPEN, probeUntil=now + CIRCUIT_PROBE_SECONDS)
+            return True
+
+    def close(self, provider):
+        with self.lock:
+            self.circuits[provider] = {'state': CLOSED, 'failures': 0, 'openUntil': 0, 'cooldown': 0}
+
+    def reset_failures(self, provider):
+        with self.lock:
+            circuit = self._circuit(provider)
+            if circuit['state'] == CLOSED:
+                circuit['failures'] = 0
+                circuit.pop('windowStart', None)
+
+
+if CIRCUIT_BACKEND == 'memory':
+    store = MemoryCircuitStore()
+else:
+    store = DynamoDBCircuitStore(CIRCUIT_TABLE)
+
+# provider -> (read at, state), see CIRCUIT_CACHE_SECONDS
+_cache = {}
+
+
+def _state(provider, now):
+    cached = _cache.get(provider)
+    if cached and now - cached[0] < CIRCUIT_CACHE_SECONDS:
+        return cached[1]
+    state = store.load(provider)
+    _cache[provider] = (now, state)
+    return state
+
+
+def _before_call(provider):
+    """Raise CircuitOpen unless the call may go through; True when it is the half-open probe"""
+    now = time.time()
+    state = _state(provider, now)
+    if state['state'] == CLOSED:
+        return False
+    if now < state['openUntil']:
+        raise CircuitOpen(provider, state['openUntil'] - now)
+    if store.claim_probe(provider, now):
+        _cache.pop(provider, None)
+        print(f"[circuit_breaker] {provider}: cooldown over, probing")
+        return True
+    # Another container is probing
+    raise CircuitOpen(provider, min(CIRCUIT_OPEN_SECONDS, CIRCUIT_PROBE_SECONDS))
+
+
+def _record_success(provider, probe):
+    if probe:
+        store.close(provider)
+        print(f"[circuit_breaker] {provider}: probe succeeded, circuit closed")
+    elif _cache.get(provider, (0, {}))[1].get('failures'):
+        store.reset_failures(provider)
+    else:
+        return
+    _cache.pop(provider, None)
+
+
+def _record_failure(provider, error, probe):
+    now = time.time()
+    if probe:
+        cooldown = min(CIRCUIT_MAX_OPEN_SECONDS, max(CIRCUIT_OPEN_SECONDS, 2 * _state(provider, now)['cooldown']))
+        store.open(provider, now, cooldown, (HALF_OPEN,))
+        print(f"[circuit_breaker] {provider}: probe failed ({error}), open for {cooldown:.0f}s")
+    elif store.count_failure(provider, now) >= CIRCUIT_FAILURE_THRESHOLD:
+        if store.open(provider, now, CIRCUIT_OPEN_SECONDS, (CLOSED,)):
+            print(f"[circuit_breaker] {provider}: {CIRCUIT_FAILURE_THRESHOLD} failures within "
+                  f"{CIRCUIT_WINDOW_SECONDS}s, open for {CIRCUIT_OPEN_SECONDS}s")
+    _cache.pop(provider, None)
+
+
+@contextmanager
+def circuit(provider):
+    """
+    Run the block as a call to the provider: fail fast with CircuitOpen while
+    its circuit is open, and report the outcome to the shared breaker.
+    """
+    probe = _before_call(provider)
+    try:
+        yield
+    except Exception as e:
+        if type(e).__name__ in UNRECORDED_ERROR_TYPES:
+            raise
+        if is_provider_failure(e):
+            _record_failure(provider, e, probe)
+        else:
+            # The provider answered, even if with an error for this request
+            _record_success(provider, probe)
+        raise
+    _record_success(provider, probe)
@@ -0,0 +1,106 @@
+import os
+import json
+import boto3
+
+# Deadline-aware pipeline stages. Before a stage starts its slow part it checks
+# the invocation's remaining time (context.get_remaining_time_in_millis())
+# against an estimate of how long that part takes. When it doesn't fit, the rest
+# of the stage is handed to a fresh invocation of the same function, which
+# starts with a full budget, instead of being killed by the hard timeout and
+# redone from scratch. A stage is only handed off when it fits in a fresh
+# invocation (FUNCTION_TIMEOUT_SECONDS, the function's configured timeout);
+# one that never fits fails with StageTooLong, which retries.py treats as
+# permanent. Every hand-off carries a counter so a stage that keeps missing its
+# estimate also ends in StageTooLong instead of bouncing forever.
+
+SAFETY_MARGIN_MS = int(os.getenv('DEADLINE_SAFETY_MARGIN_MS', '5000'))
+MAX_HANDOFFS = int(os.getenv('MAX_HANDOFFS', '3'))
+# Keep equal to the function's timeout in lambda_config.yml. Unset, the largest
+# remaining time this container has seen stands in for it.
+FUNCTION_TIMEOUT_MS = int(float(os.getenv('FUNCTION_TIMEOUT_SECONDS', '0')) * 1000) or None
+
+_largest_remaining_ms = 0
+
+lambda_client = boto3.client('lambda')
+
+
+class DeadlineExceeded(Exception):
+    """The stage doesn't fit in what is left of this invocation"""
+
+
+class StageTooLong(Exception):
+    """The stage doesn't fit in a whole invocation either; retrying won't help"""
+
+
+class StageEstimate:
+    """
+    Latency of a stage as fixed cost + cost per unit of input (characters,
+    seconds of audio). Seeded from configuration; warm containers refine the
+    per-unit cost from the latencies they observe.
+    """
+
+    def __init__(self, base_ms, per_unit_ms, smoothing=0.3):
+        self.base_ms = base_ms
+        self.per_unit_ms = per_unit_ms
+        self.smoothing = smoothing
+
+    def estimate(self, units):
+        return self.base_ms + self.per_unit_ms * units
+
+    def observe(self, units, elapsed_ms):
+        if units <= 0:
+            return
+        per_unit = max(0.0, (elapsed_ms - self.base_ms) / units)
+        self.per_unit_ms += self.smoothing * (per_unit - self.per_unit_ms)
+
+
+def remaining_ms(context):
+    """Time left in the invocation, or None outside Lambda"""
+    global _largest_remaining_ms
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    remaining = context.get_remaining_time_in_millis()
+    _largest_remaining_ms = max(_largest_remaining_ms, remaining)
+    return remaining
+
+
+def invocation_ms(context):
+    """Time a fresh invocation of this function starts with, or None outside Lambda"""
+    remaining = remaining_ms(context)
+    if remaining is None:
+        return None
+    return FUNCTION_TIMEOUT_MS or _largest_remaining_ms
+
+
+def has_time_for(context, estimate_ms):
+    remaining = remaining_ms(context)
+    return remaining is None or remaining - SAFETY_MARGIN_MS >= estimate_ms
+
+
+def fits_fresh_invocation(context, estimate_ms):
+    """Whether handing the stage off would give it enough time"""
+    full = invocation_ms(context)
+    return full is None or full - SAFETY_MARGIN_MS >= estimate_ms
+
+
+def call_budget_seconds(context):
+    """Timeout for a provider call so it returns before the invocation is killed"""
+    remaining = remaining_ms(context)
+    if remaining is None:
+        return None
+    return max(1.0, (remaining - SAFETY_MARGIN_MS) / 1000)
+
+
+def hand_off(context, body):
+    """Continue the stage in a fresh invocation of this function"""
+    handoffs = int(body.get('handoffs', 0)) + 1
+    if handoffs > MAX_HANDOFFS:
+        raise StageTooLong(f"Stage still unfinished after {MAX_HANDOFFS} hand-offs")
+
+    lambda_client.invoke(
+        FunctionName=context.function_name,
+        InvocationType='Event',
+        Payload=json.dumps({'body': json.dumps({**body, 'handoffs': handoffs})})
+    )
+    print(f"Handed off to a fresh invocation ({handoffs}/{MAX_HANDOFFS}) "
+          f"with {remaining_ms(context)}ms left")
@@ -0,0 +1,241 @@
+import os
+import time
+import uuid
+import random
+import threading
+from decimal import Decimal
+from contextlib import contextmanager
+
+import boto3
+
+# Shared limiter for calls to external AI providers (OpenAI, AssemblyAI, Bedrock).
+# Every container of every Lambda that calls a provider takes a token from the
+# provider's bucket (requests per minute) and, when a concurrency limit is set, a
+# slot (calls in flight) before calling it. The state lives in DynamoDB so a burst
+# of invocations is paced as a whole; callers wait for a token instead of being
+# throttled by the provider, and a throttle that still happens empties the bucket
+# so every container backs off together.
+#
+# RATE_LIMIT_BACKEND=memory keeps the state in the process, as a local stand-in
+# for tests and single-container runs.
+
+RATE_LIMIT_TABLE = os.getenv('RATE_LIMIT_TABLE', 'provider-rate-limits')
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'dynamodb')
+# Limits are per provider and shared by every Lambda calling it; 0 disables a limit
+RATE_LIMIT_PER_MINUTE = int(os.getenv('RATE_LIMIT_PER_MINUTE', '0'))
+RATE_LIMIT_BURST = int(os.getenv('RATE_LIMIT_BURST', '0')) or max(1, RATE_LIMIT_PER_MINUTE // 6)
+RATE_LIMIT_MAX_CONCURRENCY = int(os.getenv('RATE_LIMIT_MAX_CONCURRENCY', '0'))
+# How long a call may queue for a token or slot before giving up
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.getenv('RATE_LIMIT_MAX_WAIT_SECONDS', '60'))
+# Provider throttles that still get through are retried this many times
+RATE_LIMIT_THROTTLE_RETRIES = int(os.getenv('RATE_LIMIT_THROTTLE_RETRIES', '3'))
+# A slot held by a crashed container is freed after this long
+SLOT_LEASE_SECONDS = int(os.getenv('RATE_LIMIT_SLOT_LEASE_SECONDS', '900'))
+
+THROTTLE_ERROR_CODES = ('ThrottlingException', 'TooManyRequestsException', 'ServiceQuotaExceededException')
+
+
+class RateLimitTimeout(Exception):
+    """No token or slot became available within RATE_LIMIT_MAX_WAIT_SECONDS"""
+
+
+class DynamoDBLimiterStore:
+    """
+    Bucket item: {limiterKey: provider, tokens, refilledAt}, updated with an
+    optimistic check on refilledAt. Slot items: {limiterKey: provider#slot#n,
+    holder, expiresAt}, claimed with a conditional put.
+    """
+
+    def __init__(self, table_name):
+        kwargs = {}
+        if os.getenv('DYNAMODB_ENDPOINT_URL'):
+            kwargs['endpoint_url'] = os.getenv('DYNAMODB_ENDPOINT_URL')
+        self.table = boto3.resource('dynamodb', **kwargs).Table(table_name)
+        self.conflict = self.table.meta.client.exceptions.ConditionalCheckFailedException
+
+    def take_token(self, provider, per_minute, burst):
+        """Take one token; returns 0 when taken, otherwise the seconds to wait"""
+        now = time.time()
+        item = self.table.get_item(Key={'limiterKey': provider}, ConsistentRead=True).get('Item')
+        if item:
+            elapsed = max(0.0, now - float(item['refilledAt']))
+            tokens = min(burst, float(item['tokens']) + elapsed * per_minute / 60)
+        else:
+            tokens = burst
+
+        if tokens < 1:
+            return (1 - tokens) * 60 / per_minute
+
+        if item:
+            condition = 'refilledAt = :seen'
+            values = {':seen': item['refilledAt']}
+        else:
+            condition = 'attribute_not_exists(limiterKey)'
+            values = None
+        try:
+            kwargs = {
+                'Item': {
+                    'limiterKey': provider,
+                    'tokens': Decimal(str(round(tokens - 1, 4))),
+                    'refilledAt': Decimal(str(round(now, 4)))
+                },
+                'ConditionExpression': condition
+            }
+            if values:
+                kwargs['ExpressionAttributeValues'] = values
+            self.table.put_item(**kwargs)
+            return 0
+        except self.conflict:
+            # Another container took a token in between; try again right away
+            return 0.05
+
+    def drain(self, provider):
+        self.table.put_item(Item={
+            'limiterKey': provider,
+            'tokens': Decimal('0'),
+            'refilledAt': Decimal(str(round(time.time(), 4)))
+        })
+
+    def take_slot(self, provider, max_concurrency, holder):
+        now = int(time.time())
+        for slot in random.sample(range(max_concurrency), max_concurrency):
+            slot_key = f"{provider}#slot#{slot}"
+            try:
+                self.table.put_item(
+                    Item={'limiterKey': slot_key, 'holder': holder, 'expiresAt': now + SLOT_LEASE_SECONDS},
+                    ConditionExpression='attribute_not_exists(holder) OR expiresAt < :now',
+                    ExpressionAttributeValues={':now': now}
+                )
+                return slot_key
+            except self.conflict:
+                continue
+        return None
+
+    def release_slot(self, slot_key, holder):
+        try:
+            self.table.delete_item(
+                Key={'limiterKey': slot_key},
+                ConditionExpression='holder = :holder',
+                ExpressionAttributeValues={':holder': holder}
+            )
+        except self.conflict:
+            pass
+
+
+class MemoryLimiterStore:
+    """Same contract as DynamoDBLimiterStore, limited to this process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.slots = {}
+
+    def take_token(self, provider, per_minute, burst):
+        with self.lock:
+            now = time.time()
+            tokens, refilled_at = self.buckets.get(provider, (burst, now))
+            tokens = min(burst, tokens + (now - refilled_at) * per_minute / 60)
+            if tokens < 1:
+                self.buckets[provider] = (tokens, now)
+                return (1 - tokens) * 60 / per_minute
+            self.buckets[provider] = (tokens - 1, now)
+            return 0
+
+    def drain(self, provider):
+        with self.lock:
+            self.buckets[provider] = (0, time.time())
+
+    def take_slot(self, provider, max_concurrency, holder):
+        with self.lock:
+            now = time.time()
+            for slot in range(max_concurrency):
+                slot_key = f"{provider}#slot#{slot}"
+                current = self.slots.get(slot_key)
+                if current is None or current[1] < now:
+                    self.slots[slot_key] = (holder, now + SLOT_LEASE_SECONDS)
+                    return slot_key
+            return None
+
+    def release_slot(self, slot_key, holder):
+        with self.lock:
+            if self.slots.get(slot_key, (None,))[0] == holder:
+                del self.slots[slot_key]
+
+
+if RATE_LIMIT_BACKEND == 'memory':
+    store = MemoryLimiterStore()
+else:
+    store = DynamoDBLimiterStore(RATE_LIMIT_TABLE)
+
+
+def _wait(seconds, deadline, provider):
+    if time.time() + seconds > deadline:
+        raise RateLimitTimeout(f"{provider} rate limit: no capacity within {RATE_LIMIT_MAX_WAIT_SECONDS:.0f}s")
+    # Jitter spreads containers that woke up together
+    time.sleep(seconds * random.uniform(1.0, 1.3))
+
+
+@contextmanager
+def provider_slot(provider):
+    """Wait for a token and a concurrency slot of the provider, held for the block"""
+    deadline = time.time() + RATE_LIMIT_MAX_WAIT_SECONDS
+    started = time.time()
+
+    if RATE_LIMIT_PER_MINUTE > 0:
+        while True:
+            wait = store.take_token(provider, RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST)
+            if not wait:
+                break
+            _wait(wait, deadline, provider)
+
+    slot_key = None
+    holder = str(uuid.uuid4())
+    if RATE_LIMIT_MAX_CONCURRENCY > 0:
+        backoff = 0.2
+        while True:
+            slot_key = store.take_slot(provider, RATE_LIMIT_MAX_CONCURRENCY, holder)
+            if slot_key:
+                break
+            _wait(backoff, deadline, provider)
+            backoff = min(backoff * 2, 5)
+
+    queued_ms = int((time.time() - started) * 1000)
+    if queued_ms > 100:
+        print(f"[rate_limiter] {provider}: queued {queued_ms}ms for capacity")
+
+    try:
+        yield
+    finally:
+        if slot_key:
+            store.release_slot(slot_key, holder)
+
+
+def is_throttled(error):
+    """True for provider throttling (HTTP 429, Bedrock ThrottlingException, ...)"""
+    status = getattr(error, 'status_code', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+    if status == 429:
+        return True
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict) and response.get('Error', {}).get('Code') in THROTTLE_ERROR_CODES:
+        return True
+    message = str(error).lower()
+    return 'too many requests' in message or 'rate limit' in message
+
+
+def limited_call(provider, fn, *args, **kwargs):
+    """
+    Call fn through the provider's limiter. A throttle returned by the provider
+    empties the shared bucket and the call is retried with backoff instead of
+    failing the invocation.
+    """
+    for attempt in range(RATE_LIMIT_THROTTLE_RETRIES + 1):
+        with provider_slot(provider):
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if not is_throttled(e) or attempt == RATE_LIMIT_THROTTLE_RETRIES:
+                    raise
+                print(f"[rate_limiter] {provider} throttled the call (attempt {attempt + 1}): {e}")
+                if RATE_LIMIT_PER_MINUTE > 0:
+                    store.drain(provider)
+        time.sleep(min(2 ** attempt, 20) * random.uniform(0.5, 1.5))
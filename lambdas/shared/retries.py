@@ -0,0 +1,156 @@
+import os
+import random
+from datetime import datetime, timedelta
+
+# Failed pipeline stages are classified before the history is failed.
+# Transient errors (provider 429/5xx, timeouts, dropped connections, throttled
+# AWS calls) are retried automatically: the history stays in flight with
+# retryState "scheduled" and a retryAt drawn with full-jitter exponential
+# backoff, and stuck_history_sweeper resumes it from its last checkpoint once
+# it is due (sparse GSI retryState-retryAt-index). The jitter spreads the
+# histories that failed together during a provider incident instead of sending
+# them back at once. Permanent errors, and transient ones that used up
+# MAX_AUTO_RETRIES, fail the history; the orchestrator then files it in the
+# dead-letter store, from which it can be redriven in bulk.
+#
+# Shared by the pipeline Lambdas (lambdas/shared, see README.md).
+
+MAX_AUTO_RETRIES = int(os.getenv('MAX_AUTO_RETRIES', '4'))
+RETRY_BASE_SECONDS = int(os.getenv('RETRY_BASE_SECONDS', '30'))
+RETRY_MAX_SECONDS = int(os.getenv('RETRY_MAX_SECONDS', '900'))
+
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+RETRY_SCHEDULED = 'scheduled'
+
+TRANSIENT_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504, 529}
+# botocore error codes
+TRANSIENT_ERROR_CODES = {
+    'Throttling', 'ThrottlingException', 'TooManyRequestsException', 'RequestLimitExceeded',
+    'ProvisionedThroughputExceededException', 'ServiceUnavailable', 'ServiceUnavailableException',
+    'InternalServerError', 'InternalFailure', 'ModelNotReadyException', 'ModelTimeoutException'
+}
+# Exception types matched by name so this module doesn't import the SDKs
+TRANSIENT_ERROR_TYPES = {
+    'APITimeoutError', 'APIConnectionError', 'RateLimitError', 'InternalServerError',
+    'TimeoutException', 'ConnectError', 'ConnectTimeout', 'ReadTimeout', 'RemoteProtocolError',
+    'EndpointConnectionError', 'ConnectTimeoutError', 'ReadTimeoutError',
+    'DeadlineExceeded', 'RateLimitTimeout', 'CircuitOpen'
+}
+# Errors that retrying can't fix, whatever they were raised from
+PERMANENT_ERROR_TYPES = {'StageTooLong'}
+# AssemblyAI reports failed jobs as plain errors with the provider's message
+TRANSIENT_MESSAGES = (
+    'timed out', 'timeout', 'rate limit', 'too many requests', 'temporarily unavailable',
+    'service unavailable', 'internal server error', 'bad gateway', 'connection reset'
+)
+
+
+def _status_code(error):
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        response = getattr(error, 'response', None)
+        if isinstance(response, dict):
+            status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        else:
+            status = getattr(response, 'status_code', None)
+    return status
+
+
+def _is_transient(error):
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    if type(error).__name__ in TRANSIENT_ERROR_TYPES:
+        return True
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict) and response.get('Error', {}).get('Code') in TRANSIENT_ERROR_CODES:
+        return True
+    if _status_code(error) in TRANSIENT_STATUS_CODES:
+        return True
+    message = str(error).lower()
+    return any(marker in message for marker in TRANSIENT_MESSAGES)
+
+
+def classify_error(error):
+    """TRANSIENT if the error, or one it was raised from, is worth retrying later"""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if type(error).__name__ in PERMANENT_ERROR_TYPES:
+            return PERMANENT
+        if _is_transient(error):
+            return TRANSIENT
+        error = error.__cause__ or error.__context__
+    return PERMANENT
+
+
+def backoff_seconds(retry_count):
+    """Full jitter: uniform over [0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2^retry_count)]"""
+    return random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** retry_count))
+
+
+def record_failure(table, history_id, error, message, lease_attribute=None):
+    """
+    Record a failed pipeline stage on the history: a scheduled retry for a
+    transient error with retries left, a failed history otherwise. The stage's
+    lease (lease_attribute) is dropped either way. Returns the error class.
+    """
+    error_class = classify_error(error)
+    now = datetime.utcnow()
+    updated = now.isoformat() + 'Z'
+    lease = f", {lease_attribute}" if lease_attribute else ''
+
+    if error_class == TRANSIENT:
+        item = table.get_item(
+            Key={'historyID': history_id},
+            ProjectionExpression='retryCount'
+        ).get('Item') or {}
+        retry_count = int(item.get('retryCount', 0))
+        if retry_count < MAX_AUTO_RETRIES:
+            # Never before the provider is tried again (circuit_breaker.CircuitOpen)
+            delay = max(backoff_seconds(retry_count), getattr(error, 'retry_after', 0) or 0)
+            retry_at = (now + timedelta(seconds=delay)).isoformat() + 'Z'
+            try:
+                table.update_item(
+                    Key={'historyID': history_id},
+                    UpdateExpression=(
+                        'SET #status = :status, inFlightStatus = :status, retryState = :scheduled, retryAt = :retry_at, '
+                        'retryCount = :count, lastError = :error, errorClass = :class, updatedAt = :updated '
+                        f'REMOVE errorMessage{lease}'
+                    ),
+                    ConditionExpression='attribute_not_exists(retryCount) OR retryCount = :seen',
+                    ExpressionAttributeNames={'#status': 'status'},
+                    ExpressionAttributeValues={
+                        ':status': 'processing',
+                        ':scheduled': RETRY_SCHEDULED,
+                        ':retry_at': retry_at,
+                        ':count': retry_count + 1,
+                        ':seen': retry_count,
+                        ':error': message,
+                        ':class': error_class,
+                        ':updated': updated
+                    }
+                )
+                print(f"History {history_id} will retry at {retry_at} "
+                      f"({retry_count + 1}/{MAX_AUTO_RETRIES}): {message}")
+                return error_class
+            except table.meta.client.exceptions.ConditionalCheckFailedException:
+                # Another failure of the same history scheduled the retry already
+                return error_class
+
+    table.update_item(
+        Key={'historyID': history_id},
+        UpdateExpression=(
+            'SET #status = :status, pipelineStage = :stage, errorMessage = :error, errorClass = :class, '
+            f'updatedAt = :updated REMOVE inFlightStatus, retryState, retryAt{lease}'
+        ),
+        ExpressionAttributeNames={'#status': 'status'},
+        ExpressionAttributeValues={
+            ':status': 'failed',
+            ':stage': 'failed',
+            ':error': message,
+            ':class': error_class,
+            ':updated': updated
+        }
+    )
+    return error_class
@@ -0,0 +1,15 @@
+import hashlib
+
+# A doctor's style profile (see extract_format's "style_profile" task) is
+# distilled from their example history, and the doctors item keeps the hash of
+# that example next to it as style_profile_example_hash. A profile is only used
+# while the hash still matches the current example, so every Lambda that writes
+# or checks it must hash the same way: change it here only, and expect every
+# stored profile to be recomputed (backfill_style_profiles) when you do.
+#
+# Shared by the Lambdas that store or read style profiles (lambdas/shared, see README.md).
+
+
+def example_hash(example_history_text):
+    """Identifies the example a style profile was distilled from"""
+    return hashlib.sha256(example_history_text.encode('utf-8')).hexdigest()[:16]
@@ -0,0 +1,67 @@
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CircuitOpen, circuit
+
+
+class ProviderDown(Exception):
+    status_code = 503
+
+
+class BadRequest(Exception):
+    status_code = 400
+
+
+@pytest.fixture(autouse=True)
+def fresh_breaker(monkeypatch):
+    clock = {'now': 1000.0}
+    monkeypatch.setattr(circuit_breaker, 'store', circuit_breaker.MemoryCircuitStore())
+    monkeypatch.setattr(circuit_breaker, '_cache', {})
+    monkeypatch.setattr(circuit_breaker.time, 'time', lambda: clock['now'])
+    return clock
+
+
+def fail(provider, error):
+    with pytest.raises(type(error)):
+        with circuit(provider):
+            raise error
+
+
+def test_opens_after_threshold_failures():
+    for _ in range(circuit_breaker.CIRCUIT_FAILURE_THRESHOLD):
+        fail('openai', ProviderDown())
+    with pytest.raises(CircuitOpen) as raised:
+        with circuit('openai'):
+            pass
+    assert raised.value.retry_after > 0
+
+
+def test_client_errors_do_not_count():
+    for _ in range(circuit_breaker.CIRCUIT_FAILURE_THRESHOLD * 2):
+        fail('openai', BadRequest())
+    with circuit('openai'):
+        pass
+
+
+def test_probe_closes_or_reopens_with_doubled_cooldown(fresh_breaker):
+    for _ in range(circuit_breaker.CIRCUIT_FAILURE_THRESHOLD):
+        fail('assemblyai', ProviderDown())
+
+    fresh_breaker['now'] += circuit_breaker.CIRCUIT_OPEN_SECONDS + 1
+    fail('assemblyai', ProviderDown())
+    assert circuit_breaker.store.load('assemblyai')['cooldown'] == 2 * circuit_breaker.CIRCUIT_OPEN_SECONDS
+
+    fresh_breaker['now'] += 2 * circuit_breaker.CIRCUIT_OPEN_SECONDS + 1
+    with circuit('assemblyai'):
+        pass
+    assert circuit_breaker.store.load('assemblyai')['state'] == circuit_breaker.CLOSED
+
+
+def test_own_deadlines_are_not_recorded():
+    class DeadlineExceeded(Exception):
+        pass
+
+    for _ in range(circuit_breaker.CIRCUIT_FAILURE_THRESHOLD * 2):
+        fail('openai', DeadlineExceeded())
+    with circuit('openai'):
+        pass
@@ -0,0 +1,53 @@
+import pytest
+
+import deadline
+
+
+class Context:
+    function_name = 'transcribe'
+
+    def __init__(self, remaining_ms):
+        self.remaining = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining
+
+
+def test_estimate_learns_per_unit_cost():
+    estimate = deadline.StageEstimate(base_ms=1000, per_unit_ms=1, smoothing=0.5)
+    estimate.observe(1000, 5000)
+    assert estimate.per_unit_ms == 2.5
+    assert estimate.estimate(1000) == 3500
+
+
+def test_has_time_for_keeps_the_safety_margin():
+    margin = deadline.SAFETY_MARGIN_MS
+    assert deadline.has_time_for(Context(margin + 1000), 1000)
+    assert not deadline.has_time_for(Context(margin + 999), 1000)
+    assert deadline.has_time_for(None, 10 ** 9)
+
+
+def test_call_budget_stops_before_the_timeout():
+    assert deadline.call_budget_seconds(Context(deadline.SAFETY_MARGIN_MS + 30000)) == 30
+    assert deadline.call_budget_seconds(Context(0)) == 1.0
+    assert deadline.call_budget_seconds(None) is None
+
+
+def test_fits_fresh_invocation_uses_the_function_timeout(monkeypatch):
+    monkeypatch.setattr(deadline, 'FUNCTION_TIMEOUT_MS', 120000)
+    margin = deadline.SAFETY_MARGIN_MS
+    assert deadline.fits_fresh_invocation(Context(1000), 120000 - margin)
+    assert not deadline.fits_fresh_invocation(Context(1000), 120000 - margin + 1)
+    assert deadline.fits_fresh_invocation(None, 10 ** 9)
+
+
+def test_fresh_invocation_falls_back_to_the_largest_remaining_seen(monkeypatch):
+    monkeypatch.setattr(deadline, 'FUNCTION_TIMEOUT_MS', None)
+    monkeypatch.setattr(deadline, '_largest_remaining_ms', 0)
+    deadline.remaining_ms(Context(90000))
+    assert deadline.invocation_ms(Context(1000)) == 90000
+
+
+def test_hand_off_gives_up_with_a_permanent_error():
+    with pytest.raises(deadline.StageTooLong):
+        deadline.hand_off(Context(1000), {'historyID': 'h1', 'handoffs': deadline.MAX_HANDOFFS})
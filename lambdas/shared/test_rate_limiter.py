@@ -0,0 +1,54 @@
+import pytest
+
+import rate_limiter
+
+
+class Throttled(Exception):
+    status_code = 429
+
+
+@pytest.fixture(autouse=True)
+def memory_store(monkeypatch):
+    monkeypatch.setattr(rate_limiter, 'store', rate_limiter.MemoryLimiterStore())
+    monkeypatch.setattr(rate_limiter.time, 'sleep', lambda seconds: None)
+
+
+def test_bucket_holds_burst_then_asks_to_wait():
+    store = rate_limiter.store
+    assert all(store.take_token('openai', 60, 3) == 0 for _ in range(3))
+    assert store.take_token('openai', 60, 3) > 0
+
+
+def test_slots_are_bounded_and_released():
+    store = rate_limiter.store
+    first = store.take_slot('openai', 1, 'a')
+    assert first and store.take_slot('openai', 1, 'b') is None
+    store.release_slot(first, 'b')
+    assert store.take_slot('openai', 1, 'b') is None
+    store.release_slot(first, 'a')
+    assert store.take_slot('openai', 1, 'b')
+
+
+def test_throttles_are_retried():
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise Throttled('Too Many Requests')
+        return 'ok'
+
+    assert rate_limiter.limited_call('openai', flaky) == 'ok'
+    assert len(calls) == 3
+
+
+def test_other_errors_are_not_retried():
+    calls = []
+
+    def broken():
+        calls.append(1)
+        raise ValueError('bad request')
+
+    with pytest.raises(ValueError):
+        rate_limiter.limited_call('openai', broken)
+    assert len(calls) == 1
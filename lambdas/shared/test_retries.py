@@ -0,0 +1,54 @@
+import deadline
+import retries
+
+
+class ProviderError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class ThrottledClientError(Exception):
+    response = {'Error': {'Code': 'ThrottlingException'}, 'ResponseMetadata': {'HTTPStatusCode': 400}}
+
+
+class CircuitOpen(Exception):
+    retry_after = 30
+
+
+def test_provider_overload_is_transient():
+    assert retries.classify_error(ProviderError('overloaded', status_code=529)) == retries.TRANSIENT
+    assert retries.classify_error(ThrottledClientError()) == retries.TRANSIENT
+    assert retries.classify_error(TimeoutError()) == retries.TRANSIENT
+    assert retries.classify_error(CircuitOpen()) == retries.TRANSIENT
+
+
+def test_bad_request_is_permanent():
+    assert retries.classify_error(ProviderError('invalid audio', status_code=400)) == retries.PERMANENT
+    assert retries.classify_error(ValueError('No audio detected')) == retries.PERMANENT
+
+
+def test_cause_is_classified():
+    try:
+        try:
+            raise ConnectionError('reset by peer')
+        except ConnectionError as e:
+            raise RuntimeError('Transcription failed') from e
+    except RuntimeError as error:
+        assert retries.classify_error(error) == retries.TRANSIENT
+
+
+def test_stage_too_long_is_permanent_whatever_it_was_raised_from():
+    try:
+        try:
+            raise deadline.DeadlineExceeded('1000ms left, generation needs ~20000ms')
+        except deadline.DeadlineExceeded:
+            raise deadline.StageTooLong('Stage still unfinished after 3 hand-offs')
+    except deadline.StageTooLong as error:
+        assert retries.classify_error(error) == retries.PERMANENT
+
+
+def test_backoff_is_capped_full_jitter():
+    for retry_count in range(10):
+        ceiling = min(retries.RETRY_MAX_SECONDS, retries.RETRY_BASE_SECONDS * 2 ** retry_count)
+        assert all(0 <= retries.backoff_seconds(retry_count) <= ceiling for _ in range(50))
@@ -0,0 +1,7 @@
+import style_profile
+
+
+def test_example_hash_is_stable():
+    # Stored on every doctors item with a profile: a different value here
+    # invalidates all of them
+    assert style_profile.example_hash('Paciente de 45 años que consulta por cefalea.') == '7a9e3531e7bfbe0d'
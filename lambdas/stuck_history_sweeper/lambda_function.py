@@ -0,0 +1,179 @@
+import os
+import json
+import boto3
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from boto3.dynamodb.conditions import Key
+
+HISTORIES_TABLE = os.getenv('HISTORIES_TABLE', 'medical-histories')
+IN_FLIGHT_INDEX = os.getenv('IN_FLIGHT_INDEX', 'inFlightStatus-updatedAt-index')
+# Histories waiting for an automatic retry after a transient error (retries.py
+# in the pipeline Lambdas), by the time it is due
+RETRY_INDEX = os.getenv('RETRY_INDEX', 'retryState-retryAt-index')
+CREATE_HISTORY_LAMBDA = os.getenv('CREATE_HISTORY_LAMBDA', 'create_medical_history_from_recording')
+
+# A history is stuck once it has made no progress for this long. Keep it above
+# the workers' STAGE_LEASE_SECONDS so a requeued step can take the lease over.
+STUCK_AFTER_MINUTES = int(os.getenv('STUCK_AFTER_MINUTES', '20'))
+# Live recording sessions stay pending while the consultation goes on
+RECORDING_STUCK_AFTER_HOURS = int(os.getenv('RECORDING_STUCK_AFTER_HOURS', '6'))
+# Requeues before a history is failed for good
+MAX_PIPELINE_ATTEMPTS = int(os.getenv('MAX_PIPELINE_ATTEMPTS', '3'))
+REQUEUE_BATCH_SIZE = int(os.getenv('REQUEUE_BATCH_SIZE', '25'))
+
+IN_FLIGHT_STATUSES = ('pending', 'processing')
+
+dynamodb = boto3.resource('dynamodb')
+histories_table = dynamodb.Table(HISTORIES_TABLE)
+lambda_client = boto3.client('lambda')
+
+
+def _timestamp(moment):
+    return moment.isoformat() + 'Z'
+
+
+def query_stale(status, cutoff):
+    """In-flight histories of one status not updated since cutoff, from the sparse index"""
+    items = []
+    query_kwargs = {
+        'IndexName': IN_FLIGHT_INDEX,
+        'KeyConditionExpression': Key('inFlightStatus').eq(status) & Key('updatedAt').lt(cutoff)
+    }
+    while True:
+        response = histories_table.query(**query_kwargs)
+        items.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return items
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def query_due_retries(now):
+    """Histories whose scheduled retry is due, from the sparse retry index"""
+    items = []
+    query_kwargs = {
+        'IndexName': RETRY_INDEX,
+        'KeyConditionExpression': Key('retryState').eq('scheduled') & Key('retryAt').lte(_timestamp(now))
+    }
+    while True:
+        response = histories_table.query(**query_kwargs)
+        items.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return items
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def fail_history(history, reason):
+    """Mark a stuck history failed, unless it made progress since it was read"""
+    try:
+        histories_table.update_item(
+            Key={'historyID': history['historyID']},
+            UpdateExpression=(
+                'SET #status = :status, pipelineStage = :stage, errorMessage = :error, errorClass = :class, '
+                'updatedAt = :updated REMOVE inFlightStatus'
+            ),
+            ConditionExpression='updatedAt = :seen',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={
+                ':status': 'failed',
+                ':stage': 'failed',
+                ':error': reason,
+                ':class': 'stalled',
+                ':updated': _timestamp(datetime.utcnow()),
+                ':seen': history['updatedAt']
+            }
+        )
+        return True
+    except histories_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+def requeue_histories(histories):
+    """Hand the histories to the pipeline's bulk requeue action, a batch per invocation"""
+    for start in range(0, len(histories), REQUEUE_BATCH_SIZE):
+        batch = histories[start:start + REQUEUE_BATCH_SIZE]
+        lambda_client.invoke(
+            FunctionName=CREATE_HISTORY_LAMBDA,
+            InvocationType='Event',
+            Payload=json.dumps({'body': json.dumps({
+                'action': 'requeue',
+                'histories': [{'historyID': h['historyID'], 'updatedAt': h['updatedAt']} for h in batch]
+            })})
+        )
+
+
+def dispatch_queue():
+    """Nudge the scheduler, in case the release that should have admitted the next histories was lost"""
+    lambda_client.invoke(
+        FunctionName=CREATE_HISTORY_LAMBDA,
+        InvocationType='Event',
+        Payload=json.dumps({'body': json.dumps({'action': 'dispatch'})})
+    )
+
+
+def sweep(now=None):
+    now = now or datetime.utcnow()
+    cutoff = _timestamp(now - timedelta(minutes=STUCK_AFTER_MINUTES))
+    recording_cutoff = _timestamp(now - timedelta(hours=RECORDING_STUCK_AFTER_HOURS))
+
+    to_requeue = query_due_retries(now)
+    retries = len(to_requeue)
+    failed = 0
+
+    for status in IN_FLIGHT_STATUSES:
+        for history in query_stale(status, cutoff):
+            stage = history.get('pipelineStage')
+            attempts = int(history.get('pipelineAttempt', Decimal(0)))
+
+            if str(history.get('scheduleLane', '')).startswith('waiting') or history.get('retryState'):
+                # Waiting for its turn in the fair queue or for its retry, not stuck
+                continue
+
+            if stage == 'recording':
+                # An open session is only abandoned after the longer threshold
+                if history['updatedAt'] < recording_cutoff:
+                    failed += fail_history(history, 'Recording session was never finished')
+                continue
+
+            if attempts >= MAX_PIPELINE_ATTEMPTS:
+                failed += fail_history(
+                    history,
+                    f"Processing stalled in stage '{stage}' after {attempts} attempts"
+                )
+            else:
+                to_requeue.append(history)
+
+    requeue_histories(to_requeue)
+    dispatch_queue()
+    return {'requeued': len(to_requeue) - retries, 'retried': retries, 'failed': failed}
+
+
+def lambda_handler(event, context):
+    """
+    Scheduled sweep of histories stuck in pending/processing.
+
+    Queries the sparse GSI inFlightStatus-updatedAt-index, which only holds
+    in-flight histories, for those without progress for STUCK_AFTER_MINUTES.
+    They are requeued in bulk from their last checkpoint, or failed once they
+    used MAX_PIPELINE_ATTEMPTS. Live sessions never finished are failed after
+    RECORDING_STUCK_AFTER_HOURS. Histories waiting in the fair queue are left
+    alone, and the scheduler is nudged to admit more. Histories whose automatic
+    retry is due (sparse GSI retryState-retryAt-index) are requeued with them.
+    Never scans the table.
+    """
+    try:
+        result = sweep()
+        print(f"Sweep finished: {result}")
+        return {
+            'statusCode': 200,
+            'body': json.dumps(result)
+        }
+
+    except Exception as e:
+        print(f"Error: {e}")
+        import traceback
+        traceback.print_exc()
+        return {
+            'statusCode': 500,
+            'body': json.dumps({'error': 'Internal server error', 'details': str(e)})
+        }
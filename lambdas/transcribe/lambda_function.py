@@ -1,18 +1,109 @@
 import os
 import json
+import time
+import uuid
+import hashlib
+import boto3
 import assemblyai as aai
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, unquote, urlencode
+
+from artifacts import put_text, resolve
+from rate_limiter import limited_call
+from circuit_breaker import CircuitOpen, circuit
+from retries import record_failure
+from deadline import has_time_for, hand_off
 
 ASSEMBLY_KEY = os.getenv("ASSEMBLY_KEY")
+HISTORIES_TABLE = os.getenv("HISTORIES_TABLE", "medical-histories")
+TRANSCRIPTION_CACHE_TABLE = os.getenv("TRANSCRIPTION_CACHE_TABLE", "transcription-cache")
+TRANSCRIPTION_CACHE_TTL_DAYS = int(os.getenv("TRANSCRIPTION_CACHE_TTL_DAYS", "30"))
+RECORDINGS_BUCKET = os.getenv("RECORDINGS_BUCKET", "recordings-clinicalops")
+RECORDINGS_DOMAIN = os.getenv("RECORDINGS_DOMAIN", "storage.clinicalops.co")
 
-def transcribe_audio(audio_url, diarization):
-    aai.settings.api_key = ASSEMBLY_KEY
+# Long-audio mode: recordings above the threshold are transcribed as overlapping chunks in parallel
+LONG_AUDIO_THRESHOLD_MS = int(os.getenv("LONG_AUDIO_THRESHOLD_SECONDS", "900")) * 1000
+CHUNK_DURATION_MS = int(os.getenv("CHUNK_DURATION_SECONDS", "300")) * 1000
+CHUNK_OVERLAP_MS = int(os.getenv("CHUNK_OVERLAP_SECONDS", "20")) * 1000
+MAX_PARALLEL_CHUNKS = int(os.getenv("MAX_PARALLEL_CHUNKS", "8"))
+
+# Asynchronous mode: pipeline transcriptions are submitted with a webhook to
+# transcription_webhook instead of being polled. The webhook rejects calls
+# without its secret, so the mode needs both settings. ASSEMBLYAI_BASE_URL
+# points the SDK at a local stand-in of the provider API.
+TRANSCRIPTION_WEBHOOK_URL = os.getenv("TRANSCRIPTION_WEBHOOK_URL", "")
+TRANSCRIPTION_WEBHOOK_SECRET = os.getenv("TRANSCRIPTION_WEBHOOK_SECRET", "")
+WEBHOOK_AUTH_HEADER = "X-Webhook-Secret"
+if os.getenv("ASSEMBLYAI_BASE_URL"):
+    aai.settings.base_url = os.getenv("ASSEMBLYAI_BASE_URL")
+
+NO_AUDIO_MESSAGE = "No se detectó audio en la grabación. El archivo puede estar vacío o en silencio."
+
+# Lambda retries async events and the stream can redeliver a stage, so the same
+# step can be invoked more than once. A worker leases its step on the history
+# item before doing any paid work; duplicates find it leased or done and are
+# dropped. A lease outlives the worker timeout, so a crashed run can be taken over.
+STAGE_LEASE_SECONDS = int(os.getenv("STAGE_LEASE_SECONDS", "900"))
+
+# Without a webhook the pipeline still submits its jobs and then polls them here,
+# but only while the invocation has time for another poll and the collection;
+# past that a fresh invocation takes the polling over (see deadline.py). The
+# jobs keep running at AssemblyAI, so nothing is transcribed twice.
+TRANSCRIPTION_POLL_SECONDS = int(os.getenv("TRANSCRIPTION_POLL_SECONDS", "3"))
+COLLECT_ESTIMATE_MS = int(os.getenv("COLLECT_ESTIMATE_MS", "10000"))
+
+# Bump when the transcription settings, the text layout or the entry format change so old entries stop matching
+TRANSCRIPTION_CACHE_VERSION = 3
+
+s3_client = boto3.client('s3')
+dynamodb = boto3.resource('dynamodb')
+histories_table = dynamodb.Table(HISTORIES_TABLE)
+cache_table = dynamodb.Table(TRANSCRIPTION_CACHE_TABLE)
+
+# First invocation of this container, reported with the stage timing
+_cold_start = True
+
+
+def webhook_enabled():
+    return bool(TRANSCRIPTION_WEBHOOK_URL and TRANSCRIPTION_WEBHOOK_SECRET)
 
+
+def stage_timing(body, cold_start):
+    """Dispatch-to-start latency of a pipeline stage (invoke hop plus cold start)"""
+    timing = {'coldStart': cold_start}
+    if body.get('dispatchedAt'):
+        timing['dispatchMs'] = max(0, int(time.time() * 1000) - int(body['dispatchedAt']))
+    return timing
+
+
+def assemblyai_call(fn, *args):
+    """Call AssemblyAI through its circuit breaker and the shared rate limiter"""
+    with circuit('assemblyai'):
+        return limited_call('assemblyai', fn, *args)
+
+
+def build_transcription_config(diarization, audio_start_from=None, audio_end_at=None):
     if diarization:
-        config = aai.TranscriptionConfig(speech_model=aai.SpeechModel.universal, speaker_labels=diarization, language_code="es", speakers_expected=2)
-    else:
-        config = aai.TranscriptionConfig(speech_model=aai.SpeechModel.universal, language_code="es")
+        return aai.TranscriptionConfig(speech_model=aai.SpeechModel.universal, speaker_labels=diarization, language_code="es", speakers_expected=2,
+                                       audio_start_from=audio_start_from, audio_end_at=audio_end_at)
+    return aai.TranscriptionConfig(speech_model=aai.SpeechModel.universal, language_code="es",
+                                   audio_start_from=audio_start_from, audio_end_at=audio_end_at)
+
+
+def transcribe_audio(audio_url, diarization, audio_duration_ms=None):
+    aai.settings.api_key = ASSEMBLY_KEY
+
+    if audio_duration_ms and audio_duration_ms > LONG_AUDIO_THRESHOLD_MS:
+        return transcribe_long_audio(audio_url, diarization, audio_duration_ms)
 
-    transcript = aai.Transcriber(config=config).transcribe(audio_url)
+    config = build_transcription_config(diarization)
+
+    transcript = assemblyai_call(aai.Transcriber(config=config).transcribe, audio_url)
+    return format_transcript(transcript, diarization)
+
+
+def format_transcript(transcript, diarization):
     if transcript.status == "error":
         raise RuntimeError(f"Transcription failed: {transcript.error}")
 
@@ -20,7 +111,7 @@ def transcribe_audio(audio_url, diarization):
         full_text = ""
         # Check if utterances exist and are not None
         if transcript.utterances is None or len(transcript.utterances) == 0:
-            raise RuntimeError("No se detectó audio en la grabación. El archivo puede estar vacío o en silencio.")
+            raise RuntimeError(NO_AUDIO_MESSAGE)
 
         for utterance in transcript.utterances:
             speaker = f"Speaker{utterance.speaker}"
@@ -31,11 +122,544 @@ def transcribe_audio(audio_url, diarization):
         full_text = transcript.text
         # Check if text is empty
         if not full_text or full_text.strip() == "":
-            raise RuntimeError("No se detectó audio en la grabación. El archivo puede estar vacío o en silencio.")
+            raise RuntimeError(NO_AUDIO_MESSAGE)
 
     return full_text
 
+
+def plan_chunks(audio_duration_ms):
+    """
+    Split the recording into (start, end) windows in ms that overlap by CHUNK_OVERLAP_MS.
+    The last window is open-ended so a slightly short client-reported duration loses nothing.
+    """
+    chunks = []
+    step = CHUNK_DURATION_MS - CHUNK_OVERLAP_MS
+    start = 0
+    while start + CHUNK_DURATION_MS < audio_duration_ms:
+        chunks.append((start, start + CHUNK_DURATION_MS))
+        start += step
+    chunks.append((start, None))
+    return chunks
+
+
+def transcribe_chunk(audio_url, diarization, start, end):
+    """Transcribe one window of the file and return its segments"""
+    config = build_transcription_config(diarization, audio_start_from=start, audio_end_at=end)
+    transcript = assemblyai_call(aai.Transcriber(config=config).transcribe, audio_url)
+    return transcript_segments(transcript, diarization, start)
+
+
+def transcript_segments(transcript, diarization, start):
+    """
+    Words of a chunk transcript, labelled with the speaker of their utterance when
+    diarizing, with timestamps on the full recording's timeline. Utterances can
+    run for tens of seconds, so chunks are cut word by word (see stitch_chunks).
+    """
+    if transcript.status == "error":
+        raise RuntimeError(f"Transcription failed: {transcript.error}")
+
+    if diarization:
+        segments = [
+            {'speaker': u.speaker, 'text': w.text, 'start': w.start, 'end': w.end}
+            for u in (transcript.utterances or [])
+            for w in (u.words or [u])
+        ]
+    else:
+        segments = [
+            {'speaker': None, 'text': w.text, 'start': w.start, 'end': w.end}
+            for w in (transcript.words or [])
+        ]
+
+    # Timestamps relative to the slice start would land before it
+    if start and segments and segments[0]['start'] < start:
+        for segment in segments:
+            segment['start'] += start
+            segment['end'] += start
+
+    return segments
+
+
+def match_speakers(previous, current, window_start, window_end, used_labels):
+    """
+    Map the speaker labels of a chunk onto the labels already in use, pairing the
+    labels that talk over the same stretch of the overlap window for the longest.
+    Speakers with no match get an unused known label, or a fresh one.
+    """
+    previous = [s for s in previous if s['end'] > window_start and s['start'] < window_end]
+    overlapping = [s for s in current if s['end'] > window_start and s['start'] < window_end]
+
+    shared_ms = {}
+    for before in previous:
+        for after in overlapping:
+            low = max(before['start'], after['start'], window_start)
+            high = min(before['end'], after['end'], window_end)
+            if high > low:
+                pair = (after['speaker'], before['speaker'])
+                shared_ms[pair] = shared_ms.get(pair, 0) + high - low
+
+    mapping = {}
+    for (label, known_label), _ in sorted(shared_ms.items(), key=lambda item: -item[1]):
+        if label not in mapping and known_label not in mapping.values():
+            mapping[label] = known_label
+
+    # Speakers silent during the overlap take the known labels left over, in order
+    unclaimed = sorted(label for label in used_labels if label not in mapping.values())
+    for segment in current:
+        label = segment['speaker']
+        if label in mapping:
+            continue
+        if unclaimed:
+            mapping[label] = unclaimed.pop(0)
+        else:
+            mapping[label] = next(c for c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ' if c not in used_labels)
+            used_labels.add(mapping[label])
+
+    return mapping
+
+
+def stitch_chunks(chunks, chunk_segments, diarization):
+    """
+    Join per-chunk words into one transcript. Each overlap is cut at its midpoint:
+    words starting before the cut come from the earlier chunk, the rest from the
+    later one, so an utterance that crosses the cut is kept whole. Speaker labels
+    are carried across boundaries through match_speakers.
+    """
+    merged = []
+    previous = []
+    used_labels = set()
+
+    for index, segments in enumerate(chunk_segments):
+        chunk_start, _ = chunks[index]
+        previous_end = chunks[index - 1][1] if index else None
+        next_start = chunks[index + 1][0] if index + 1 < len(chunks) else None
+
+        if diarization:
+            if index == 0:
+                used_labels.update(s['speaker'] for s in segments)
+            else:
+                mapping = match_speakers(previous, segments, chunk_start, previous_end, used_labels)
+                segments = [dict(s, speaker=mapping[s['speaker']]) for s in segments]
+
+        cut_from = (chunk_start + previous_end) / 2 if previous_end is not None else float('-inf')
+        cut_to = (next_start + chunks[index][1]) / 2 if next_start is not None else float('inf')
+        merged.extend(s for s in segments if cut_from <= s['start'] < cut_to)
+        previous = segments
+
+    if not merged:
+        raise RuntimeError(NO_AUDIO_MESSAGE)
+
+    if not diarization:
+        return " ".join(s['text'] for s in merged)
+
+    # Words regrouped into turns, across the boundaries too
+    turns = []
+    for segment in merged:
+        if turns and turns[-1][0] == segment['speaker']:
+            turns[-1][1].append(segment['text'])
+        else:
+            turns.append((segment['speaker'], [segment['text']]))
+
+    return "".join(f"Speaker{speaker}: {' '.join(texts)}\n\n" for speaker, texts in turns)
+
+
+def transcribe_long_audio(audio_url, diarization, audio_duration_ms):
+    """
+    Transcribe overlapping windows of a long recording concurrently, so wall-clock
+    time follows the chunk length instead of the consultation length.
+    """
+    chunks = plan_chunks(audio_duration_ms)
+    print(f"Long audio ({audio_duration_ms} ms): transcribing {len(chunks)} chunks in parallel")
+
+    with ThreadPoolExecutor(max_workers=min(len(chunks), MAX_PARALLEL_CHUNKS)) as executor:
+        futures = [
+            executor.submit(transcribe_chunk, audio_url, diarization, start, end)
+            for start, end in chunks
+        ]
+        chunk_segments = [future.result() for future in futures]
+
+    return stitch_chunks(chunks, chunk_segments, diarization)
+
+
+def submit_transcription(history_id, audio_url, diarization, audio_duration_ms, cache_key, timing=None):
+    """
+    Queue the transcription at AssemblyAI without waiting for it. With a webhook
+    every job reports back to transcription_webhook, which calls this Lambda
+    again in collect mode once all of them are done; otherwise the jobs are
+    polled by poll_transcription.
+    """
+    aai.settings.api_key = ASSEMBLY_KEY
+
+    if audio_duration_ms and audio_duration_ms > LONG_AUDIO_THRESHOLD_MS:
+        windows = plan_chunks(audio_duration_ms)
+    else:
+        windows = [(None, None)]
+
+    webhook_url = f"{TRANSCRIPTION_WEBHOOK_URL}?{urlencode({'historyID': history_id})}"
+
+    jobs = []
+    for start, end in windows:
+        config = build_transcription_config(diarization, audio_start_from=start, audio_end_at=end)
+        if webhook_enabled():
+            config.set_webhook(webhook_url, WEBHOOK_AUTH_HEADER, TRANSCRIPTION_WEBHOOK_SECRET)
+        transcript = assemblyai_call(aai.Transcriber(config=config).submit, audio_url)
+        jobs.append({'transcriptID': transcript.id, 'start': start, 'end': end})
+
+    response = histories_table.update_item(
+        Key={'historyID': history_id},
+        UpdateExpression='SET transcriptionJobs = :jobs, transcriptionRequest = :request, updatedAt = :updated '
+                         'REMOVE transcriptionCollectRequestedAt',
+        ExpressionAttributeValues={
+            ':jobs': jobs,
+            ':request': {
+                'audio_url': audio_url,
+                'diarization': bool(diarization),
+                'cache_key': cache_key,
+                'timing': {**(timing or {}), 'submittedAt': int(time.time() * 1000)}
+            },
+            ':updated': datetime.utcnow().isoformat() + 'Z'
+        },
+        ReturnValues='ALL_NEW'
+    )
+    print(f"Submitted {len(jobs)} transcription job(s) for history {history_id}")
+    return response['Attributes']
+
+
+def poll_transcription(history, context, handoffs=0):
+    """
+    Wait for the submitted jobs of a pipeline transcription and collect them.
+    Returns False when the wait was handed to a fresh invocation.
+    """
+    history_id = history['historyID']
+    pending = [job['transcriptID'] for job in history['transcriptionJobs']]
+
+    while True:
+        transcripts = [assemblyai_call(aai.Transcript.get_by_id, job_id) for job_id in pending]
+        raise_failed_jobs(history_id, transcripts)
+        pending = [
+            transcript.id for transcript in transcripts
+            if transcript.status not in (aai.TranscriptStatus.completed, aai.TranscriptStatus.error)
+        ]
+        if not pending:
+            break
+        if not has_time_for(context, TRANSCRIPTION_POLL_SECONDS * 1000 + COLLECT_ESTIMATE_MS):
+            hand_off(context, {'historyID': history_id, 'poll': True, 'handoffs': handoffs})
+            return False
+        time.sleep(TRANSCRIPTION_POLL_SECONDS)
+
+    if claim_collection(history_id):
+        store_collected_transcription(history)
+    return True
+
+
+def discard_transcription_jobs(history_id):
+    """
+    Forget jobs AssemblyAI failed, so the next attempt submits new ones instead
+    of collecting them again (see start_transcription in the pipeline)
+    """
+    histories_table.update_item(
+        Key={'historyID': history_id},
+        UpdateExpression='REMOVE transcriptionJobs, transcriptionJobsDone'
+    )
+
+
+def raise_failed_jobs(history_id, transcripts):
+    failed = [transcript for transcript in transcripts if transcript.status == aai.TranscriptStatus.error]
+    if failed:
+        discard_transcription_jobs(history_id)
+        raise RuntimeError(f"AssemblyAI job {failed[0].id} failed: {failed[0].error}")
+
+
+def transcription_jobs_done(history):
+    done = history.get('transcriptionJobsDone') or set()
+    jobs = history.get('transcriptionJobs') or []
+    return bool(jobs) and all(job['transcriptID'] in done for job in jobs)
+
+
+def claim_collection(history_id):
+    """Only the first caller to see every job finished collects the transcript"""
+    try:
+        histories_table.update_item(
+            Key={'historyID': history_id},
+            UpdateExpression='SET transcriptionCollectRequestedAt = :now',
+            ConditionExpression='attribute_not_exists(transcriptionCollectRequestedAt)',
+            ExpressionAttributeValues={':now': datetime.utcnow().isoformat() + 'Z'}
+        )
+        return True
+    except histories_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+def store_transcription(text, history_id=None, cache_key=None, segment_index=None):
+    """
+    Write a transcript once to S3 and return its reference. Cacheable transcripts
+    are stored under their audio hash, so the cache and every history that
+    matches it share the same object.
+    """
+    if cache_key:
+        key = f"transcriptions/{cache_key}.txt"
+    elif segment_index is not None:
+        key = f"histories/{history_id}/segments/{segment_index}.txt"
+    else:
+        key = f"histories/{history_id}/transcription.txt"
+    return put_text(key, text)
+
+
+def store_collected_transcription(history):
+    history_id = history['historyID']
+    transcribed_text = collect_transcription(history)
+
+    request = history['transcriptionRequest']
+    transcription_ref = store_transcription(transcribed_text, history_id, request.get('cache_key'))
+    if request.get('cache_key'):
+        put_cached_transcription(request['cache_key'], request['audio_url'], transcription_ref)
+
+    timing = dict(request.get('timing') or {})
+    if 'submittedAt' in timing:
+        timing['providerMs'] = int(time.time() * 1000) - int(timing.pop('submittedAt'))
+    save_pipeline_result(history_id, transcription_ref, timing)
+    print(f"Transcription collected for history {history_id}: {len(transcribed_text)} characters")
+
+
+def collect_transcription(history):
+    """Fetch the finished jobs of a submitted transcription and build the transcript"""
+    aai.settings.api_key = ASSEMBLY_KEY
+
+    jobs = history['transcriptionJobs']
+    diarization = history['transcriptionRequest']['diarization']
+
+    with ThreadPoolExecutor(max_workers=min(len(jobs), MAX_PARALLEL_CHUNKS)) as executor:
+        transcripts = list(executor.map(
+            lambda job: assemblyai_call(aai.Transcript.get_by_id, job['transcriptID']), jobs
+        ))
+    raise_failed_jobs(history['historyID'], transcripts)
+
+    if len(jobs) == 1:
+        return format_transcript(transcripts[0], diarization)
+
+    chunks = [
+        (int(job['start']), int(job['end']) if job['end'] is not None else None)
+        for job in jobs
+    ]
+    chunk_segments = [
+        transcript_segments(transcript, diarization, start)
+        for transcript, (start, _) in zip(transcripts, chunks)
+    ]
+    return stitch_chunks(chunks, chunk_segments, diarization)
+
+
+def transcribe_segment(audio_url, diarization):
+    """Segments of a live session that hold only silence contribute nothing instead of failing it"""
+    try:
+        return transcribe_audio(audio_url, diarization)
+    except RuntimeError as e:
+        if str(e) == NO_AUDIO_MESSAGE:
+            return ""
+        raise
+
+
+def save_segment_transcription(history_id, segment_index, transcription_ref):
+    response = histories_table.update_item(
+        Key={'historyID': history_id},
+        UpdateExpression='SET segmentTranscripts.#index = :trans, updatedAt = :updated REMOVE #lease',
+        ExpressionAttributeNames={'#index': str(segment_index), '#lease': f"segmentLease{segment_index}"},
+        ExpressionAttributeValues={
+            ':trans': transcription_ref,
+            ':updated': datetime.utcnow().isoformat() + 'Z'
+        },
+        ReturnValues='ALL_NEW'
+    )
+    return response['Attributes']
+
+
+def segments_ready(history):
+    count = history.get('segmentCount')
+    transcribed = history.get('segmentTranscripts') or {}
+    return bool(count) and all(str(index) in transcribed for index in range(int(count)))
+
+
+def assemble_segments(history):
+    """
+    Join the segment transcripts of a live session in recording order, transcribing
+    any segment that never reported back (lost invocation, retry after a failure).
+    Speaker labels come from each segment's own diarization.
+    """
+    count = int(history['segmentCount'])
+    segments = history.get('segments') or {}
+    transcribed = dict(history.get('segmentTranscripts') or {})
+
+    missing = [str(index) for index in range(count) if str(index) not in transcribed]
+    for index in missing:
+        if index not in segments:
+            raise RuntimeError(f"Segment {index} was never uploaded")
+
+    # Segment transcripts are stored as references, fetched in parallel
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_CHUNKS) as executor:
+        stored = list(transcribed)
+        transcribed.update(zip(stored, executor.map(resolve, [transcribed[index] for index in stored])))
+
+    if missing:
+        print(f"Transcribing {len(missing)} missing segment(s) of history {history['historyID']}")
+        with ThreadPoolExecutor(max_workers=min(len(missing), MAX_PARALLEL_CHUNKS)) as executor:
+            texts = executor.map(lambda index: transcribe_segment(segments[index]['recordingURL'], True), missing)
+            transcribed.update(zip(missing, texts))
+
+    parts = [transcribed[str(index)].strip() for index in range(count)]
+    parts = [part for part in parts if part]
+    if not parts:
+        raise RuntimeError(NO_AUDIO_MESSAGE)
+
+    return "\n\n".join(parts) + "\n\n"
+
+
+def parse_recording_url(audio_url):
+    """
+    Map a recording URL to its S3 bucket and key.
+    Supports the storage domain and https://bucket.s3.region.amazonaws.com/key.
+    Returns (None, None) for audio hosted anywhere else.
+    """
+    parsed = urlparse(audio_url)
+    key = unquote(parsed.path.lstrip('/'))
+
+    if parsed.netloc == RECORDINGS_DOMAIN:
+        return RECORDINGS_BUCKET, key
+
+    if '.s3.' in parsed.netloc and parsed.netloc.endswith('amazonaws.com'):
+        return parsed.netloc.split('.')[0], key
+
+    return None, None
+
+
+def transcription_cache_key(audio_url, diarization):
+    """
+    Content address of a transcription: the audio's checksum plus every setting
+    that changes the output. Returns None when the audio can't be fingerprinted.
+    """
+    bucket, key = parse_recording_url(audio_url)
+    if not bucket or not key:
+        return None
+
+    head = s3_client.head_object(Bucket=bucket, Key=key, ChecksumMode='ENABLED')
+    audio_hash = head.get('ChecksumSHA256') or head.get('ETag', '').strip('"')
+    if not audio_hash:
+        return None
+
+    settings = {
+        'version': TRANSCRIPTION_CACHE_VERSION,
+        'speech_model': 'universal',
+        'language_code': 'es',
+        'speaker_labels': bool(diarization),
+        'speakers_expected': 2 if diarization else None
+    }
+    fingerprint = f"{audio_hash}|{json.dumps(settings, sort_keys=True)}"
+    return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+
+
+def get_cached_transcription(cache_key):
+    """Reference to the cached transcript in S3"""
+    response = cache_table.get_item(Key={'audioHash': cache_key})
+    return response.get('Item', {}).get('transcriptionRef')
+
+
+def put_cached_transcription(cache_key, audio_url, transcription_ref):
+    try:
+        cache_table.put_item(Item={
+            'audioHash': cache_key,
+            'transcriptionRef': transcription_ref,
+            'audioURL': audio_url,
+            'createdAt': datetime.utcnow().isoformat() + 'Z',
+            'ttl': int(time.time()) + TRANSCRIPTION_CACHE_TTL_DAYS * 86400
+        })
+    except Exception as e:
+        # The cache is an optimization, never fail a transcription over it
+        print(f"Warning: Could not cache transcription: {e}")
+
+
+def acquire_lease(history_id, lease, done_path, owner, names=None):
+    """
+    Claim a pipeline step for this invocation. Fails when the step is already
+    done (done_path exists) or another invocation holds an unexpired lease; a
+    retry of this same invocation (same request ID) gets its lease back.
+    """
+    now = int(time.time())
+    try:
+        histories_table.update_item(
+            Key={'historyID': history_id},
+            UpdateExpression='SET #lease = :lease',
+            ConditionExpression=(
+                f'attribute_not_exists({done_path}) AND '
+                '(attribute_not_exists(#lease) OR #lease.expiresAt < :now OR #lease.#owner = :owner)'
+            ),
+            ExpressionAttributeNames={'#lease': lease, '#owner': 'owner', **(names or {})},
+            ExpressionAttributeValues={
+                ':lease': {'owner': owner, 'expiresAt': now + STAGE_LEASE_SECONDS},
+                ':now': now,
+                ':owner': owner
+            }
+        )
+        return True
+    except histories_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+def save_pipeline_result(history_id, transcription_ref, timing=None):
+    """
+    Checkpoint the transcription reference and move the history to the next
+    pipeline stage. Only the first result counts: a late duplicate must not
+    move a history that already went further back to "transcribed".
+    """
+    try:
+        histories_table.update_item(
+            Key={'historyID': history_id},
+            UpdateExpression=(
+                'SET transcriptionRef = :trans, checkpoints.transcription = :updated, pipelineStage = :stage, '
+                'updatedAt = :updated, transcriptionTiming = :timing '
+                'REMOVE transcriptionLease'
+            ),
+            ConditionExpression='attribute_not_exists(checkpoints.transcription)',
+            ExpressionAttributeValues={
+                ':trans': transcription_ref,
+                ':stage': 'transcribed',
+                ':updated': datetime.utcnow().isoformat() + 'Z',
+                ':timing': timing or {}
+            }
+        )
+        return True
+    except histories_table.meta.client.exceptions.ConditionalCheckFailedException:
+        print(f"Transcription of history {history_id} was already stored, dropping duplicate result")
+        return False
+
+
+def save_pipeline_failure(history_id, error):
+    """Fail the stage, or schedule its retry when the error is transient (see retries.py)"""
+    try:
+        record_failure(
+            histories_table, history_id, error, f"Transcription failed: {error}", lease_attribute='transcriptionLease'
+        )
+    except Exception as update_error:
+        print(f"Failed to update error status: {update_error}")
+
+
 def lambda_handler(event, context):
+    """
+    Transcribe an audio file.
+
+    When called by the recording pipeline the body also carries "historyID": the
+    result is written to medical-histories instead of being awaited by the caller.
+    With TRANSCRIPTION_WEBHOOK_URL and its secret set, pipeline jobs are only submitted here and
+    transcription_webhook triggers {"historyID", "collect": true} once they finish.
+    Without it they are polled while the invocation has time, then by fresh
+    invocations called with {"historyID", "poll": true}.
+
+    Live recording sessions send each segment with "segmentIndex" as soon as it is
+    recorded; {"historyID", "assemble": true} joins them once the session is closed.
+
+    Pipeline transcripts are stored in S3 (see artifacts.py) and only their
+    reference, "transcriptionRef", is saved on the history and returned.
+    """
+    global _cold_start
+    cold_start, _cold_start = _cold_start, False
+    history_id = None
+    segment_index = None
     try:
         # Parse input - handle both direct invocation and API Gateway format
         if isinstance(event.get('body'), str):
@@ -43,9 +667,46 @@ def lambda_handler(event, context):
         else:
             body = event.get('body', event)  # Fallback to event itself for direct invocation
 
+        history_id = body.get('historyID')
+        segment_index = body.get('segmentIndex')
         audio_url = body.get('audio_url')
         diarization = body.get('diarization', True)
+        audio_duration_ms = body.get('audio_duration_ms')
+
+        # All submitted jobs finished (called by transcription_webhook)
+        if body.get('collect'):
+            history = histories_table.get_item(Key={'historyID': history_id})['Item']
+            store_collected_transcription(history)
+            return {
+                'statusCode': 200,
+                'body': json.dumps({'historyID': history_id, 'message': 'Transcription stored'})
+            }
+
+        # Submitted jobs still running when the previous invocation ran short of time
+        if body.get('poll'):
+            history = histories_table.get_item(Key={'historyID': history_id})['Item']
+            collected = poll_transcription(history, context, int(body.get('handoffs', 0)))
+            return {
+                'statusCode': 200 if collected else 202,
+                'body': json.dumps({
+                    'historyID': history_id,
+                    'message': 'Transcription stored' if collected else 'Polling handed off'
+                })
+            }
 
+        # Live session closed with every segment transcribed (called by the pipeline)
+        if body.get('assemble'):
+            history = histories_table.get_item(Key={'historyID': history_id})['Item']
+            if claim_collection(history_id):
+                transcribed_text = assemble_segments(history)
+                save_pipeline_result(history_id, store_transcription(transcribed_text, history_id))
+                print(f"Transcript assembled for history {history_id}: {len(transcribed_text)} characters")
+            return {
+                'statusCode': 200,
+                'body': json.dumps({'historyID': history_id, 'message': 'Segments assembled'})
+            }
+
+        # Validated before the lease, so a rejected request never holds it
         if not audio_url:
             return {
                 'statusCode': 400,
@@ -56,7 +717,87 @@ def lambda_handler(event, context):
                 'body': json.dumps({'error': 'audio_url is required'})
             }
 
-        transcribed_text = transcribe_audio(audio_url, diarization)
+        # Drop duplicate deliveries before paying for a transcription
+        if history_id:
+            owner = getattr(context, 'aws_request_id', None) or str(uuid.uuid4())
+            if segment_index is not None:
+                leased = acquire_lease(
+                    history_id, f"segmentLease{segment_index}", 'segmentTranscripts.#index', owner,
+                    {'#index': str(segment_index)}
+                )
+            else:
+                leased = acquire_lease(history_id, 'transcriptionLease', 'checkpoints.transcription', owner)
+            if not leased:
+                print(f"Duplicate transcription invocation for history {history_id} dropped")
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps({'historyID': history_id, 'message': 'Duplicate invocation dropped'})
+                }
+
+        cache_key = None
+        try:
+            cache_key = transcription_cache_key(audio_url, diarization)
+        except Exception as e:
+            print(f"Warning: Could not fingerprint audio, skipping cache: {e}")
+
+        # Transcripts move around as S3 references; the text is only loaded
+        # when it is needed here or returned to a blocking caller
+        transcription_ref = get_cached_transcription(cache_key) if cache_key else None
+        transcribed_text = None
+        cached = transcription_ref is not None
+
+        if cached:
+            print(f"Transcription cache hit for {audio_url}")
+        elif segment_index is not None:
+            transcribed_text = transcribe_segment(audio_url, diarization)
+            if cache_key and transcribed_text:
+                transcription_ref = store_transcription(transcribed_text, cache_key=cache_key)
+                put_cached_transcription(cache_key, audio_url, transcription_ref)
+        elif history_id:
+            history = submit_transcription(
+                history_id, audio_url, diarization, audio_duration_ms, cache_key, stage_timing(body, cold_start)
+            )
+            if webhook_enabled():
+                # Very short audio can report back before the job IDs were stored
+                if transcription_jobs_done(history) and claim_collection(history_id):
+                    store_collected_transcription(history)
+                message = 'Transcription submitted'
+            else:
+                collected = poll_transcription(history, context)
+                message = 'Transcription stored' if collected else 'Polling handed off'
+            return {
+                'statusCode': 202,
+                'body': json.dumps({'historyID': history_id, 'message': message})
+            }
+        else:
+            transcribed_text = transcribe_audio(audio_url, diarization, audio_duration_ms)
+            if cache_key:
+                transcription_ref = store_transcription(transcribed_text, cache_key=cache_key)
+                put_cached_transcription(cache_key, audio_url, transcription_ref)
+
+        if history_id and segment_index is not None:
+            if transcription_ref is None:
+                transcription_ref = store_transcription(transcribed_text, history_id, segment_index=segment_index)
+            history = save_segment_transcription(history_id, segment_index, transcription_ref)
+            print(f"Segment {segment_index} of history {history_id} transcribed")
+            # The last segment of a finished session assembles the transcript
+            if segments_ready(history) and claim_collection(history_id):
+                try:
+                    assembled = assemble_segments(history)
+                    save_pipeline_result(history_id, store_transcription(assembled, history_id))
+                except Exception as e:
+                    save_pipeline_failure(history_id, e)
+                    raise
+        elif history_id:
+            save_pipeline_result(history_id, transcription_ref, {**stage_timing(body, cold_start), 'providerMs': 0})
+            print(f"Transcription stored for history {history_id}: {transcription_ref}")
+
+        if history_id:
+            result = {'transcriptionRef': transcription_ref, 'cached': cached}
+        else:
+            if transcribed_text is None:
+                transcribed_text = resolve(transcription_ref)
+            result = {'transcription': transcribed_text, 'cached': cached}
 
         return {
             'statusCode': 200,
@@ -64,13 +805,31 @@ def lambda_handler(event, context):
                 'Content-Type': 'application/json',
                 'Access-Control-Allow-Origin': '*'
             },
-            'body': json.dumps({'transcription': transcribed_text})
+            'body': json.dumps(result)
+        }
+
+    except CircuitOpen as e:
+        # AssemblyAI is down: fail fast, pipeline histories wait for their retry
+        print(f"Error: {e}")
+        if history_id and segment_index is None:
+            save_pipeline_failure(history_id, e)
+        return {
+            'statusCode': 503,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*',
+                'Retry-After': str(int(e.retry_after) + 1)
+            },
+            'body': json.dumps({'error': 'Transcription service unavailable', 'details': str(e)})
         }
 
     except Exception as e:
         print(f"Error: {e}")
         import traceback
         traceback.print_exc()
+        # A failed segment is retried when the session is assembled
+        if history_id and segment_index is None:
+            save_pipeline_failure(history_id, e)
         return {
             'statusCode': 500,
             'headers': {
@@ -0,0 +1,114 @@
+from types import SimpleNamespace
+
+import pytest
+
+
+@pytest.fixture(scope='module')
+def transcribe(load_lambda):
+    return load_lambda('transcribe')
+
+
+def chunk_words(start, end, speaker_at, labels=None):
+    """One word per second of [start, end), as transcript_segments returns them"""
+    labels = labels or {}
+    return [
+        {'speaker': labels.get(speaker_at(second), speaker_at(second)), 'text': f"w{second}",
+         'start': second * 1000, 'end': second * 1000 + 900}
+        for second in range(start // 1000, end // 1000)
+    ]
+
+
+def turns(text):
+    return [line.split(': ', 1) for line in text.strip().split('\n\n')]
+
+
+def test_plan_chunks_overlaps_windows_and_leaves_the_last_open(transcribe):
+    assert transcribe.plan_chunks(900000) == [
+        (0, 300000), (280000, 580000), (560000, 860000), (840000, None)
+    ]
+    assert transcribe.plan_chunks(250000) == [(0, None)]
+
+
+def test_transcript_segments_splits_utterances_into_words_on_the_recording_timeline(transcribe):
+    utterance = SimpleNamespace(
+        speaker='A', text='hola doctor', start=0, end=1500,
+        words=[SimpleNamespace(text='hola', start=0, end=600), SimpleNamespace(text='doctor', start=700, end=1500)]
+    )
+    transcript = SimpleNamespace(status='completed', utterances=[utterance])
+
+    segments = transcribe.transcript_segments(transcript, True, 280000)
+
+    assert segments == [
+        {'speaker': 'A', 'text': 'hola', 'start': 280000, 'end': 280600},
+        {'speaker': 'A', 'text': 'doctor', 'start': 280700, 'end': 281500},
+    ]
+
+
+def test_match_speakers_follows_a_label_swap(transcribe):
+    speaker_at = lambda second: 'A' if second % 20 < 10 else 'B'
+    previous = chunk_words(0, 300000, speaker_at)
+    current = chunk_words(280000, 580000, speaker_at, labels={'A': 'B', 'B': 'A'})
+
+    mapping = transcribe.match_speakers(previous, current, 280000, 300000, {'A', 'B'})
+
+    assert mapping == {'B': 'A', 'A': 'B'}
+
+
+def test_match_speakers_gives_a_new_speaker_a_fresh_label(transcribe):
+    previous = chunk_words(0, 300000, lambda second: 'A')
+    current = chunk_words(280000, 580000, lambda second: 'A' if second < 400 else 'B')
+    used_labels = {'A'}
+
+    mapping = transcribe.match_speakers(previous, current, 280000, 300000, used_labels)
+
+    assert mapping == {'A': 'A', 'B': 'B'}
+    assert used_labels == {'A', 'B'}
+
+
+def utterance(speaker, start, end):
+    words = [
+        SimpleNamespace(text=f"w{second}", start=second * 1000, end=second * 1000 + 900)
+        for second in range(start, end)
+    ]
+    return SimpleNamespace(speaker=speaker, text=' '.join(w.text for w in words),
+                           start=start * 1000, end=end * 1000, words=words)
+
+
+def test_stitch_chunks_keeps_an_utterance_that_crosses_a_boundary(transcribe):
+    # Speaker A talks from 260 s to 320 s, across the cut at 290 s: the first
+    # chunk hears it until its end, the second from its start, and names the
+    # speakers the other way round
+    chunks = [(0, 300000), (280000, None)]
+    transcripts = [
+        SimpleNamespace(status='completed', utterances=[utterance('B', 0, 260), utterance('A', 260, 300)]),
+        SimpleNamespace(status='completed', utterances=[utterance('B', 280, 320), utterance('A', 320, 400)]),
+    ]
+    chunk_segments = [
+        transcribe.transcript_segments(transcript, True, start)
+        for transcript, (start, _) in zip(transcripts, chunks)
+    ]
+
+    text = transcribe.stitch_chunks(chunks, chunk_segments, True)
+
+    assert turns(text) == [
+        ['SpeakerB', ' '.join(f"w{second}" for second in range(0, 260))],
+        ['SpeakerA', ' '.join(f"w{second}" for second in range(260, 320))],
+        ['SpeakerB', ' '.join(f"w{second}" for second in range(320, 400))],
+    ]
+
+
+def test_stitch_chunks_without_diarization_keeps_every_word_once(transcribe):
+    chunks = transcribe.plan_chunks(900000)
+    no_speaker = lambda second: None
+    chunk_segments = [
+        chunk_words(start, end if end is not None else 900000, no_speaker) for start, end in chunks
+    ]
+
+    text = transcribe.stitch_chunks(chunks, chunk_segments, False)
+
+    assert text.split() == [f"w{second}" for second in range(0, 900)]
+
+
+def test_stitch_chunks_without_speech_fails(transcribe):
+    with pytest.raises(RuntimeError, match='No se detectó audio'):
+        transcribe.stitch_chunks([(0, None)], [[]], True)
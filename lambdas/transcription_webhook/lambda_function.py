@@ -0,0 +1,135 @@
+import os
+import json
+import hmac
+import boto3
+from datetime import datetime
+
+lambda_client = boto3.client('lambda')
+dynamodb = boto3.resource('dynamodb')
+
+HISTORIES_TABLE = os.getenv('HISTORIES_TABLE', 'medical-histories')
+TRANSCRIBE_LAMBDA = os.getenv('TRANSCRIBE_LAMBDA', 'transcribe')
+# Required: the route is public, so without a secret every call is rejected
+TRANSCRIPTION_WEBHOOK_SECRET = os.getenv('TRANSCRIPTION_WEBHOOK_SECRET', '')
+WEBHOOK_AUTH_HEADER = 'x-webhook-secret'
+
+histories_table = dynamodb.Table(HISTORIES_TABLE)
+
+
+def _response(status_code, body):
+    return {
+        'statusCode': status_code,
+        'headers': {'Content-Type': 'application/json'},
+        'body': json.dumps(body)
+    }
+
+
+def authorized(headers):
+    if not TRANSCRIPTION_WEBHOOK_SECRET:
+        print("TRANSCRIPTION_WEBHOOK_SECRET is not set, rejecting every webhook call")
+        return False
+    received = headers.get(WEBHOOK_AUTH_HEADER) or ''
+    return hmac.compare_digest(received.encode('utf-8'), TRANSCRIPTION_WEBHOOK_SECRET.encode('utf-8'))
+
+
+def transcription_jobs_done(history):
+    done = history.get('transcriptionJobsDone') or set()
+    jobs = history.get('transcriptionJobs') or []
+    return bool(jobs) and all(job['transcriptID'] in done for job in jobs)
+
+
+def claim_collection(history_id):
+    """Only the first webhook to see every job finished triggers the collection"""
+    try:
+        histories_table.update_item(
+            Key={'historyID': history_id},
+            UpdateExpression='SET transcriptionCollectRequestedAt = :now',
+            ConditionExpression='attribute_not_exists(transcriptionCollectRequestedAt)',
+            ExpressionAttributeValues={':now': datetime.utcnow().isoformat() + 'Z'}
+        )
+        return True
+    except histories_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+def request_collection(history_id):
+    lambda_client.invoke(
+        FunctionName=TRANSCRIBE_LAMBDA,
+        InvocationType='Event',
+        Payload=json.dumps({'body': json.dumps({'historyID': history_id, 'collect': True})})
+    )
+
+
+def lambda_handler(event, context):
+    """
+    Completion webhook for AssemblyAI transcription jobs submitted by the transcribe Lambda.
+
+    Called by the provider (POST ?historyID=...) with:
+    {
+        "transcript_id": "string",
+        "status": "completed" | "error"
+    }
+
+    Calls must carry the shared secret in X-Webhook-Secret; with no secret
+    configured every call is rejected. Records the finished job on the existing
+    history (404 for an unknown one) and, once every job of the history
+    is done, invokes transcribe in collect mode. A failed job triggers the
+    collection right away: transcribe reads the provider's error, discards the
+    jobs and fails the stage or schedules its retry (retries.py), dropping the
+    transcription lease. Never waits for the provider.
+    """
+    try:
+        headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+        if not authorized(headers):
+            print("Rejected webhook call with invalid secret")
+            return _response(401, {'error': 'Unauthorized'})
+
+        query_params = event.get('queryStringParameters', {}) or {}
+        history_id = query_params.get('historyID')
+
+        if isinstance(event.get('body'), str):
+            body = json.loads(event['body'])
+        else:
+            body = event.get('body', {}) or {}
+
+        transcript_id = body.get('transcript_id')
+        status = body.get('status')
+
+        if not history_id or not transcript_id:
+            return _response(400, {'error': 'historyID and transcript_id are required'})
+
+        print(f"Transcription job {transcript_id} for history {history_id} finished with status '{status}'")
+
+        if status == 'error':
+            history = histories_table.get_item(Key={'historyID': history_id}).get('Item', {})
+            job_ids = {job['transcriptID'] for job in history.get('transcriptionJobs') or []}
+            # Jobs from an earlier attempt no longer decide the outcome
+            if transcript_id in job_ids and claim_collection(history_id):
+                request_collection(history_id)
+            return _response(200, {'message': 'Failure recorded'})
+
+        try:
+            response = histories_table.update_item(
+                Key={'historyID': history_id},
+                UpdateExpression='ADD transcriptionJobsDone :done',
+                ConditionExpression='attribute_exists(historyID)',
+                ExpressionAttributeValues={':done': {transcript_id}},
+                ReturnValues='ALL_NEW'
+            )
+        except histories_table.meta.client.exceptions.ConditionalCheckFailedException:
+            # Never create a history for an unknown ID
+            print(f"History {history_id} not found, job {transcript_id} ignored")
+            return _response(404, {'error': 'History not found'})
+        history = response['Attributes']
+
+        if transcription_jobs_done(history) and claim_collection(history_id):
+            request_collection(history_id)
+            print(f"All transcription jobs done for history {history_id}, collection requested")
+
+        return _response(200, {'message': 'Job recorded'})
+
+    except Exception as e:
+        print(f"Error: {e}")
+        import traceback
+        traceback.print_exc()
+        return _response(500, {'error': 'Internal server error', 'details': str(e)})
@@ -0,0 +1,200 @@
+import json
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import assemblyai as aai
+import boto3
+import pytest
+
+SECRET = 'webhook-secret'
+WEBHOOK_URL = 'https://hooks.clinicalops.test/transcription'
+AUDIO_URL = 'https://audio.clinicalops.test/consulta.mp3'
+
+
+class AssemblyAIStandIn(ThreadingHTTPServer):
+    """
+    Local stand-in of the AssemblyAI transcript API: keeps submitted jobs queued
+    until the test finishes them, and hands back the webhook each job would call.
+    """
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.jobs = {}
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def finish(self, transcript_id, utterances=None, error=None):
+        """Complete (or fail) a job and return the webhook call it triggers"""
+        job = self.jobs[transcript_id]
+        if error:
+            job.update(status='error', error=error)
+        else:
+            job.update(status='completed', utterances=utterances, text=' '.join(u['text'] for u in utterances))
+        url = urlparse(job['webhook_url'])
+        return {
+            'headers': {job['webhook_auth_header_name']: job['webhook_auth_header_value']},
+            'queryStringParameters': {k: v[0] for k, v in parse_qs(url.query).items()},
+            'body': json.dumps({'transcript_id': transcript_id, 'status': job['status']})
+        }
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def _send(self, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        job = {**request, 'id': str(uuid.uuid4()), 'status': 'queued'}
+        self.server.jobs[job['id']] = job
+        self._send(job)
+
+    def do_GET(self):
+        self._send(self.server.jobs[self.path.rsplit('/', 1)[-1]])
+
+    def log_message(self, *args):
+        pass
+
+
+def utterance(speaker, text, start):
+    words = [
+        {'text': word, 'start': start + i * 500, 'end': start + i * 500 + 400, 'confidence': 0.9, 'speaker': speaker}
+        for i, word in enumerate(text.split())
+    ]
+    return {'speaker': speaker, 'text': text, 'start': start, 'end': words[-1]['end'], 'confidence': 0.9,
+            'words': words}
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    server = AssemblyAIStandIn()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(aai.settings, 'base_url', server.base_url)
+    monkeypatch.setattr(aai.settings, 'api_key', 'test-key')
+    # The SDK keeps one default client, built with the settings of its first use
+    monkeypatch.setattr(aai.Client, '_default', None)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def pipeline(load_lambda, monkeypatch, provider):
+    """transcribe and transcription_webhook against moto, invoking each other in process"""
+    dynamodb = boto3.resource('dynamodb')
+    for name, key in (('medical-histories', 'historyID'), ('transcription-cache', 'audioHash')):
+        dynamodb.create_table(
+            TableName=name,
+            KeySchema=[{'AttributeName': key, 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': key, 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+    boto3.client('s3').create_bucket(Bucket='recordings-clinicalops')
+
+    transcribe = load_lambda('transcribe')
+    webhook = load_lambda('transcription_webhook')
+    monkeypatch.setattr(transcribe, 'TRANSCRIPTION_WEBHOOK_URL', WEBHOOK_URL)
+    monkeypatch.setattr(transcribe, 'TRANSCRIPTION_WEBHOOK_SECRET', SECRET)
+    monkeypatch.setattr(transcribe, 'ASSEMBLY_KEY', 'test-key')
+    monkeypatch.setattr(webhook, 'TRANSCRIPTION_WEBHOOK_SECRET', SECRET)
+
+    collections = []
+
+    def invoke(FunctionName, InvocationType, Payload):
+        collections.append(json.loads(Payload))
+        transcribe.lambda_handler(json.loads(Payload), None)
+
+    monkeypatch.setattr(webhook.lambda_client, 'invoke', invoke)
+    return transcribe, webhook, dynamodb.Table('medical-histories'), collections
+
+
+def submit(transcribe, histories, history_id='history-1'):
+    histories.put_item(Item={
+        'historyID': history_id, 'status': 'processing', 'pipelineStage': 'transcribing', 'checkpoints': {}
+    })
+    response = transcribe.lambda_handler(
+        {'body': json.dumps({'historyID': history_id, 'audio_url': AUDIO_URL, 'diarization': True})}, None
+    )
+    assert response['statusCode'] == 202
+    return histories.get_item(Key={'historyID': history_id})['Item']
+
+
+def test_submit_webhook_collect(pipeline, provider):
+    transcribe, webhook, histories, collections = pipeline
+
+    history = submit(transcribe, histories)
+    [job] = history['transcriptionJobs']
+    assert provider.jobs[job['transcriptID']]['webhook_url'] == f"{WEBHOOK_URL}?historyID=history-1"
+
+    call = provider.finish(job['transcriptID'], [
+        utterance('A', 'Buenos días doctor', 0),
+        utterance('B', 'Cuénteme qué le pasa', 2500),
+    ])
+    response = webhook.lambda_handler(call, None)
+
+    assert response['statusCode'] == 200
+    assert collections == [{'body': json.dumps({'historyID': 'history-1', 'collect': True})}]
+    history = histories.get_item(Key={'historyID': 'history-1'})['Item']
+    assert history['pipelineStage'] == 'transcribed'
+    assert transcribe.resolve(history['transcriptionRef']) == (
+        "SpeakerA: Buenos días doctor\n\nSpeakerB: Cuénteme qué le pasa\n\n"
+    )
+
+    # A redelivered webhook doesn't collect twice
+    webhook.lambda_handler(call, None)
+    assert len(collections) == 1
+
+
+def test_failed_job_goes_through_the_retry_path(pipeline, provider):
+    transcribe, webhook, histories, collections = pipeline
+
+    history = submit(transcribe, histories)
+    [job] = history['transcriptionJobs']
+
+    response = webhook.lambda_handler(provider.finish(job['transcriptID'], error='Audio file could not be decoded'), None)
+
+    assert response['statusCode'] == 200
+    assert len(collections) == 1
+    history = histories.get_item(Key={'historyID': 'history-1'})['Item']
+    assert history['status'] == 'failed'
+    assert 'Audio file could not be decoded' in history['errorMessage']
+    assert 'transcriptionJobs' not in history
+    assert 'transcriptionLease' not in history
+
+
+def test_unknown_history_is_not_created(pipeline):
+    _, webhook, histories, collections = pipeline
+
+    response = webhook.lambda_handler({
+        'headers': {'X-Webhook-Secret': SECRET},
+        'queryStringParameters': {'historyID': 'no-such-history'},
+        'body': json.dumps({'transcript_id': 'job-1', 'status': 'completed'})
+    }, None)
+
+    assert response['statusCode'] == 404
+    assert 'Item' not in histories.get_item(Key={'historyID': 'no-such-history'})
+    assert collections == []
+
+
+@pytest.mark.parametrize('configured, sent', [(SECRET, 'wrong-secret'), (SECRET, None), ('', '')])
+def test_calls_without_the_secret_are_rejected(pipeline, monkeypatch, configured, sent):
+    _, webhook, histories, collections = pipeline
+    monkeypatch.setattr(webhook, 'TRANSCRIPTION_WEBHOOK_SECRET', configured)
+    histories.put_item(Item={'historyID': 'history-1'})
+
+    response = webhook.lambda_handler({
+        'headers': {'X-Webhook-Secret': sent} if sent is not None else {},
+        'queryStringParameters': {'historyID': 'history-1'},
+        'body': json.dumps({'transcript_id': 'job-1', 'status': 'completed'})
+    }, None)
+
+    assert response['statusCode'] == 401
+    assert 'transcriptionJobsDone' not in histories.get_item(Key={'historyID': 'history-1'})['Item']
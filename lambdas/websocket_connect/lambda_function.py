@@ -3,12 +3,56 @@ import json
 import boto3
 from datetime import datetime
 
+AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
+
 # AWS Clients
 dynamodb = boto3.resource('dynamodb')
+cognito_client = boto3.client('cognito-idp', region_name=AWS_REGION)
 
-# DynamoDB table
+# DynamoDB tables
 CONNECTIONS_TABLE = os.environ.get('DYNAMODB_CONNECTIONS_TABLE', 'websocket_connections')
+HISTORIES_TABLE = os.environ.get('HISTORIES_TABLE', 'medical-histories')
 connections_table = dynamodb.Table(CONNECTIONS_TABLE)
+histories_table = dynamodb.Table(HISTORIES_TABLE)
+
+
+def _response(status_code, body):
+    return {
+        'statusCode': status_code,
+        'body': json.dumps(body)
+    }
+
+
+def authenticated_doctor(event, query_params):
+    """
+    Doctor behind the connection: the principal of an API Gateway authorizer
+    when there is one, otherwise the owner of the Cognito access token sent as
+    the "token" query parameter (browsers can't set headers on a WebSocket).
+    Doctor IDs are Cognito subs. None if the caller is not authenticated.
+    """
+    authorizer = event['requestContext'].get('authorizer') or {}
+    principal = authorizer.get('principalId') or authorizer.get('sub')
+    if principal:
+        return principal
+
+    token = query_params.get('token')
+    if not token:
+        return None
+    try:
+        user = cognito_client.get_user(AccessToken=token)
+    except (cognito_client.exceptions.NotAuthorizedException,
+            cognito_client.exceptions.UserNotFoundException):
+        return None
+    attributes = {attr['Name']: attr['Value'] for attr in user['UserAttributes']}
+    return attributes.get('sub')
+
+
+def owns_history(doctor_id, history_id):
+    item = histories_table.get_item(
+        Key={'historyID': history_id},
+        ProjectionExpression='doctorID'
+    ).get('Item')
+    return item is not None and item.get('doctorID') == doctor_id
 
 
 def lambda_handler(event, context):
@@ -17,49 +61,63 @@ def lambda_handler(event, context):
     Store connectionId with historyID and userId for broadcasting.
 
     Query parameters expected:
-    - historyID: Medical record ID
-    - userId: User ID (from auth)
+    - token: Cognito access token of the doctor (unless an authorizer is attached)
+    - historyID: Medical record ID, must belong to the doctor
+    - doctorID: Doctor whose histories to follow (optional, pipeline progress
+      for lists), must be the authenticated doctor
+
+    userId is the authenticated doctor, whatever the client sends. Pipeline
+    events carry error messages, so nobody can follow someone else's histories.
     """
     try:
         connection_id = event['requestContext']['connectionId']
         query_params = event.get('queryStringParameters', {}) or {}
 
         history_id = query_params.get('historyID')
-        user_id = query_params.get('userId')
+        doctor_id = query_params.get('doctorID')
 
         print(f"New WebSocket connection: {connection_id}")
-        print(f"History ID: {history_id}, User ID: {user_id}")
+        print(f"History ID: {history_id}, Doctor ID: {doctor_id}")
+
+        user_id = authenticated_doctor(event, query_params)
+        if not user_id:
+            print(f"Rejected unauthenticated connection {connection_id}")
+            return _response(401, {'error': 'Unauthorized'})
+
+        if doctor_id and doctor_id != user_id:
+            print(f"Rejected connection {connection_id}: {user_id} asked for doctor {doctor_id}")
+            return _response(403, {'error': 'Forbidden'})
+
+        if history_id and not owns_history(user_id, history_id):
+            print(f"Rejected connection {connection_id}: {user_id} does not own history {history_id}")
+            return _response(403, {'error': 'Forbidden'})
 
-        if not history_id or not user_id:
-            print("Warning: Missing historyID or userId in connection")
+        if not history_id:
+            print("Warning: Missing historyID in connection")
             # Allow connection anyway, but log warning
-            history_id = history_id or "unknown"
-            user_id = user_id or "unknown"
+            history_id = "unknown"
+
+        connection = {
+            'connectionId': connection_id,
+            'historyID': history_id,
+            'userId': user_id,
+            'connectedAt': datetime.now().isoformat(),
+            'ttl': int(datetime.now().timestamp()) + 86400  # 24 hour TTL
+        }
+        # Only doctor subscriptions carry it, which keeps doctorID-index sparse
+        if doctor_id:
+            connection['doctorID'] = doctor_id
 
         # Store connection in DynamoDB
-        connections_table.put_item(
-            Item={
-                'connectionId': connection_id,
-                'historyID': history_id,
-                'userId': user_id,
-                'connectedAt': datetime.now().isoformat(),
-                'ttl': int(datetime.now().timestamp()) + 86400  # 24 hour TTL
-            }
-        )
+        connections_table.put_item(Item=connection)
 
         print(f"Stored connection {connection_id} for history {history_id}")
 
-        return {
-            'statusCode': 200,
-            'body': json.dumps({'message': 'Connected successfully'})
-        }
+        return _response(200, {'message': 'Connected successfully'})
 
     except Exception as e:
         print(f"Error handling connection: {e}")
         import traceback
         traceback.print_exc()
 
-        return {
-            'statusCode': 500,
-            'body': json.dumps({'error': str(e)})
-        }
+        return _response(500, {'error': str(e)})
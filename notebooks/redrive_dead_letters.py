@@ -0,0 +1,70 @@
+"""
+Bulk redrive of recording pipeline histories that failed for good.
+
+Lists the pipeline-dead-letters store through the "redrive" action of
+create_medical_history_from_recording and, unless --dry-run, restarts the
+selected histories from their last checkpoint, in batches. Redriven histories
+get a fresh set of automatic retries and run in the scheduler's batch lane.
+
+    python notebooks/redrive_dead_letters.py --dry-run
+    python notebooks/redrive_dead_letters.py --error-class transient --failed-since 2026-10-16T08:00:00Z
+    python notebooks/redrive_dead_letters.py --history-id 1234 --history-id 5678
+"""
+import json
+import argparse
+
+import boto3
+
+
+def invoke(lambda_client, function_name, body):
+    response = lambda_client.invoke(
+        FunctionName=function_name,
+        Payload=json.dumps({'body': json.dumps(body)})
+    )
+    result = json.loads(response['Payload'].read())
+    if result.get('statusCode') != 200:
+        raise SystemExit(f"{function_name} answered {result.get('statusCode')}: {result.get('body')}")
+    return json.loads(result['body'])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--function', default='create_medical_history_from_recording')
+    parser.add_argument('--history-id', action='append', dest='history_ids', help='repeat for several')
+    parser.add_argument('--error-class', choices=('transient', 'permanent', 'stalled', 'unknown'))
+    parser.add_argument('--failed-since', help='ISO timestamp, e.g. the start of a provider incident')
+    parser.add_argument('--batch-size', type=int, default=100, help='histories per invocation (REDRIVE_LIMIT caps it)')
+    parser.add_argument('--max-batches', type=int, default=10)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    lambda_client = boto3.client('lambda')
+    body = {'action': 'redrive', 'limit': args.batch_size}
+    if args.history_ids:
+        body['historyIDs'] = args.history_ids
+    if args.error_class:
+        body['errorClass'] = args.error_class
+    if args.failed_since:
+        body['failedSince'] = args.failed_since
+
+    if args.dry_run:
+        letters = invoke(lambda_client, args.function, {**body, 'dryRun': True})['deadLetters']
+        for letter in letters:
+            print(f"{letter['failedAt']}  {letter['historyID']}  {letter.get('errorClass', 'unknown'):<10} "
+                  f"{letter.get('resumeStage', '?'):<12} {letter.get('errorMessage', '')[:80]}")
+        print(f"\n{len(letters)} dead-lettered histories would be redriven")
+        return
+
+    redriven = 0
+    for _ in range(args.max_batches):
+        result = invoke(lambda_client, args.function, body)
+        redriven += len(result['redriven'])
+        print(f"Redriven {len(result['redriven'])}, skipped {len(result['skipped'])}")
+        # Redriven histories leave the store, so the next batch picks up the rest
+        if args.history_ids or len(result['redriven']) + len(result['skipped']) < args.batch_size:
+            break
+    print(f"\n{redriven} histories redriven")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+Simulation of the recording pipeline's admission queue under a noisy neighbor.
+
+One doctor syncs a backlog of offline recordings all at once while other
+doctors keep recording live consultations. It compares the latency (upload to
+completed note) of the live doctors' recordings with a plain FIFO queue, with
+the weighted fair queue of lambdas/create_medical_history_from_recording/fair_queue.py,
+and with that queue split into priority lanes where the backlog is batch work
+and --reserved places are kept for interactive recordings (scheduler.py).
+
+    python notebooks/scheduling_simulation.py [--places 8] [--reserved 2] [--backlog 150] [--seed 7]
+"""
+import os
+import sys
+import heapq
+import random
+import argparse
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambdas', 'create_medical_history_from_recording'))
+
+from fair_queue import FairQueue, job_cost
+
+
+class FifoQueue:
+    def __init__(self):
+        self._jobs = deque()
+
+    def push(self, tenant, job, cost, priority):
+        self._jobs.append(job)
+
+    def next(self, free):
+        return self._jobs.popleft() if self._jobs else None
+
+
+class FairPolicy:
+    def __init__(self):
+        self._queue = FairQueue()
+
+    def push(self, tenant, job, cost, priority):
+        self._queue.push(tenant, job, cost)
+
+    def next(self, free):
+        return self._queue.pop() if len(self._queue) else None
+
+
+class PriorityLanes:
+    """Interactive lane first; batch only while more than `reserved` places are free"""
+
+    def __init__(self, reserved):
+        self.reserved = reserved
+        self._lanes = {'interactive': FairQueue(), 'batch': FairQueue()}
+
+    def push(self, tenant, job, cost, priority):
+        self._lanes[priority].push(tenant, job, cost)
+
+    def next(self, free):
+        if len(self._lanes['interactive']):
+            return self._lanes['interactive'].pop()
+        if len(self._lanes['batch']) and free > self.reserved:
+            return self._lanes['batch'].pop()
+        return None
+
+
+def processing_seconds(duration):
+    """Pipeline time of a recording: transcription runs at about a quarter of real time, plus the note"""
+    return 0.25 * duration + 40
+
+
+def workload(backlog, live_doctors, hours, rng):
+    """(arrival, doctor, duration) of every recording"""
+    jobs = [(rng.uniform(0, 60), 'backlog-doctor', rng.uniform(10, 30) * 60) for _ in range(backlog)]
+    for doctor in range(live_doctors):
+        t = rng.uniform(0, 600)
+        while t < hours * 3600:
+            jobs.append((t, f"live-doctor-{doctor}", rng.uniform(5, 25) * 60))
+            t += rng.expovariate(1 / (20 * 60))
+    return sorted(jobs)
+
+
+def simulate(queue, jobs, places):
+    """Event-driven run; returns {doctor: [latency seconds, ...]}"""
+    events = [(arrival, 0, index) for index, (arrival, _, _) in enumerate(jobs)]
+    heapq.heapify(events)
+    free = places
+    latencies = {}
+
+    while events:
+        now, kind, index = heapq.heappop(events)
+        arrival, doctor, duration = jobs[index]
+        if kind == 0:
+            priority = 'batch' if doctor == 'backlog-doctor' else 'interactive'
+            queue.push(doctor, index, job_cost(duration), priority)
+        else:
+            free += 1
+            latencies.setdefault(doctor, []).append(now - arrival)
+
+        while free:
+            started = queue.next(free)
+            if started is None:
+                break
+            free -= 1
+            heapq.heappush(events, (now + processing_seconds(jobs[started][2]), 1, started))
+
+    return latencies
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--places', type=int, default=8, help='MAX_ACTIVE_PIPELINES')
+    parser.add_argument('--reserved', type=int, default=2, help='RESERVED_INTERACTIVE_PIPELINES')
+    parser.add_argument('--backlog', type=int, default=150, help='recordings synced by the noisy doctor')
+    parser.add_argument('--live-doctors', type=int, default=12)
+    parser.add_argument('--hours', type=float, default=4)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    jobs = workload(args.backlog, args.live_doctors, args.hours, random.Random(args.seed))
+    print(f"{len(jobs)} recordings, {args.backlog} of them from the backlog, {args.places} pipeline places\n")
+    print(f"{'queue':<6} {'live p50':>9} {'live p95':>9} {'live p99':>9} {'live max':>9} {'backlog done':>13}")
+
+    for name, queue in (('fifo', FifoQueue()), ('fair', FairPolicy()), ('lanes', PriorityLanes(args.reserved))):
+        latencies = simulate(queue, jobs, args.places)
+        live = [latency for doctor, values in latencies.items() if doctor != 'backlog-doctor' for latency in values]
+        backlog_done = max(latencies['backlog-doctor']) if args.backlog else 0
+        print(f"{name:<6} " + ' '.join(
+            f"{percentile(live, p) / 60:>8.1f}m" for p in (50, 95, 99, 100)
+        ) + f" {backlog_done / 3600:>12.1f}h")
+
+
+if __name__ == '__main__':
+    main()